@@ -0,0 +1,257 @@
+import os, sys
+dir_path = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.join(dir_path, os.path.pardir)
+sys.path.append(root_dir)
+import argparse
+import hashlib
+import itertools
+import json
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+home = str(Path.home())
+base_dir = os.path.join(home, 'mxt-sim')
+INFERENCE_SIM = os.path.join(dir_path, 'inference_sim.py')
+
+# Flags that change only how tensors are quantized, not the statistics collected by calibration
+QUANT_ONLY = ['qtype', 'qweight', 'fp_scaling', 'clipping', 'rho_act', 'rho_weight', 'stats_kind', 'stochastic',
+              'hw_scale', 'preserve_zero', 'per_channel_quant_weights', '-pcq_w', 'per_channel_quant_act', '-pcq_a',
+              'bit_alloc_act', 'bit_alloc_weight', 'bit_alloc_rmode', 'bit_alloc_prior', 'bias_corr_act',
+              'bias_corr_weight', 'var_corr_weight', 'precision_map', 'bit_search_budget', 'bit_search_target',
+              'bit_search_range', 'q_off', 'stats_mode', 'stats_folder', 'results_json', 'mlflow', 'mlf_experiment',
+              'print-freq', 'workers', 'cpu_workers', 'results_db', 'results_db_skip']
+# Placeholder quantization type of calibration runs
+CALIB_QTYPE = 'int8'
+# Flags that do not change results of a job
+NO_RESULT = ['print-freq', 'workers', 'cpu_workers', 'results_json', 'results_db', 'results_db_skip', 'mlflow',
+             'mlf_experiment']
+
+
+def load_grid(path):
+    """
+    Grid file (json, or yaml if pyyaml is installed):
+    {"name": ..., "base": {flag: value}, "grid": {flag: [values]}, "exclude": [{flag: value}]}
+    Flags are long names of inference_sim options without dashes (e.g. "qtype", "batch-size"),
+    or short options with leading dash (e.g. "-pcq_w"). True adds a switch, false and null omit it.
+    """
+    with open(path) as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            import yaml
+            grid = yaml.safe_load(f)
+        else:
+            grid = json.load(f)
+    grid.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    grid.setdefault('base', {})
+    grid.setdefault('grid', {})
+    grid.setdefault('exclude', [])
+    return grid
+
+
+def expand_grid(grid):
+    keys = sorted(grid['grid'].keys())
+    jobs = []
+    for values in itertools.product(*[grid['grid'][k] for k in keys]):
+        job = dict(grid['base'])
+        job.update(zip(keys, values))
+        if any([all([job.get(k) == v for k, v in ex.items()]) for ex in grid['exclude']]):
+            continue
+        jobs.append(job)
+    return jobs
+
+
+def config_hash(config, ignore=()):
+    c = {k: v for k, v in config.items() if k not in ignore and v is not None and v is not False}
+    return hashlib.sha1(json.dumps(c, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def to_argv(config):
+    argv = []
+    for k, v in sorted(config.items()):
+        flag = k if k.startswith('-') else '--' + k
+        if v is None or v is False:
+            continue
+        elif v is True:
+            argv.append(flag)
+        elif isinstance(v, (list, tuple)):
+            argv += [flag] + [str(i) for i in v]
+        else:
+            argv += [flag, str(v)]
+    return argv
+
+
+def uses_stats(job):
+    # Statistics collected by the runner, unless job points to existing statistics folder
+    return job.get('stats_mode') == 'use' and job.get('stats_folder') is None
+
+
+def per_channel_act(job):
+    return bool(job.get('per_channel_quant_act') or job.get('-pcq_a'))
+
+
+def calibration_config(job):
+    # Collect run shared by all jobs with the same calibration relevant flags
+    calib = {k: v for k, v in job.items() if k not in QUANT_ONLY}
+    # Statistics are collected only with quantization enabled, collection does not quantize so any qtype gives
+    # the same statistics, except kld statistics which are collected for the target type
+    calib['qtype'] = CALIB_QTYPE
+    if (job.get('kld_threshold') or job.get('-kld')) and job.get('qtype') is not None:
+        calib['qtype'] = job.get('qtype')
+    calib['stats_folder'] = 'grid_' + config_hash(calib, NO_RESULT)
+    calib['stats_mode'] = 'collect'
+    return calib
+
+
+def calibration_done(calib, per_channel):
+    sf = calib['stats_folder']
+    if calib.get('kld_threshold') or calib.get('-kld'):
+        sf += '_kld_' + calib['qtype']
+    if per_channel:
+        return os.path.exists(os.path.join(base_dir, 'statistics/per_channel', sf,
+                                           '%s_statistics_perchannel_summary.pkl' % sf))
+    return os.path.exists(os.path.join(base_dir, 'statistics', sf, '%s_summary.csv' % sf))
+
+
+class GridRunner:
+    """
+    Runs jobs of a grid as inference_sim processes.
+    Calibration (stats collection) is run once per group of jobs that share it and jobs are ordered by calibration
+    and architecture. Jobs run in parallel, each pinned to own cores within the cpu budget.
+    Results are cached by hash of job config, jobs with existing results are skipped.
+    """
+    def __init__(self, grid, cpus=None, cpus_per_job=1, out_dir=None, dry_run=False, results_db=None):
+        self.grid = grid
+        self.results_db = results_db
+        self.out_dir = out_dir if out_dir is not None else os.path.join(base_dir, 'grid', grid['name'])
+        self.results_dir = os.path.join(base_dir, 'grid', 'results')
+        self.logs_dir = os.path.join(self.out_dir, 'logs')
+        os.makedirs(self.results_dir, exist_ok=True)
+        os.makedirs(self.logs_dir, exist_ok=True)
+        self.dry_run = dry_run
+        cores = sorted(os.sched_getaffinity(0))
+        cpus = len(cores) if cpus is None else min(cpus, len(cores))
+        self.cpus_per_job = max(1, min(cpus_per_job, cpus))
+        k = self.cpus_per_job
+        self.core_groups = [cores[i * k:(i + 1) * k] for i in range(cpus // k)]
+        self.free_groups = list(self.core_groups)
+        self.taskset = shutil.which('taskset')
+        if self.taskset is None:
+            print("taskset not found, jobs are not pinned to cores")
+        self.lock = threading.Condition()
+
+    def result_path(self, job):
+        return os.path.join(self.results_dir, config_hash(job, NO_RESULT) + '.json')
+
+    def __acquire_cores(self):
+        with self.lock:
+            while len(self.free_groups) == 0:
+                self.lock.wait()
+            return self.free_groups.pop()
+
+    def __release_cores(self, cores):
+        with self.lock:
+            self.free_groups.append(cores)
+            self.lock.notify()
+
+    def run_process(self, config, name):
+        argv = [sys.executable, INFERENCE_SIM] + to_argv(config)
+        if self.dry_run:
+            print(' '.join(argv))
+            return 0
+        cores = self.__acquire_cores()
+        try:
+            env = dict(os.environ)
+            env['OMP_NUM_THREADS'] = str(len(cores))
+            env['MKL_NUM_THREADS'] = str(len(cores))
+            # Pinned by taskset, preexec_fn is not safe in threads of the pool
+            if self.taskset is not None:
+                argv = [self.taskset, '-c', ','.join([str(c) for c in cores])] + argv
+            start = time.time()
+            with open(os.path.join(self.logs_dir, name + '.log'), 'w') as log:
+                ret = subprocess.call(argv, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=root_dir)
+            print("%s %s in %.1fs" % (name, 'done' if ret == 0 else 'failed (%d)' % ret, time.time() - start))
+            return ret
+        finally:
+            self.__release_cores(cores)
+
+    def run_calibration(self, calib, per_channel):
+        config = dict(calib)
+        if per_channel:
+            config['per_channel_quant_act'] = True
+        return self.run_process(config, 'calib_%s%s' % (calib['stats_folder'], '_pc' if per_channel else ''))
+
+    def run_job(self, job):
+        config = dict(job)
+        config['results_json'] = self.result_path(job)
+        if self.results_db is not None:
+            config['results_db'] = self.results_db
+        if uses_stats(job):
+            config['stats_folder'] = calibration_config(job)['stats_folder']
+        return self.run_process(config, 'job_' + config_hash(job, NO_RESULT))
+
+    def run(self):
+        jobs = expand_grid(self.grid)
+        todo = [j for j in jobs if not os.path.exists(self.result_path(j))]
+        print("Grid %s: %d jobs, %d cached, %d workers x %d cores" % (self.grid['name'], len(jobs),
+              len(jobs) - len(todo), len(self.core_groups), self.cpus_per_job))
+
+        # Calibration runs needed by remaining jobs, each once
+        calibrations = {}
+        for j in todo:
+            if uses_stats(j):
+                calib = calibration_config(j)
+                # Per layer statistics are always needed, per channel only for per channel activations
+                for pc in set([False, per_channel_act(j)]):
+                    calibrations[(calib['stats_folder'], pc)] = (calib, pc)
+        calibrations = [c for c in calibrations.values() if not calibration_done(*c)]
+
+        # Jobs sharing calibration and architecture next to each other, warm caches
+        todo.sort(key=lambda j: (calibration_config(j)['stats_folder'] if uses_stats(j) else '', str(j.get('arch'))))
+
+        with ThreadPoolExecutor(len(self.core_groups)) as pool:
+            failed = [c for c, r in zip(calibrations, pool.map(lambda c: self.run_calibration(*c), calibrations))
+                      if r != 0]
+            failed_calib = set([c[0]['stats_folder'] for c in failed])
+            if len(failed) > 0:
+                print("%d calibration runs failed, skipping their jobs" % len(failed))
+            todo = [j for j in todo if not (uses_stats(j) and calibration_config(j)['stats_folder'] in failed_calib)]
+            list(pool.map(self.run_job, todo))
+
+        return self.summary(jobs)
+
+    def summary(self, jobs):
+        import pandas as pd
+        keys = sorted(self.grid['grid'].keys())
+        rows = []
+        for j in jobs:
+            res = {'loss': None, 'top1': None, 'top5': None}
+            if os.path.exists(self.result_path(j)):
+                with open(self.result_path(j)) as f:
+                    res.update(json.load(f))
+            rows.append([j.get(k) for k in keys] + [res['loss'], res['top1'], res['top5'],
+                                                    config_hash(j, NO_RESULT)])
+        df = pd.DataFrame(data=rows, columns=keys + ['loss', 'top1', 'top5', 'hash'])
+        if not self.dry_run:
+            path = os.path.join(self.out_dir, '%s.csv' % self.grid['name'])
+            df.to_csv(path, index=False)
+            print("Results saved to %s" % path)
+        print(df)
+        return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run grid of inference_sim experiments')
+    parser.add_argument('grid', help='Grid file, json or yaml')
+    parser.add_argument('--cpus', '-c', default=None, type=int, help='Cpu budget, number of cores (default: all)')
+    parser.add_argument('--cpus_per_job', '-cpj', default=1, type=int, help='Cores per job')
+    parser.add_argument('--out_dir', '-o', default=None, help='Output folder (default: ~/mxt-sim/grid/<name>)')
+    parser.add_argument('--dry_run', '-n', action='store_true', default=False, help='Print commands only')
+    parser.add_argument('--results_db', '-rdb', default=None, help='Also append job results to SQLite results database')
+    args = parser.parse_args()
+
+    GridRunner(load_grid(args.grid), cpus=args.cpus, cpus_per_job=args.cpus_per_job, out_dir=args.out_dir,
+               dry_run=args.dry_run, results_db=args.results_db).run()
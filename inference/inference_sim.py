@@ -9,7 +9,10 @@ import random
 import shutil
 import time
 import collections
+import copy
+import math
 import warnings
+import json
 import torch
 import torch.nn as nn
 import torch.nn.parallel
@@ -18,21 +21,25 @@ import torch.optim
 import torch.utils.data
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-import torchvision.models as models
-from utils.meters import AverageMeter, accuracy
+from utils.dataset import StratifiedSampler
+from utils.synthetic_data import synthetic_dataset
+from utils.meters import AverageMeter, BinomialMeter, EarlyStop, accuracy
 from pytorch_quantizer.quantization.inference.inference_quantization_manager import QuantizationManagerInference as QM
 from utils.log import EvalLog
-from utils.absorb_bn import search_absorbe_bn
-from utils.mark_relu import resnet_mark_before_relu
+from utils.absorb_bn import is_bn, search_absorbe_bn
+from utils.mark_relu import mark_before_relu, resnet_mark_before_relu
 from utils.model_naming import set_node_names
 import numpy as np
 from utils.dump_manager import DumpManager as DM
+from pytorch_quantizer.quantization.codebook import load_codebook_state
+from pytorch_quantizer.quantization.inference.statistic_manager import StatisticManager
+from pytorch_quantizer.quantization.inference.bit_search import search_bit_widths, save_precision_map
+from utils.cpu_parallel import run_cpu_parallel, shard_range, split_cores
+from utils.distributed import init_distributed, is_distributed, is_main_process, get_rank, get_world_size, \
+    all_reduce_meters, all_reduce_sum, barrier, DistributedBatchSampler
 # import pretrainedmodels
 # import pretrainedmodels.utils as mutils
 from pathlib import Path
-import mlflow
 
 
 torch.backends.cudnn.deterministic = True
@@ -41,72 +48,106 @@ torch.backends.cudnn.deterministic = True
 home = str(Path.home())
 IMAGENET_FOR_INFERENCE = '/home/cvds_lab/datasets/ILSVRC2012/'
 
-mlflow.set_tracking_uri(os.path.join(home, 'mlruns_mxt'))
-
-model_names = sorted(name for name in models.__dict__
-    if name.islower() and not name.startswith("__")
-    and callable(models.__dict__[name]))
-model_names.append('shufflenet')
-model_names.append('mobilenetv2')
-# model_names+=pretrainedmodels.model_names
-
-parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
-parser.add_argument('--data', metavar='DIR', default=IMAGENET_FOR_INFERENCE,
-                    help='path to dataset')
-parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
-                    choices=model_names,
-                    help='model architecture: ' +
-                        ' | '.join(model_names) +
-                        ' (default: resnet18)')
-parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
-                    help='number of data loading workers (default: 4)')
-parser.add_argument('-b', '--batch-size', default=256, type=int,
-                    metavar='N', help='mini-batch size (default: 256)')
-parser.add_argument('--print-freq', '-p', default=10, type=int,
-                    metavar='N', help='print frequency (default: 10)')
-parser.add_argument('--seed', default=None, type=int,
-                    help='seed for initializing training. ')
-parser.add_argument('--device', default='cuda',
-                    help='device assignment ("cpu" or "cuda")')
-parser.add_argument('--device_ids', default=[0], type=int, nargs='+',
-                    help='device ids assignment (e.g 0 1 2 3')
-
-parser.add_argument('--qtype', default=None, help='data type: bfloat[N], int[N]')
-parser.add_argument('--qweight', '-qw', default='int8', help='quantizer for weights')
-parser.add_argument('--qmodel', '-qm', type=int, default=None, help='load quantized model')
-parser.add_argument('--no_bias_corr', '-nb', action='store_true', help='Load model w/o bias correction')
-parser.add_argument('--q_off', action='store_true', help='dissable quantization')
-parser.add_argument('--shuffle', '-sh', action='store_true', help='shuffle data')
-parser.add_argument('--stochastic', '-s', action='store_true', help='Stochastic rounding.', default=False)
-parser.add_argument('--hw_scale', '-hs', action='store_true', help='Force scale to be HW compatible', default=False)
-parser.add_argument('--preserve_zero', '-pz', action='store_true', help='Preserve zero during quantization', default=False)
-parser.add_argument('--eval_precision', '-ep', action='store_true', default=False, help='Evaluate different precisions, to csv.')
-parser.add_argument('--clipping', '-c', default='no', help='Clipping type: [no, gaus, exp, laplace]')
-parser.add_argument('--rho_act', '-ra', default=None, type=float, help='Rho parameter for activations clipping')
-parser.add_argument('--rho_weight', '-rw', default=None, type=float, help='Rho parameter for weights clipping')
-parser.add_argument('--stats_mode', '-sm', default='no', help='Specify if collect stats, use or not stats: [collect, use, no]')
-parser.add_argument('--stats_kind', '-sk', default='mean', help='Specify kind of stats to use: [mean, max]')
-parser.add_argument('--stats_folder', '-sf', default=None, help='Specify directory of for statistics')
-parser.add_argument('--stats_batch_avg', '-sba', action='store_true', help='Whether average statistics across the batch')
-parser.add_argument('--custom_test', '-ct', action='store_true', default=False, help='Perform some custom test.')
-parser.add_argument('--dump_dir', '-dd', default=None, help='Directory to dump tensors')
-parser.add_argument('--measure_stats', '-m', action='store_true', help='Measure statistics of activations during runtime', default=False)
-parser.add_argument('--measure_stats_folder', '-mf', help='Folder to save measured statistics of activations during runtime', default=None)
-parser.add_argument('--kld_threshold', '-kld', action='store_true', help='Measure statistics of activations during runtime', default=False)
-parser.add_argument('--aciq_cal', '-ac', action='store_true', help='Enable aciq calibration mode', default=False)
-parser.add_argument('--cal_set_size', '-cs', default=5120, type=int, help='Size of calibration set for threshold evaluation (default: 2048)')
-parser.add_argument('--subset', '-ss', default=None, type=int, help='Run on subset of data')
-parser.add_argument('--per_channel_quant_weights', '-pcq_w', action='store_true', help='Per channel quantization of weights', default=False)
-parser.add_argument('--per_channel_quant_act', '-pcq_a', action='store_true', help='Per channel quantization of activations', default=False)
-parser.add_argument('--bit_alloc_act', '-baa', action='store_true', help='Optimal bit allocation for each channel of activations', default=False)
-parser.add_argument('--bit_alloc_weight', '-baw', action='store_true', help='Optimal bit allocation for each channel of weights', default=False)
-parser.add_argument('--bit_alloc_rmode', '-bam', help='One of [round, ceil]', default='ceil')
-parser.add_argument('--bit_alloc_prior', '-bap', help='One of [gaus, laplace]', default='gaus')
-parser.add_argument('--bias_corr_act', '-bca', action='store_true', help='Bias correction for activations', default=False)
-parser.add_argument('--bias_corr_weight', '-bcw', action='store_true', help='Bias correction for weights', default=False)
-parser.add_argument('--var_corr_weight', '-vcw', action='store_true', help='Variance correction for weights', default=False)
-parser.add_argument('--mlf_experiment', '-mlexp', help='Name of experiment', default=None)
-args = parser.parse_args()
+
+def get_model_names():
+    import torchvision.models as models
+    model_names = sorted(name for name in models.__dict__
+        if name.islower() and not name.startswith("__")
+        and callable(models.__dict__[name]))
+    model_names.append('shufflenet')
+    model_names.append('mobilenetv2')
+    # model_names+=pretrainedmodels.model_names
+    return model_names
+
+
+def get_parser():
+    # Heavy packages (torchvision, mlflow, pandas, scipy) are imported only by features that use them
+    parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
+    parser.add_argument('--data', metavar='DIR', default=IMAGENET_FOR_INFERENCE,
+                        help='path to dataset')
+    parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
+                        help='model architecture: torchvision model name, shufflenet or mobilenetv2 (default: resnet18)')
+    parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
+                        help='number of data loading workers (default: 4)')
+    parser.add_argument('-b', '--batch-size', default=256, type=int,
+                        metavar='N', help='mini-batch size (default: 256)')
+    parser.add_argument('--print-freq', '-p', default=10, type=int,
+                        metavar='N', help='print frequency (default: 10)')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='seed for initializing training. ')
+    parser.add_argument('--device', default='cuda',
+                        help='device assignment ("cpu" or "cuda")')
+    parser.add_argument('--device_ids', default=[0], type=int, nargs='+',
+                        help='device ids assignment (e.g 0 1 2 3')
+    parser.add_argument('--cpu_workers', '-cw', default=1, type=int,
+                        help='number of evaluation processes on cpu, each with own cores and shard of validation set')
+    parser.add_argument('--distributed', '-dist', action='store_true', default=False,
+                        help='distributed calibration and evaluation over gloo, rank and world size from environment (torchrun)')
+
+    parser.add_argument('--qtype', default=None, help='data type: int[N], bfloat[N], half, fp[N]e[E]m[M] (e.g. fp8e4m3, fp8e5m2)')
+    parser.add_argument('--qweight', '-qw', default='int8', help='quantizer for weights')
+    parser.add_argument('--fp_scaling', '-fps', default='max', help='Per tensor scaling of float quantizers: [max, no]')
+    parser.add_argument('--qmodel', '-qm', type=int, default=None, help='load quantized model')
+    parser.add_argument('--no_bias_corr', '-nb', action='store_true', help='Load model w/o bias correction')
+    parser.add_argument('--q_off', action='store_true', help='dissable quantization')
+    parser.add_argument('--shuffle', '-sh', action='store_true', help='shuffle data')
+    parser.add_argument('--stochastic', '-s', action='store_true', help='Stochastic rounding.', default=False)
+    parser.add_argument('--hw_scale', '-hs', action='store_true', help='Force scale to be HW compatible', default=False)
+    parser.add_argument('--preserve_zero', '-pz', action='store_true', help='Preserve zero during quantization', default=False)
+    parser.add_argument('--eval_precision', '-ep', action='store_true', default=False, help='Evaluate different precisions, to csv.')
+    parser.add_argument('--clipping', '-c', default='no', help='Clipping type: [no, gaus, exp, laplace]')
+    parser.add_argument('--rho_act', '-ra', default=None, type=float, help='Rho parameter for activations clipping')
+    parser.add_argument('--rho_weight', '-rw', default=None, type=float, help='Rho parameter for weights clipping')
+    parser.add_argument('--stats_mode', '-sm', default='no', help='Specify if collect stats, use or not stats: [collect, use, no]')
+    parser.add_argument('--stats_kind', '-sk', default='mean', help='Specify kind of stats to use: [mean, max]')
+    parser.add_argument('--stats_folder', '-sf', default=None, help='Specify directory of for statistics')
+    parser.add_argument('--stats_batch_avg', '-sba', action='store_true', help='Whether average statistics across the batch')
+    parser.add_argument('--calib_mem_budget', '-cmb', default=None, type=float, help='Memory budget in MB for statistics buffers during calibration')
+    parser.add_argument('--calib_mem_policy', '-cmp', default='stream', help='What to do when calibration exceeds memory budget: [stream, spill]')
+    parser.add_argument('--custom_test', '-ct', action='store_true', default=False, help='Perform some custom test.')
+    parser.add_argument('--dump_dir', '-dd', default=None, help='Directory to dump tensors')
+    parser.add_argument('--dump_async', '-da', action='store_true', help='Dump tensors by background writer into one npz per batch', default=False)
+    parser.add_argument('--dump_compress', '-dc', action='store_true', help='Compress async dump containers', default=False)
+    parser.add_argument('--dump_queue_mb', '-dqm', default=1024, type=float, help='Max memory of tensors waiting for async dump (MB)')
+    parser.add_argument('--measure_stats', '-m', action='store_true', help='Measure statistics of activations during runtime', default=False)
+    parser.add_argument('--measure_stats_folder', '-mf', help='Folder to save measured statistics of activations during runtime', default=None)
+    parser.add_argument('--profile_quant', '-pq', action='store_true', help='Profile quantization per layer, dump summary table and chrome trace', default=False)
+    parser.add_argument('--kld_threshold', '-kld', action='store_true', help='Measure statistics of activations during runtime', default=False)
+    parser.add_argument('--aciq_cal', '-ac', action='store_true', help='Enable aciq calibration mode', default=False)
+    parser.add_argument('--cal_set_size', '-cs', default=5120, type=int, help='Size of calibration set for threshold evaluation (default: 2048)')
+    parser.add_argument('--cal_stratified', '-cst', action='store_true', default=False, help='Class balanced seeded calibration set for statistics collection')
+    parser.add_argument('--cal_synthetic', '-csyn', default=None, type=int, help='Collect statistics on N synthetic images generated from BN statistics, no dataset needed')
+    parser.add_argument('--cal_synthetic_iters', '-csi', default=500, type=int, help='Optimization iterations per batch of synthetic images')
+    parser.add_argument('--subset', '-ss', default=None, type=int, help='Run on subset of data')
+    parser.add_argument('--early_stop', '-es', action='store_true', default=False, help='Stop evaluation when top1 confidence interval is tight enough or below reference (shuffles data)')
+    parser.add_argument('--es_width', '-esw', default=0.5, type=float, help='Early stop when confidence interval of top1 is within +- width (percent)')
+    parser.add_argument('--es_confidence', '-esc', default=0.99, type=float, help='Confidence level of early stop intervals')
+    parser.add_argument('--es_reference', '-esr', default=None, type=float, help='Early stop when top1 is clearly below reference accuracy (percent)')
+    parser.add_argument('--es_min_samples', '-esm', default=1000, type=int, help='Minimal number of images before early stop')
+    parser.add_argument('--es_agreement', '-esa', action='store_true', default=False, help='Also track agreement of top1 with fp32 model, keeps fp32 copy of the model')
+    parser.add_argument('--per_channel_quant_weights', '-pcq_w', action='store_true', help='Per channel quantization of weights', default=False)
+    parser.add_argument('--per_channel_quant_act', '-pcq_a', action='store_true', help='Per channel quantization of activations', default=False)
+    parser.add_argument('--bit_alloc_act', '-baa', action='store_true', help='Optimal bit allocation for each channel of activations', default=False)
+    parser.add_argument('--bit_alloc_weight', '-baw', action='store_true', help='Optimal bit allocation for each channel of weights', default=False)
+    parser.add_argument('--bit_alloc_rmode', '-bam', help='One of [round, ceil]', default='ceil')
+    parser.add_argument('--bit_alloc_prior', '-bap', help='One of [gaus, laplace]', default='gaus')
+    parser.add_argument('--bias_corr_act', '-bca', action='store_true', help='Bias correction for activations', default=False)
+    parser.add_argument('--bias_corr_weight', '-bcw', action='store_true', help='Bias correction for weights', default=False)
+    parser.add_argument('--var_corr_weight', '-vcw', action='store_true', help='Variance correction for weights', default=False)
+    parser.add_argument('--codebook_model', '-cbm', default=None, help='Load weights from codebook model saved by kmeans_quantization')
+    parser.add_argument('--precision_map', '-pmap', default=None, help='Json file with per layer bit widths {layer: {act: bits, weight: bits}}')
+    parser.add_argument('--bit_search_budget', '-bsb', default=None, type=float, help='Search mixed precision under budget: model size in MB or GBOPs per image')
+    parser.add_argument('--bit_search_target', '-bst', default='size', help='Budget of mixed precision search: [size, bops]')
+    parser.add_argument('--bit_search_range', '-bsr', default=[2, 8], type=int, nargs=2, help='Min and max bit width for mixed precision search')
+    parser.add_argument('--results_json', '-rj', default=None, help='Save loss, top1 and top5 of the run to json file')
+    parser.add_argument('--results_db', '-rdb', default=None, help='Append results to SQLite results database (e.g. ~/mxt-sim/results.db)')
+    parser.add_argument('--results_db_skip', '-rdbs', action='store_true', default=False, help='Skip run if results database has result of the same config and code version')
+    parser.add_argument('--mlflow', '-mlf', action='store_true', help='Track run with mlflow', default=False)
+    parser.add_argument('--mlf_experiment', '-mlexp', help='Name of experiment', default=None)
+    return parser
+
+
+args = get_parser().parse_args()
 
 if args.arch == 'resnet50':
     max_mse_order_id = ['linear0_activation', 'conv52_activation', 'conv49_activation', 'conv46_activation', 'conv43_activation', 'conv2_activation', 'conv25_activation', 'conv5_activation', 'conv1_activation', 'conv3_activation', 'conv9_activation', 'conv50_activation', 'conv12_activation', 'conv6_activation', 'conv13_activation', 'conv51_activation', 'conv44_activation', 'conv48_activation', 'conv22_activation', 'conv8_activation', 'conv41_activation', 'conv29_activation', 'conv26_activation', 'conv19_activation', 'conv47_activation', 'conv40_activation', 'conv32_activation', 'conv45_activation', 'conv38_activation', 'conv18_activation', 'conv35_activation', 'conv37_activation', 'conv21_activation', 'conv16_activation', 'conv34_activation', 'conv28_activation', 'conv4_activation', 'conv31_activation', 'conv11_activation', 'conv27_activation', 'conv15_activation', 'conv14_activation', 'conv42_activation', 'conv17_activation', 'conv20_activation', 'conv10_activation', 'conv24_activation', 'conv23_activation', 'conv30_activation', 'conv39_activation', 'conv7_activation', 'conv36_activation', 'conv33_activation']
@@ -124,6 +165,12 @@ elif args.arch == 'inception_v3':
 class InferenceModel:
     def __init__(self):
         global args, best_prec1
+        import torchvision.models as models
+        import torchvision.transforms as transforms
+        import torchvision.datasets as datasets
+
+        if args.arch not in get_model_names():
+            raise ValueError('Invalid architecture %s, one of: %s' % (args.arch, ' | '.join(get_model_names())))
 
         if args.seed is not None:
             random.seed(args.seed)
@@ -164,16 +211,46 @@ class InferenceModel:
 
         set_node_names(self.model)
 
-        # Mark layers before relue for fusing
-        if 'resnet' in args.arch:
-            resnet_mark_before_relu(self.model)
+        # Synthetic calibration data needs BN statistics, generated before BN folding
+        self.synthetic_dataset = None
+        if args.cal_synthetic is not None and args.stats_mode == 'collect':
+            self.model.to(args.device)
+            quantize = QM().enabled
+            QM().disable()
+            cache_name = '%s_%d_iters%d_seed%d' % (args.arch, args.cal_synthetic, args.cal_synthetic_iters,
+                                                  args.seed if args.seed is not None else 0)
+            gen_args = (self.model, args.cal_synthetic, args.batch_size, 224 if args.arch != 'inception_v3' else 299,
+                        args.cal_synthetic_iters, args.seed if args.seed is not None else 0, args.device, cache_name)
+            # Generated once, other ranks load cached images
+            if is_main_process():
+                self.synthetic_dataset = synthetic_dataset(*gen_args)
+            barrier()
+            if not is_main_process():
+                self.synthetic_dataset = synthetic_dataset(*gen_args)
+            if quantize:
+                QM().enable()
 
         # BatchNorm folding
-        if 'resnet' in args.arch or args.arch == 'vgg16_bn' or args.arch == 'inception_v3':
-            print("Perform BN folding")
-            search_absorbe_bn(self.model)
+        if any([is_bn(m) for m in self.model.modules()]):
+            print("Perform BN folding, %d layers folded" % search_absorbe_bn(self.model))
             QM().bn_folding = True
 
+        # Mark layers before relu for half range quantization and fusing relu, detected on traced model
+        marked = mark_before_relu(self.model)
+        if marked is not None:
+            print("%d layers before relu" % len(marked))
+            QM().set_relu_marked(True)
+        elif 'resnet' in args.arch:
+            resnet_mark_before_relu(self.model)
+
+        # Clustered weights are saved with folded BN
+        if args.codebook_model is not None:
+            if not QM().bn_folding:
+                search_absorbe_bn(self.model)
+                QM().bn_folding = True
+            print("=> loading codebook weights '{}'".format(args.codebook_model))
+            load_codebook_state(self.model, args.codebook_model)
+
         # if args.qmodel is not None:
         #     model_q_path = os.path.join(os.path.join(home, 'mxt-sim/models'), args.arch + '_lowp_pcq%dbit%s.pt' % (args.qmodel, ('' if args.no_bias_corr else '_bcorr')))
         #     model_q = torch.load(model_q_path)
@@ -184,6 +261,22 @@ class InferenceModel:
         #     del model_q
 
         self.model.to(args.device)
+
+        # Data free mixed precision search based on collected statistics
+        if args.bit_search_budget is not None and args.stats_mode == 'use':
+            qbits = int(args.qtype[len('int'):]) if args.qtype is not None and args.qtype.startswith('int') else 8
+            precision_map = search_bit_widths(self.model, StatisticManager().stats_df, args.bit_search_budget,
+                                              target=args.bit_search_target, clipping=args.clipping,
+                                              per_channel_weights=args.per_channel_quant_weights,
+                                              batch_size=args.batch_size, bits=args.bit_search_range,
+                                              default_act_bits=qbits, ignore_ids=QM().op_manager.ignore_ids)
+            if args.precision_map is not None:
+                save_precision_map(precision_map, args.precision_map)
+            QM().set_precision_map(precision_map)
+
+        # Reference for agreement of predictions, before weights are quantized
+        self.model_fp32 = copy.deepcopy(self.model) if args.early_stop and args.es_agreement else None
+
         QM().quantize_model(self.model)
 
         if args.device_ids and len(args.device_ids) > 1 and args.arch != 'shufflenet' and args.arch != 'mobilenetv2':
@@ -216,18 +309,38 @@ class InferenceModel:
                 normalize,
             ]
 
-        self.val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(valdir, transforms.Compose(tfs)),
-            batch_size=args.batch_size, shuffle=(True if (args.kld_threshold or args.aciq_cal or args.shuffle) else False),
-            num_workers=args.workers, pin_memory=True)
+        if self.synthetic_dataset is not None:
+            self.val_dataset = self.synthetic_dataset
+        else:
+            self.val_dataset = datasets.ImageFolder(valdir, transforms.Compose(tfs))
+        # Early stop needs random order of images, validation set is sorted by class
+        shuffle = True if (args.kld_threshold or args.aciq_cal or args.shuffle or args.early_stop) else False
+        sampler = None
+        if args.cal_stratified and args.stats_mode == 'collect':
+            # Built from labels of ImageFolder, no images are decoded
+            cal_size = args.cal_set_size if (args.kld_threshold or args.aciq_cal) else args.subset
+            sampler = StratifiedSampler(self.val_dataset, cal_size, seed=args.seed if args.seed is not None else 0)
+            shuffle = False
+        if is_distributed():
+            # Each rank gets whole batches of the single process order
+            batch_sampler = DistributedBatchSampler(self.val_dataset, args.batch_size, shuffle=shuffle,
+                                                    seed=args.seed if args.seed is not None else 0, sampler=sampler)
+            self.val_loader = torch.utils.data.DataLoader(self.val_dataset, batch_sampler=batch_sampler,
+                                                          num_workers=args.workers, pin_memory=True)
+        else:
+            self.val_loader = torch.utils.data.DataLoader(
+                self.val_dataset,
+                batch_size=args.batch_size, shuffle=shuffle, sampler=sampler,
+                num_workers=args.workers, pin_memory=True)
 
     def run(self):
         if args.eval_precision:
             elog = EvalLog(['dtype', 'val_prec1', 'val_prec5'])
             print("\nFloat32 no quantization")
             QM().disable()
-            val_loss, val_prec1, val_prec5 = validate(self.val_loader, self.model, self.criterion)
+            val_loss, val_prec1, val_prec5 = self.validate()
             elog.log('fp32', val_prec1, val_prec5)
+            save_result(val_loss, val_prec1, val_prec5, tag='fp32')
             logging.info('\nValidation Loss {val_loss:.4f} \t'
                          'Validation Prec@1 {val_prec1:.3f} \t'
                          'Validation Prec@5 {val_prec5:.3f} \n'
@@ -239,8 +352,9 @@ class InferenceModel:
                 print("\nQuantize to %s" % args.qtype)
                 QM().quantize = True
                 QM().reload(args, get_params())
-                val_loss, val_prec1, val_prec5 = validate(self.val_loader, self.model, self.criterion)
+                val_loss, val_prec1, val_prec5 = self.validate()
                 elog.log(args.qtype, val_prec1, val_prec5)
+                save_result(val_loss, val_prec1, val_prec5, tag='eval_precision')
                 logging.info('\nValidation Loss {val_loss:.4f} \t'
                              'Validation Prec@1 {val_prec1:.3f} \t'
                              'Validation Prec@5 {val_prec5:.3f} \n'
@@ -255,20 +369,97 @@ class InferenceModel:
                 _8bit_layers = ['conv0_activation'] + max_mse_order_id[0:i]
                 print("it: %d, 8 bit layers: %d" % (i, len(_8bit_layers)))
                 QM().set_8bit_list(_8bit_layers)
-                val_loss, val_prec1, val_prec5 = validate(self.val_loader, self.model, self.criterion)
+                val_loss, val_prec1, val_prec5 = self.validate()
                 elog.log(i+1, str(_8bit_layers), val_prec1, val_prec5)
+                save_result(val_loss, val_prec1, val_prec5, tag='8bit_layers:' + ','.join(_8bit_layers))
             print(elog)
         else:
-            val_loss, val_prec1, val_prec5 = validate(self.val_loader, self.model, self.criterion)
-            if mlflow.active_run() is not None:
-                mlflow.log_metric('top1', val_prec1)
-                mlflow.log_metric('top5', val_prec5)
-                mlflow.log_metric('loss', val_loss)
+            val_loss, val_prec1, val_prec5 = self.validate()
+            save_result(val_loss, val_prec1, val_prec5)
+            if args.mlflow and is_main_process():
+                import mlflow
+                if mlflow.active_run() is not None:
+                    mlflow.log_metric('top1', val_prec1)
+                    mlflow.log_metric('top5', val_prec5)
+                    mlflow.log_metric('loss', val_loss)
             return val_loss, val_prec1, val_prec5
 
+    def validate(self):
+        if args.cpu_workers > 1 and 'cuda' not in args.device:
+            if args.stats_mode == 'collect' or args.dump_dir is not None or args.measure_stats or \
+                    args.profile_quant or args.shuffle or args.kld_threshold or args.aciq_cal or args.early_stop:
+                print("CPU parallel evaluation does not support stats collection, dump, measure, profiling, shuffle or "
+                      "early stop."
+                      " Running single process.")
+            else:
+                return validate_cpu_parallel(self.val_dataset, self.model, self.criterion, args.cpu_workers)
+        return validate(self.val_loader, self.model, self.criterion, self.model_fp32)
+
+
+# Images evaluated by the last validation and whether it was stopped early
+last_eval = {'images': 0, 'early_stop': False}
 
 
-def validate(val_loader, model, criterion):
+def save_result(val_loss, val_prec1, val_prec5, tag=None):
+    if args.results_db is not None and is_main_process() and args.stats_mode != 'collect':
+        from utils.results_db import ResultsDB
+        db = ResultsDB(os.path.expanduser(args.results_db))
+        db.add(args, val_loss, val_prec1, val_prec5, tag=tag, images=last_eval['images'],
+               early_stop=last_eval['early_stop'])
+        db.close()
+
+
+def validate_cpu_parallel(dataset, model, criterion, workers):
+    # switch to evaluate mode, forked workers use the same model memory
+    model.eval()
+    model.share_memory()
+    # No more workers than available cores
+    workers = len(split_cores(workers))
+
+    num_samples = len(dataset)
+    if args.subset is not None:
+        # Same samples as single process, which stops after the batch that reaches subset
+        num_samples = min(num_samples, ((args.subset + args.batch_size - 1) // args.batch_size) * args.batch_size)
+
+    def validate_shard(rank):
+        start, end = shard_range(num_samples, workers, rank, align=args.batch_size)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, end)),
+                                             batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
+        batch_time = AverageMeter()
+        # Sum of loss and counts of correct predictions, aggregated exactly across workers
+        loss_sum, correct1, correct5 = 0., 0, 0
+        with torch.no_grad():
+            end_time = time.time()
+            for i, (input, target) in enumerate(loader):
+                output = model(input)
+                QM().reset_counters()
+
+                loss = criterion(output, target)
+                prec1, prec5 = accuracy(output, target, topk=(1, 5))
+                n = input.size(0)
+                loss_sum += loss.item() * n
+                correct1 += int(round(float(prec1) * n / 100))
+                correct5 += int(round(float(prec5) * n / 100))
+
+                batch_time.update(time.time() - end_time)
+                end_time = time.time()
+                if rank == 0 and i % args.print_freq == 0:
+                    print('Test: [{0}/{1}] (worker 0 of {2})\t'
+                          'Time {batch_time.val:.3f} ({batch_time.avg:.3f})'.format(
+                           i, len(loader), workers, batch_time=batch_time))
+        return loss_sum, correct1, correct5, end - start
+
+    results = run_cpu_parallel(validate_shard, workers)
+    count = sum([r[3] for r in results])
+    loss = sum([r[0] for r in results]) / count
+    prec1 = 100. * sum([r[1] for r in results]) / count
+    prec5 = 100. * sum([r[2] for r in results]) / count
+    last_eval.update(images=count, early_stop=False)
+    print(' * Prec@1 {top1:.3f} Prec@5 {top5:.3f}'.format(top1=prec1, top5=prec5))
+    return loss, prec1, prec5
+
+
+def validate(val_loader, model, criterion, model_fp32=None):
     batch_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
@@ -277,15 +468,31 @@ def validate(val_loader, model, criterion):
     # switch to evaluate mode
     model.eval()
 
+    early_stop = None
+    reason = None
+    if args.early_stop and args.stats_mode != 'collect':
+        early_stop = EarlyStop(args.es_width, args.es_confidence, args.es_reference, args.es_min_samples)
+        correct1 = BinomialMeter()
+        agreement = BinomialMeter() if model_fp32 is not None else None
+        if model_fp32 is not None:
+            model_fp32.eval()
+        # Stopping decision must be the same on all ranks, checked only in rounds where every rank has a batch
+        num_batches = int(math.ceil(len(val_loader.dataset) / args.batch_size))
+        if args.subset is not None:
+            num_batches = min(num_batches, int(math.ceil(args.subset / args.batch_size)))
+        es_rounds = num_batches // get_world_size()
+
     if args.dump_dir is not None:
         QM().disable()
-        DM(args.dump_dir)
+        DM(args.dump_dir, async_mode=args.dump_async, compress=args.dump_compress, max_queue_mb=args.dump_queue_mb)
 
     with torch.no_grad():
         end = time.time()
         for i, (input, target) in enumerate(val_loader):
-            if (args.stats_mode == 'collect' and i*args.batch_size >= args.cal_set_size and (args.kld_threshold or args.aciq_cal)) or \
-                (args.subset is not None and i*args.batch_size >= args.subset):
+            # Index of the batch in single process order
+            bi = i * get_world_size() + get_rank()
+            if (args.stats_mode == 'collect' and bi*args.batch_size >= args.cal_set_size and (args.kld_threshold or args.aciq_cal)) or \
+                (args.subset is not None and bi*args.batch_size >= args.subset):
                 break
             # Uncomment to enable dump
             # QM().disable()
@@ -315,6 +522,29 @@ def validate(val_loader, model, criterion):
             top1.update(float(prec1), input.size(0))
             top5.update(float(prec5), input.size(0))
 
+            if early_stop is not None and i < es_rounds:
+                pred = output.argmax(1)
+                counts = [(pred == target).sum().item(), input.size(0)]
+                if agreement is not None:
+                    quantize = QM().enabled
+                    QM().disable()
+                    counts += [(pred == model_fp32(input).argmax(1)).sum().item(), input.size(0)]
+                    if quantize:
+                        QM().enable()
+                counts = all_reduce_sum(counts)
+                correct1.update(*counts[:2])
+                if agreement is not None:
+                    agreement.update(*counts[2:])
+                reason = early_stop.check(correct1, agreement)
+                if reason is not None:
+                    if is_main_process():
+                        lo, hi = correct1.interval(args.es_confidence)
+                        print(' * Early stop ({}) after {} images: Prec@1 {:.3f} [{:.3f}, {:.3f}]{}'.format(
+                              reason, int(correct1.count), correct1.avg, lo, hi, '' if agreement is None else
+                              ' fp32 agreement {:.3f} [{:.3f}, {:.3f}]'.format(
+                                  agreement.avg, *agreement.interval(args.es_confidence))))
+                    break
+
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
@@ -328,8 +558,11 @@ def validate(val_loader, model, criterion):
                        i, len(val_loader), batch_time=batch_time, loss=losses,
                        top1=top1, top5=top5))
 
-        print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
-              .format(top1=top1, top5=top5))
+        all_reduce_meters(losses, top1, top5)
+        last_eval.update(images=int(losses.count), early_stop=reason is not None)
+        if is_main_process():
+            print(' * Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
+                  .format(top1=top1, top5=top5))
 
     return losses.avg, top1.avg, top5.avg
 
@@ -348,17 +581,35 @@ def get_params():
             'bit_alloc_prior': args.bit_alloc_prior,
             'bcorr_act': args.bias_corr_act,
             'bcorr_weight': args.bias_corr_weight,
-            'vcorr_weight': args.var_corr_weight
+            'vcorr_weight': args.var_corr_weight,
+            'stochastic': args.stochastic,
+            'seed': args.seed
         },
         'qmanager':{
             'rho_act': args.rho_act,
             'rho_weight': args.rho_weight
         }
-    }  # TODO: add params for bfloat
+    }
+    float_params = {
+        'scaling': args.fp_scaling,
+        'stats_kind': args.stats_kind
+    }
+    for qtype_name in ['bfloat', 'half', 'fp']:
+        qparams[qtype_name] = float_params
     return qparams
 
 if __name__ == '__main__':
-    if args.stats_mode != 'collect':
+    if args.results_db is not None and args.results_db_skip:
+        from utils.results_db import ResultsDB
+        prev = ResultsDB(os.path.expanduser(args.results_db)).find(args)
+        if prev is not None:
+            print("Result of the same config exists, skipping: Prec@1 %.3f Prec@5 %.3f" % (prev['top1'], prev['top5']))
+            sys.exit(0)
+    if args.distributed:
+        init_distributed('gloo')
+    if args.mlflow and args.stats_mode != 'collect' and is_main_process():
+        import mlflow
+        mlflow.set_tracking_uri(os.path.join(home, 'mlruns_mxt'))
         mlflow.set_experiment(args.arch if args.mlf_experiment is None else args.mlf_experiment)
         with mlflow.start_run(run_name="{}_W{}_A{}".format(args.arch, args.qweight, args.qtype)):
             params = vars(args)
@@ -366,8 +617,14 @@ if __name__ == '__main__':
                 mlflow.log_param(p, params[p])
             with QM(args, get_params()):
                 im = InferenceModel()
-                im.run()
+                res = im.run()
     else:
         with QM(args, get_params()):
             im = InferenceModel()
-            im.run()
+            res = im.run()
+
+    if args.results_json is not None and res is not None and is_main_process():
+        with open(args.results_json, 'w') as f:
+            result = dict(zip(['loss', 'top1', 'top5'], [float(r) for r in res]))
+            result.update(last_eval)
+            json.dump(result, f)
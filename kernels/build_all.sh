@@ -6,4 +6,9 @@ echo "**************************************************************"
 python build_int_quantization.py install
 echo "Done"
 echo "**************************************************************"
+echo "Building float quantization kernels"
+echo "**************************************************************"
+python build_float_quantization.py install
+echo "Done"
+echo "**************************************************************"
 
@@ -0,0 +1,13 @@
+from setuptools import setup
+from torch.utils.cpp_extension import CppExtension, BuildExtension
+
+
+
+setup(name='float_quantization',
+      ext_modules=[CppExtension('float_quantization', ['float_quantization.cpp'],
+                                extra_compile_args=['-O3', '-fopenmp'],
+                                extra_link_args=['-fopenmp'])],
+      cmdclass={'build_ext': BuildExtension})
+
+# for installation execute:
+# > python build_float_quantization.py install
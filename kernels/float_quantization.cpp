@@ -0,0 +1,49 @@
+#include <torch/extension.h>
+#include <ATen/Parallel.h>
+
+#include <cmath>
+#include <algorithm>
+
+
+// Round float 32 to nearest value of float format with exp_bits exponent and man_bits mantissa (round to nearest even).
+// Values below normal range are rounded as subnormals, values above max_value are saturated.
+// out may be the input itself (in-place).
+at::Tensor float2float_out(at::Tensor in, at::Tensor out, int exp_bits, int man_bits, float max_value) {
+    auto x = in.contiguous();
+    const float* src = x.data_ptr<float>();
+    float* dst = out.data_ptr<float>();
+    const int min_exp = 2 - (1 << (exp_bits - 1));
+
+    at::parallel_for(0, x.numel(), 2048, [&](int64_t begin, int64_t end) {
+        for (int64_t i = begin; i < end; i++) {
+            float v = src[i];
+            if (v == 0 || std::isnan(v)) {
+                dst[i] = v;
+                continue;
+            }
+            if (std::isinf(v)) {
+                dst[i] = v > 0 ? max_value : -max_value;
+                continue;
+            }
+            int e;
+            std::frexp(v, &e);
+            e = std::max(e - 1, min_exp);
+            float step = std::ldexp(1.0f, e - man_bits);
+            float q = std::nearbyint(v / step) * step;
+            dst[i] = std::min(std::max(q, -max_value), max_value);
+        }
+    });
+
+    return out;
+}
+
+at::Tensor float2float(at::Tensor in, int exp_bits, int man_bits, float max_value) {
+    auto x = in.contiguous();
+    return float2float_out(x, at::empty_like(x), exp_bits, man_bits, max_value);
+}
+
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("float2float", &float2float, "Truncate float 32 to low precision float format on cpu");
+    m.def("float2float_out", &float2float_out, "Truncate float 32 to low precision float format on cpu into out tensor");
+}
@@ -2,45 +2,148 @@
 
 #include <cuda.h>
 #include <cuda_runtime.h>
+#include <curand_kernel.h>
 
 #include <vector>
 
-__global__ void GEMMLowpKernel(const float* in, const int N, float* out,
-                               float scale, float shift, long long qmax, const float* noise, bool enforce_true_zero) {
+// Stochastic rounding noise is generated in-kernel with counter based Philox generator.
+// Each thread draws from its own subsequence starting at offset, no noise tensor is allocated.
+struct RoundingNoise {
+  bool stochastic;
+  curandStatePhilox4_32_10_t state;
+
+  __device__ __forceinline__ RoundingNoise(bool stochastic, unsigned long long seed, unsigned long long offset)
+      : stochastic(stochastic) {
+    if (stochastic)
+      curand_init(seed, blockIdx.x * blockDim.x + threadIdx.x, offset, &state);
+  }
+
+  __device__ __forceinline__ float next() {
+    return stochastic ? curand_uniform(&state) - 0.5f : 0.f;
+  }
+};
+
+__device__ __forceinline__ float gemmlowp(float x, float scale, float shift, long long qmax, float noise,
+                                          bool enforce_true_zero) {
+  if (enforce_true_zero)
+    x = (x / scale) + shift;
+  else
+    x = (x + shift) / scale;
+  x += noise;
+  x = fminf(x, qmax);
+  x = fmaxf(x, 0.);
+  x = roundf(x);
+  if (enforce_true_zero)
+    x = (x - shift) * scale;
+  else
+    x = x * scale - shift;
+  return x;
+}
+
+__global__ void GEMMLowpKernel(const float* in, const int N, float* out, float scale, float shift, long long qmax,
+                               bool enforce_true_zero, bool stochastic, unsigned long long seed,
+                               unsigned long long offset) {
+  RoundingNoise noise(stochastic, seed, offset);
+  for (int i = blockIdx.x * blockDim.x + threadIdx.x; i < N; i += blockDim.x * gridDim.x) {
+      out[i] = gemmlowp(in[i], scale, shift, qmax, noise.next(), enforce_true_zero);
+  }
+}
+
+// Range and offset are read from device memory, so dynamic quantization does not synchronize with host
+__global__ void GEMMLowpDynamicKernel(const float* in, const int N, float* out, const float* range,
+                                      const float* offset, long long qmax, bool int_exp, bool enforce_true_zero,
+                                      bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+  const float r = *range;
+  const float o = *offset;
+  float scale = r / qmax;
+  if (int_exp)
+    scale = powf(2, int(ceilf(log2f(scale))));
+  // if enforce_true_zero and zero in range
+  const bool preserve_zero = enforce_true_zero && (o + r) > 0 && o < 0;
+  const float shift = preserve_zero ? roundf(-o / scale) : -o;
+  RoundingNoise noise(stochastic, seed, rng_offset);
   for (int i = blockIdx.x * blockDim.x + threadIdx.x; i < N; i += blockDim.x * gridDim.x) {
-      out[i] = in[i];
-      if (enforce_true_zero)
-        out[i] = (out[i] / scale) + shift;
-      else
-        out[i] = (out[i] + shift) / scale;
-      out[i] += noise[i];
-      out[i] = fminf(out[i], qmax);
-      out[i] = fmaxf(out[i], 0.);
-      out[i] = roundf(out[i]);
-      if (enforce_true_zero)
-        out[i] = (out[i] - shift) * scale;
-      else
-        out[i] = out[i] * scale - shift;
+      out[i] = r <= 0 ? in[i] : gemmlowp(in[i], scale, shift, qmax, noise.next(), preserve_zero);
+  }
+}
+
+__global__ void SymLowpKernel(const float* in, const int N, float* out, const float* maxabs, long long qmax,
+                              bool int_exp, bool stochastic, unsigned long long seed, unsigned long long offset) {
+  const float m = *maxabs;
+  float scale = m / qmax;
+  if (int_exp)
+    scale = powf(2, int(ceilf(log2f(scale))));
+  RoundingNoise noise(stochastic, seed, offset);
+  for (int i = blockIdx.x * blockDim.x + threadIdx.x; i < N; i += blockDim.x * gridDim.x) {
+      if (m <= 0) {
+        out[i] = in[i];
+        continue;
+      }
+      float x = in[i] / scale + noise.next();
+      x = fminf(x, qmax);
+      x = fmaxf(x, -qmax);
+      out[i] = roundf(x) * scale;
   }
 }
 
 #define block_count 32
 #define thread_per_block 1024
 // Wrapper for ATen
-at::Tensor float2gemmlowp(at::Tensor in, float range, float offset, int num_bits, bool int_exp, bool enforce_true_zero, at::Tensor noise) {
-    if (range <= 0)
-        return in;
+// _out variants write to preallocated out tensor, out may be the input itself (in-place)
+at::Tensor float2gemmlowp_out(at::Tensor in, at::Tensor out, float range, float offset, int num_bits, bool int_exp, bool enforce_true_zero,
+                              bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    if (range <= 0) {
+        if (!out.is_same(in))
+            out.copy_(in);
+        return out;
+    }
 
     int N = in.numel();
-    auto out = at::zeros_like(in);
     long long qmax = (0x1l << num_bits) - 1;
     float scale = range / qmax;
     if (int_exp)
         scale = powf(2, int(ceilf(log2f(scale))));
     float zero_point = roundf(-offset / scale);
     float shift = enforce_true_zero ? zero_point : -offset;
-    GEMMLowpKernel<<<block_count, thread_per_block>>>(in.data<float>(), N, out.data<float>(), scale, shift, qmax, noise.data<float>(), enforce_true_zero);
+    GEMMLowpKernel<<<block_count, thread_per_block>>>(in.data<float>(), N, out.data<float>(), scale, shift, qmax, enforce_true_zero, stochastic, seed, rng_offset);
 
     return out;
 }
 
+at::Tensor float2gemmlowp(at::Tensor in, float range, float offset, int num_bits, bool int_exp, bool enforce_true_zero,
+                          bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    if (range <= 0)
+        return in;
+    return float2gemmlowp_out(in, at::empty_like(in), range, offset, num_bits, int_exp, enforce_true_zero, stochastic, seed, rng_offset);
+}
+
+at::Tensor float2gemmlowp_dynamic_out(at::Tensor in, at::Tensor out, at::Tensor range, at::Tensor offset, int num_bits, bool int_exp, bool enforce_true_zero,
+                                      bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    int N = in.numel();
+    long long qmax = (0x1l << num_bits) - 1;
+    auto range_ = range.to(in.options()).contiguous();
+    auto offset_ = offset.to(in.options()).contiguous();
+    GEMMLowpDynamicKernel<<<block_count, thread_per_block>>>(in.data<float>(), N, out.data<float>(), range_.data<float>(), offset_.data<float>(), qmax, int_exp, enforce_true_zero, stochastic, seed, rng_offset);
+
+    return out;
+}
+
+at::Tensor float2gemmlowp_dynamic(at::Tensor in, at::Tensor range, at::Tensor offset, int num_bits, bool int_exp, bool enforce_true_zero,
+                                  bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    return float2gemmlowp_dynamic_out(in, at::empty_like(in), range, offset, num_bits, int_exp, enforce_true_zero, stochastic, seed, rng_offset);
+}
+
+at::Tensor float2symlowp_out(at::Tensor in, at::Tensor out, at::Tensor maxabs, int num_bits, bool int_exp,
+                             bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    int N = in.numel();
+    long long qmax = (0x1l << (num_bits - 1)) - 1;
+    auto maxabs_ = maxabs.to(in.options()).contiguous();
+    SymLowpKernel<<<block_count, thread_per_block>>>(in.data<float>(), N, out.data<float>(), maxabs_.data<float>(), qmax, int_exp, stochastic, seed, rng_offset);
+
+    return out;
+}
+
+at::Tensor float2symlowp(at::Tensor in, at::Tensor maxabs, int num_bits, bool int_exp,
+                         bool stochastic, unsigned long long seed, unsigned long long rng_offset) {
+    return float2symlowp_out(in, at::empty_like(in), maxabs, num_bits, int_exp, stochastic, seed, rng_offset);
+}
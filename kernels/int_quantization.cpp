@@ -4,9 +4,28 @@
 
 // CUDA declarations
 at::Tensor float2gemmlowp(at::Tensor in, float range, float offset, int num_bits, bool int_exp,
-                          bool enforce_true_zero, at::Tensor noise);
+                          bool enforce_true_zero, bool stochastic, unsigned long long seed,
+                          unsigned long long rng_offset);
+at::Tensor float2gemmlowp_dynamic(at::Tensor in, at::Tensor range, at::Tensor offset, int num_bits, bool int_exp,
+                                  bool enforce_true_zero, bool stochastic, unsigned long long seed,
+                                  unsigned long long rng_offset);
+at::Tensor float2symlowp(at::Tensor in, at::Tensor maxabs, int num_bits, bool int_exp,
+                         bool stochastic, unsigned long long seed, unsigned long long rng_offset);
+at::Tensor float2gemmlowp_out(at::Tensor in, at::Tensor out, float range, float offset, int num_bits, bool int_exp,
+                              bool enforce_true_zero, bool stochastic, unsigned long long seed,
+                              unsigned long long rng_offset);
+at::Tensor float2gemmlowp_dynamic_out(at::Tensor in, at::Tensor out, at::Tensor range, at::Tensor offset, int num_bits,
+                                      bool int_exp, bool enforce_true_zero, bool stochastic, unsigned long long seed,
+                                      unsigned long long rng_offset);
+at::Tensor float2symlowp_out(at::Tensor in, at::Tensor out, at::Tensor maxabs, int num_bits, bool int_exp,
+                             bool stochastic, unsigned long long seed, unsigned long long rng_offset);
 
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("float2gemmlowp", &float2gemmlowp, "Convert float 32 to gemmlowp");
+    m.def("float2gemmlowp_dynamic", &float2gemmlowp_dynamic, "Convert float 32 to gemmlowp, range and offset on device");
+    m.def("float2symlowp", &float2symlowp, "Convert float 32 to symmetric lowp, max abs on device");
+    m.def("float2gemmlowp_out", &float2gemmlowp_out, "Convert float 32 to gemmlowp into out tensor");
+    m.def("float2gemmlowp_dynamic_out", &float2gemmlowp_dynamic_out, "Convert float 32 to gemmlowp into out tensor, range and offset on device");
+    m.def("float2symlowp_out", &float2symlowp_out, "Convert float 32 to symmetric lowp into out tensor, max abs on device");
 }
@@ -0,0 +1,110 @@
+import torch
+import numpy as np
+import math
+
+
+MAX_BITS = 32
+
+
+def mse_laplace(b, alpha, num_bits):
+    return 2 * (b ** 2) * np.exp(-alpha / b) + ((alpha ** 2) / (3 * 2 ** (2 * num_bits)))
+
+
+def mse_exponential(mean_abs, alpha, num_bits):
+    return 2 * (mean_abs ** 2) * np.exp(-alpha / mean_abs) + ((alpha ** 2) / (3 * 2 ** (2 * num_bits)))
+
+
+def mse_gaus(sigma, alpha, num_bits):
+    clipping_err = (sigma ** 2 + (alpha ** 2)) * (1 - math.erf(alpha / (sigma * np.sqrt(2.0)))) - \
+                   np.sqrt(2.0 / np.pi) * alpha * sigma * (np.e ** ((-1) * (0.5 * (alpha ** 2)) / sigma ** 2))
+    quant_err = (alpha ** 2) / (3 * (2 ** (2 * num_bits)))
+    return clipping_err + quant_err
+
+
+mse_functions = {'laplace': mse_laplace, 'gaus': mse_gaus, 'exp': mse_exponential}
+
+# Published coefficients, kept as is so results of existing experiments are reproduced exactly
+known_alpha = {
+    'gaus': {1: 1.24, 2: 1.71, 3: 2.15, 4: 2.55, 5: 2.93, 6: 3.28, 7: 3.61, 8: 3.92},
+    'laplace': {0: 1.05, 1: 1.86, 2: 2.83, 3: 3.89, 4: 5.03, 5: 6.2, 6: 7.41, 7: 8.64, 8: 9.89},
+}
+known_alpha_positive = {
+    'gaus': {1: 1.71, 2: 2.15, 3: 2.55, 4: 2.93, 5: 3.28, 6: 3.61, 7: 3.92, 8: 4.2},
+    'laplace': {0: 1.86, 1: 2.83, 2: 3.89, 3: 5.02, 4: 6.2, 5: 7.41, 6: 8.64, 7: 9.89, 8: 11.16},
+}
+
+
+def optimal_alpha(prior, num_bits):
+    """Clipping value minimizing the analytical mse of a unit scale prior quantized to num_bits"""
+    from scipy.optimize import minimize_scalar
+    mse = mse_functions[prior]
+    res = minimize_scalar(lambda a: mse(1., a, num_bits), bounds=(1e-3, 4. * num_bits + 10.), method='bounded',
+                          options={'xatol': 1e-6})
+    return res.x
+
+
+class AlphaTable:
+    """
+    Optimal clipping coefficient per bit width, alpha = table[num_bits] * scale.
+    Indexing with int returns python float, gather with tensor of bit widths returns tensor on the same device
+    without host synchronization.
+    Alpha may be given as a function, it is evaluated on first use.
+    """
+    def __init__(self, alpha):
+        self.__alpha = alpha if callable(alpha) else np.array(alpha, dtype=np.float64)
+        self.__tensors = {}
+
+    @property
+    def alpha(self):
+        if callable(self.__alpha):
+            self.__alpha = np.array(self.__alpha(), dtype=np.float64)
+        return self.__alpha
+
+    def __getitem__(self, num_bits):
+        return float(self.alpha[int(num_bits)])
+
+    def __len__(self):
+        return len(self.alpha)
+
+    def tensor(self, device, dtype=None):
+        # Table is kept in float64 on host, cast only on device copies
+        key = (torch.device(device), dtype or torch.get_default_dtype())
+        if key not in self.__tensors:
+            self.__tensors[key] = torch.tensor(self.alpha, dtype=key[1], device=key[0])
+        return self.__tensors[key]
+
+    def gather(self, bit_alloc, dtype=None):
+        if dtype is None and bit_alloc.is_floating_point():
+            dtype = bit_alloc.dtype
+        table = self.tensor(bit_alloc.device, dtype)
+        return table[bit_alloc.long().clamp(0, len(self.alpha) - 1)]
+
+
+__tables = {}
+__solved = {}
+
+
+def __solve(prior, max_bits):
+    key = (prior, max_bits)
+    if key not in __solved:
+        alpha = np.array([optimal_alpha(prior, n) for n in range(max_bits + 2)])
+        for n, a in known_alpha.get(prior, {}).items():
+            alpha[n] = a
+        alpha_positive = alpha[1:].copy()
+        for n, a in known_alpha_positive.get(prior, {}).items():
+            alpha_positive[n] = a
+        __solved[key] = (alpha[:-1], alpha_positive)
+    return __solved[key]
+
+
+def aciq_tables(prior, max_bits=MAX_BITS):
+    """
+    Returns (alpha, alpha_positive) tables of prior for bit widths [0, max_bits].
+    Positive tensors (half range) are quantized with one extra bit of resolution.
+    Tables are solved on first use, so runs without clipping do not pay for it.
+    """
+    key = (prior, max_bits)
+    if key not in __tables:
+        __tables[key] = (AlphaTable(lambda: __solve(prior, max_bits)[0]),
+                         AlphaTable(lambda: __solve(prior, max_bits)[1]))
+    return __tables[key]
@@ -0,0 +1,153 @@
+import torch
+import math
+from collections.abc import Mapping
+
+
+FORMAT_VERSION = 1
+FOLDED_BN_BUFFERS = ['running_mean', 'running_var', 'num_batches_tracked']
+
+
+def pack_bits(indices, bits):
+    # Pack integer indices in [0, 2^bits) into uint8 array, bits per index
+    n = indices.numel()
+    shifts = torch.arange(bits, dtype=torch.long)
+    b = (indices.flatten().long().unsqueeze(-1) >> shifts) & 1  # n x bits, lsb first
+    b = b.flatten()
+    pad = (-b.numel()) % 8
+    if pad > 0:
+        b = torch.cat([b, b.new_zeros(pad)])
+    weights = 1 << torch.arange(8, dtype=torch.long)
+    packed = (b.view(-1, 8) * weights).sum(-1).to(torch.uint8)
+    return packed, n
+
+
+def unpack_bits(packed, bits, n):
+    weights = 1 << torch.arange(8, dtype=torch.long, device=packed.device)
+    b = (packed.long().unsqueeze(-1) & weights).ne(0).flatten()[:n * bits].view(n, bits).long()
+    shifts = torch.arange(bits, dtype=torch.long, device=packed.device)
+    return (b << shifts).sum(-1)
+
+
+def row_codebooks(t2d):
+    """
+    Codebook of unique values per row of 2D tensor without loop over rows.
+    Returns codebooks [R, K] (rows with less than K values padded with 0), indices [R, N] and K.
+    """
+    s, order = torch.sort(t2d, dim=1)
+    new_value = torch.ones_like(s, dtype=torch.long)
+    new_value[:, 1:] = (s[:, 1:] != s[:, :-1]).long()
+    new_value[:, 0] = 0
+    rank = torch.cumsum(new_value, dim=1)
+    k = int(rank[:, -1].max().item()) + 1
+    codebooks = t2d.new_zeros(t2d.shape[0], k).scatter_(1, rank, s)
+    indices = torch.empty_like(rank).scatter_(1, order, rank)
+    return codebooks, indices, k
+
+
+def encode_tensor(t, max_bits=8):
+    """
+    Encode tensor with few distinct values as codebook + packed indices.
+    Per layer codebook is tried first, then per output channel codebook (e.g. weights after per channel
+    bias correction). Tensors that need more than 2^max_bits values, or whose encoding is not smaller than
+    the raw tensor (e.g. small biases, unclustered layers), are kept as is.
+    """
+    raw_nbytes = t.numel() * t.element_size()
+    t = t.detach().cpu().float()
+    if t.numel() == 0:
+        return t
+    for per_channel in [False, True]:
+        if per_channel and t.dim() < 2:
+            break
+        t2d = t.view(t.shape[0], -1) if per_channel else t.view(1, -1)
+        codebooks, indices, k = row_codebooks(t2d)
+        bits = max(1, int(math.ceil(math.log2(k))))
+        if bits <= max_bits:
+            packed, n = pack_bits(indices, bits)
+            e = {'codebook': codebooks if per_channel else codebooks[0], 'indices': packed, 'bits': bits,
+                 'numel': n, 'shape': list(t.shape), 'per_channel': per_channel}
+            if encoded_nbytes(e) < raw_nbytes:
+                return e
+    return t
+
+
+def decode_tensor(e, device=None):
+    if isinstance(e, torch.Tensor):
+        return e.to(device) if device is not None else e
+    codebook = e['codebook'].to(device) if device is not None else e['codebook']
+    indices = unpack_bits(e['indices'].to(codebook.device), e['bits'], e['numel'])
+    if e['per_channel']:
+        # Gather from per channel codebooks
+        indices = indices.view(codebook.shape[0], -1)
+        return torch.gather(codebook, 1, indices).view(e['shape'])
+    else:
+        return codebook[indices].view(e['shape'])
+
+
+def encoded_nbytes(e):
+    if isinstance(e, torch.Tensor):
+        return e.numel() * e.element_size()
+    return e['codebook'].numel() * e['codebook'].element_size() + e['indices'].numel()
+
+
+class CodebookStateDict(Mapping):
+    """State dict view over encoded tensors, each tensor is decoded on access"""
+    def __init__(self, tensors, device=None):
+        self.tensors = tensors
+        self.device = device
+
+    def __getitem__(self, key):
+        return decode_tensor(self.tensors[key], self.device)
+
+    def __iter__(self):
+        return iter(self.tensors)
+
+    def __len__(self):
+        return len(self.tensors)
+
+
+def save_codebook_model(model, path, arch=None, max_bits=8):
+    tensors = {}
+    for name, t in model.state_dict().items():
+        tensors[name] = encode_tensor(t, max_bits) if t.is_floating_point() else t.cpu()
+    full = sum([t.numel() * t.element_size() for t in model.state_dict().values()])
+    compressed = sum([encoded_nbytes(e) for e in tensors.values()])
+    torch.save({'format': 'codebook', 'version': FORMAT_VERSION, 'arch': arch, 'tensors': tensors}, path)
+    print("Codebook model %.1f MB (full precision %.1f MB, x%.1f)" % (compressed / 2**20, full / 2**20,
+                                                                     full / max(compressed, 1)))
+
+
+def load_codebook_archive(path):
+    archive = torch.load(path, map_location='cpu')
+    if not isinstance(archive, dict) or archive.get('format') != 'codebook':
+        raise ValueError('%s is not a codebook model' % path)
+    return archive
+
+
+def load_codebook_state(model, archive):
+    """Load codebook model into model with the same (bn folded) structure, one tensor decoded at a time"""
+    if isinstance(archive, str):
+        archive = load_codebook_archive(archive)
+    state = CodebookStateDict(archive['tensors'])
+    own_state = model.state_dict()
+    missing = [k for k in own_state if k not in state]
+    # Archives of older bn folding keep buffers of folded bn modules, which are removed now
+    modules = dict(model.named_modules())
+    unexpected = [k for k in state if k not in own_state and
+                  not (k.rpartition('.')[2] in FOLDED_BN_BUFFERS and k.rpartition('.')[0] not in modules)]
+    if len(missing) > 0 or len(unexpected) > 0:
+        raise KeyError('Codebook model does not match, missing keys: %s, unexpected keys: %s' % (missing, unexpected))
+    with torch.no_grad():
+        for name, t in own_state.items():
+            t.copy_(state[name])
+    return archive['arch']
+
+
+def load_codebook_model(path):
+    """Create model of the saved arch, fold bn like kmeans_quantization does and load codebook weights"""
+    import torchvision.models as models
+    from utils.absorb_bn import search_absorbe_bn
+    archive = load_codebook_archive(path)
+    model = models.__dict__[archive['arch']](pretrained=False)
+    search_absorbe_bn(model)
+    load_codebook_state(model, archive)
+    return model
@@ -1,13 +1,11 @@
 from utils.misc import Singleton
 import numpy as np
-import pandas as pd
 import os
 import shutil
 from utils.misc import sorted_nicely, cos_sim
 import torch
 from pathlib import Path
 import pickle
-from tqdm import tqdm
 
 
 home = str(Path.home())
@@ -27,6 +25,7 @@ class MeasureStatistics(metaclass=Singleton):
         self.targets = []
 
     def save_measure(self, tensor, id):
+        from tqdm import tqdm
         # Assume dimensions of [N,C,H,W]
         t = tensor.view(tensor.shape[0], -1)
         ang_matrix = np.zeros(shape=(t.shape[0], t.shape[0]))
@@ -53,6 +52,7 @@ class MeasureStatistics(metaclass=Singleton):
         return self
 
     def __exit__(self, *args):
+        import pandas as pd
         if self.enabled and len(self.stats) > 0:
             self.enabled = False
             # Save measures
@@ -0,0 +1,169 @@
+import numpy as np
+import json
+import os
+import torch
+from pytorch_quantizer.clipping import aciq
+
+
+def _optimal_clipping_mse(prior, scale, num_bits):
+    # Analytical clipping + quantization noise at optimal alpha
+    alpha = aciq.aciq_tables(prior)[0][num_bits] * scale
+    return aciq.mse_functions[prior](scale, alpha, num_bits)
+
+
+def _uniform_mse(range_, num_bits):
+    # Rounding noise of uniform quantizer without clipping
+    return (range_ / (2. ** num_bits - 1)) ** 2 / 12.
+
+
+class LayerPrecision:
+    def __init__(self, name, module, act_stats, weight_only, fixed):
+        self.name = name
+        self.module = module
+        self.act_stats = act_stats
+        self.weight_only = weight_only
+        self.fixed = fixed
+        self.half_range = hasattr(module, 'before_relu')
+        self.weight_numel = module.weight.numel()
+
+    def macs(self):
+        if isinstance(self.module, torch.nn.Conv2d):
+            if self.act_stats is None:
+                return 0
+            return self.act_stats['sample_dim'] * self.module.weight[0].numel()
+        else:
+            return self.weight_numel
+
+    def act_mse(self, num_bits, clipping):
+        # Half range activations (before relu) gain one bit of resolution
+        bits = num_bits + 1 if self.half_range else num_bits
+        if clipping == 'laplace':
+            return _optimal_clipping_mse('laplace', self.act_stats['b'], bits)
+        elif clipping == 'gaus':
+            return _optimal_clipping_mse('gaus', self.act_stats['std'], bits)
+        else:
+            min_ = 0 if self.half_range else self.act_stats['min']
+            return _uniform_mse(self.act_stats['max'] - min_, num_bits)
+
+    def weight_mse(self, num_bits, per_channel):
+        w = self.module.weight.detach()
+        w = w.view(w.shape[0], -1) if per_channel else w.view(1, -1)
+        range_ = (w.max(-1)[0] - w.min(-1)[0]).cpu().numpy()
+        return np.mean(_uniform_mse(range_, num_bits))
+
+    # Signal power of the tensors, mse relative to it (inverse SQNR) is comparable between weights and activations
+    def act_var(self):
+        return max(self.act_stats['std'] ** 2, 1e-12)
+
+    def weight_var(self):
+        return max(float(self.module.weight.detach().var()), 1e-12)
+
+
+def collect_layers(model, stats_df, ignore_ids=[], batch_size=1):
+    layers = []
+    for n, m in model.named_modules():
+        if not hasattr(m, 'id') or not (isinstance(m, torch.nn.Conv2d) or isinstance(m, torch.nn.Linear)):
+            continue
+        name = ('conv%d_activation' if isinstance(m, torch.nn.Conv2d) else 'linear%d_activation') % m.id
+        act_stats = None
+        if name in stats_df.index:
+            act_stats = {s: float(stats_df.loc[name, 'mean_%s' % s]) for s in ['b', 'std', 'min', 'max']}
+            # Statistics collected before per sample size was recorded hold only size of a batch
+            if 'sample_dim' in stats_df.columns:
+                act_stats['sample_dim'] = float(stats_df.loc[name, 'sample_dim'])
+            else:
+                act_stats['sample_dim'] = float(stats_df.loc[name, 'dim']) / batch_size
+        # First layer and classifier stay in 8 bit
+        fixed = m.weight.shape[0] == 1000 or (isinstance(m, torch.nn.Conv2d) and m.weight.shape[1] == 3)
+        layers.append(LayerPrecision(name, m, act_stats, weight_only=(act_stats is None or name in ignore_ids),
+                                     fixed=fixed))
+    return layers
+
+
+def search_bit_widths(model, stats_df, budget, target='size', clipping='laplace', per_channel_weights=False,
+                      batch_size=1, bits=(2, 8), default_act_bits=8, ignore_ids=[]):
+    """
+    Greedy data free mixed precision search.
+    Starting from max bits repeatedly lowers precision of the activation or weight with minimal increase of
+    predicted relative mse (mse / variance of the tensor) per saved cost until the budget is met.
+    target 'size' - budget of model weights in MB, only weights are searched.
+    target 'bops' - budget of GBOPs per image, activations and weights are searched. Activation bits of a layer are
+    charged together with its weights since each layer quantizes its output.
+    batch_size is used only for statistics without per sample size, it has to be the batch size of their collection.
+    Returns precision map {activation_id: {'weight': bits, 'act': bits}}.
+    """
+    if target not in ['size', 'bops']:
+        raise ValueError('Invalid bit search target %s, one of [size, bops]' % target)
+
+    layers = collect_layers(model, stats_df, ignore_ids, batch_size)
+    min_bits, max_bits = bits
+    options = range(min_bits, max_bits + 1)
+
+    # Precompute predicted noise of every decision, normalized by variance of the tensor
+    variables = []
+    for l in layers:
+        if l.fixed:
+            continue
+        wvar = l.weight_var()
+        variables.append((l, 'weight', {b: l.weight_mse(b, per_channel_weights) / wvar for b in options}))
+        if target == 'bops' and not l.weight_only:
+            avar = l.act_var()
+            variables.append((l, 'act', {b: l.act_mse(b, clipping) / avar for b in options}))
+    state = {(l.name, kind): max_bits for l, kind, _ in variables}
+
+    def layer_cost(l, wbits, abits):
+        if target == 'size':
+            return l.weight_numel * wbits / 8. / 2**20
+        else:
+            return l.macs() * wbits * abits / 1e9
+
+    def bits_of(l, kind):
+        # Layers kept in 8 bit and activations excluded from the search
+        if l.fixed or (kind == 'act' and l.weight_only):
+            return 8 if (l.fixed or l.name in ignore_ids) else default_act_bits
+        return state.get((l.name, kind), default_act_bits)
+
+    def total_cost():
+        return sum([layer_cost(l, bits_of(l, 'weight'), bits_of(l, 'act')) for l in layers])
+
+    cost = total_cost()
+    while cost > budget:
+        best = None
+        for l, kind, mse in variables:
+            b = state[(l.name, kind)]
+            if b <= min_bits:
+                continue
+            wb, ab = bits_of(l, 'weight'), bits_of(l, 'act')
+            lowered = layer_cost(l, wb - 1, ab) if kind == 'weight' else layer_cost(l, wb, ab - 1)
+            saved = layer_cost(l, wb, ab) - lowered
+            if saved <= 0:
+                continue
+            score = (mse[b - 1] - mse[b]) / saved
+            if best is None or score < best[0]:
+                best = (score, l, kind, saved)
+        if best is None:
+            print("Bit search: budget %.3f can't be met, minimal cost %.3f" % (budget, cost))
+            break
+        _, l, kind, saved = best
+        state[(l.name, kind)] -= 1
+        cost -= saved
+
+    precision_map = {}
+    for l, kind, mse in variables:
+        precision_map.setdefault(l.name, {})[kind] = state[(l.name, kind)]
+    predicted = sum([mse[state[(l.name, kind)]] for l, kind, mse in variables])
+    print("Bit search: %s cost %.3f (budget %.3f), predicted relative mse %.6f" % (target, total_cost(), budget, predicted))
+    return precision_map
+
+
+def save_precision_map(precision_map, path):
+    dir_name = os.path.dirname(path)
+    if dir_name != '' and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(path, 'w') as f:
+        json.dump(precision_map, f, indent=4, sort_keys=True)
+
+
+def load_precision_map(path):
+    with open(path, 'r') as f:
+        return json.load(f)
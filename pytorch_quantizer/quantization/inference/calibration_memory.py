@@ -0,0 +1,232 @@
+import numpy as np
+import os
+import shutil
+import torch
+from utils.misc import sorted_nicely
+from utils.distributed import gather_object, get_rank, get_world_size, is_distributed, is_main_process
+
+
+def layer_buffers(b):
+    # Layer stats are kept either in a single buffer or in a dictionary of buffers per statistic
+    return list(b.values()) if isinstance(b, dict) else [b]
+
+
+class StreamingSummary:
+    """Running min/mean/max of statistic rows. NaN entries are skipped like pandas does."""
+    def __init__(self, rows):
+        self.first = rows[0].copy()
+        self.min = np.full(rows.shape[1:], np.nan)
+        self.max = np.full(rows.shape[1:], np.nan)
+        self.sum = np.zeros(rows.shape[1:])
+        self.count = np.zeros(rows.shape[1:])
+        self.update(rows)
+
+    def update(self, rows):
+        self.min = np.fmin(self.min, np.fmin.reduce(rows, axis=0))
+        self.max = np.fmax(self.max, np.fmax.reduce(rows, axis=0))
+        self.sum += np.nansum(rows, axis=0)
+        self.count += (~np.isnan(rows)).sum(axis=0)
+
+    def merge(self, other):
+        # Summary of union of rows, first row of self is kept
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self.sum = self.sum + other.sum
+        self.count = self.count + other.count
+
+    @property
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / np.maximum(self.count, 1), np.nan)
+
+    @property
+    def nbytes(self):
+        return self.first.nbytes + self.min.nbytes + self.max.nbytes + self.sum.nbytes + self.count.nbytes
+
+
+class StatsBuffer:
+    """
+    History of per batch statistic rows of a single layer.
+    Rows are kept in memory until the calibration budget is exceeded, then they are either spilled to disk
+    or replaced by a streaming summary.
+    """
+    def __init__(self, spill_path):
+        self.spill_path = spill_path
+        self.mode = 'memory'
+        self.rows = None
+        self.summary = None
+        self.row_shape = None
+        self.num_rows = 0
+
+    def append(self, row):
+        row = np.asarray(row, dtype=np.float64).reshape(1, -1)
+        self.row_shape = row.shape[1:]
+        self.num_rows += 1
+        if self.mode == 'stream':
+            self.summary.update(row)
+        elif self.mode == 'spill':
+            with open(self.spill_path, 'ab') as f:
+                row.tofile(f)
+        else:
+            self.rows = row if self.rows is None else np.concatenate([self.rows, row])
+
+    @property
+    def nbytes(self):
+        if self.mode == 'stream':
+            return self.summary.nbytes
+        elif self.mode == 'spill':
+            return 0
+        else:
+            return 0 if self.rows is None else self.rows.nbytes
+
+    def spill(self):
+        if self.mode != 'memory' or self.rows is None:
+            return
+        os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+        with open(self.spill_path, 'wb') as f:
+            self.rows.tofile(f)
+        self.rows = None
+        self.mode = 'spill'
+
+    def stream(self):
+        if self.mode != 'memory' or self.rows is None:
+            return
+        self.summary = StreamingSummary(self.rows)
+        self.rows = None
+        self.mode = 'stream'
+
+    def materialize(self):
+        # Full history or None if only streaming summary is available
+        if self.mode == 'stream':
+            return None
+        elif self.mode == 'spill':
+            return np.fromfile(self.spill_path, dtype=np.float64).reshape((-1,) + self.row_shape)
+        else:
+            return self.rows
+
+    def merge_distributed(self):
+        """
+        Merge buffers of all ranks into rank 0, must be called by all ranks (with empty buffer on ranks without
+        rows of the layer). Rank r holds rows of batches r, r + world, ... (see DistributedBatchSampler), one row
+        per batch, so full histories are interleaved back to single process order.
+        If any rank keeps only a streaming summary the merged buffer is a streaming summary.
+        """
+        if self.mode == 'stream':
+            local = ('stream', self.summary)
+        else:
+            local = ('rows', self.materialize())
+        parts = gather_object(local)
+        if not is_main_process():
+            return
+        parts = [(r, kind, data) for r, (kind, data) in enumerate(parts) if data is not None]
+        if len(parts) == 0:
+            return
+
+        if all([kind == 'rows' for _, kind, _ in parts]):
+            world = get_world_size()
+            counts = [0] * world
+            for r, _, rank_rows in parts:
+                counts[r] = len(rank_rows)
+            if counts != [len(range(r, sum(counts), world)) for r in range(world)]:
+                raise RuntimeError('Statistics rows per rank %s do not match round robin batches, expected one row '
+                                   'per layer per batch' % counts)
+            rows = np.empty((sum([len(data) for _, _, data in parts]),) + parts[0][2].shape[1:])
+            for r, _, rank_rows in parts:
+                rows[r::world] = rank_rows
+            self.rows = rows
+            self.row_shape = rows.shape[1:]
+            self.num_rows = len(rows)
+            self.mode = 'memory'
+        else:
+            summaries = [data if kind == 'stream' else StreamingSummary(data) for _, kind, data in parts]
+            for s in summaries[1:]:
+                summaries[0].merge(s)
+            self.summary = summaries[0]
+            self.rows = None
+            self.mode = 'stream'
+
+    def summarize(self):
+        # min, mean, max over batches and the first row
+        if self.mode == 'stream':
+            s = self.summary
+        else:
+            s = StreamingSummary(self.materialize())
+        return s.min, s.mean, s.max, s.first
+
+
+class CalibrationMemoryTracker:
+    """
+    Accounts memory used by calibration per layer: statistics buffers (host) and temporary tensors created while
+    computing statistics. When total buffers exceed the budget the largest in-memory buffers are spilled to disk
+    or switched to streaming summaries according to the policy.
+    """
+    def __init__(self, budget_mb=None, policy='stream', spill_dir=None):
+        if policy not in ['stream', 'spill']:
+            raise ValueError('Invalid calibration memory policy %s, one of [stream, spill]' % policy)
+        self.budget = budget_mb * 2**20 if budget_mb is not None else None
+        self.policy = policy
+        # Ranks on the same machine must not share spill files
+        self.spill_dir = spill_dir + '_rank%d' % get_rank() if spill_dir is not None and is_distributed() else spill_dir
+        self.peak_buffers = {}
+        self.peak_temp = {}
+        self.peak_total = 0
+        self.__base = 0
+
+    def spill_path(self, id, name=None):
+        fname = id if name is None else '%s_%s' % (id, name)
+        return os.path.join(self.spill_dir, fname + '.bin')
+
+    def begin(self, tensor):
+        if tensor.is_cuda:
+            torch.cuda.reset_peak_memory_stats(tensor.device)
+            self.__base = torch.cuda.memory_allocated(tensor.device)
+
+    def end(self, id, tensor, buffers, temp_factor=2):
+        # Temporary memory is measured on cuda, and estimated as multiple of input size otherwise
+        if tensor.is_cuda:
+            temp = torch.cuda.max_memory_allocated(tensor.device) - self.__base
+        else:
+            temp = temp_factor * tensor.numel() * tensor.element_size()
+        self.peak_temp[id] = max(self.peak_temp.get(id, 0), temp)
+
+        layer_bytes = sum([b.nbytes for b in layer_buffers(buffers[id])])
+        self.peak_buffers[id] = max(self.peak_buffers.get(id, 0), layer_bytes)
+
+        total = self.__enforce_budget(buffers)
+        self.peak_total = max(self.peak_total, total + temp)
+
+    def __enforce_budget(self, buffers):
+        total = sum([b.nbytes for l in buffers for b in layer_buffers(buffers[l])])
+        if self.budget is None:
+            return total
+
+        while total > self.budget:
+            in_memory = [(b.nbytes, l, i) for l in buffers for i, b in enumerate(layer_buffers(buffers[l]))
+                         if b.mode == 'memory' and b.nbytes > 0]
+            if len(in_memory) == 0:
+                break
+            _, l, i = max(in_memory)
+            b = layer_buffers(buffers[l])[i]
+            if self.policy == 'spill':
+                b.spill()
+            else:
+                b.stream()
+            total = sum([b.nbytes for l in buffers for b in layer_buffers(buffers[l])])
+        return total
+
+    def report(self, buffers, folder):
+        import pandas as pd
+        rows = []
+        for l in sorted_nicely(self.peak_buffers.keys()):
+            modes = set([b.mode for b in layer_buffers(buffers[l])]) if l in buffers else set()
+            rows.append([l, ','.join(sorted(modes)), self.peak_buffers[l] / 2**20, self.peak_temp.get(l, 0) / 2**20,
+                         (self.peak_buffers[l] + self.peak_temp.get(l, 0)) / 2**20])
+        df = pd.DataFrame(data=rows, columns=['layer', 'mode', 'peak_buffers_MB', 'peak_temp_MB', 'peak_MB'])
+        df.to_csv(os.path.join(folder, 'calibration_memory.csv'), index=False)
+        print("Calibration peak memory %.1f MB (budget %s)" %
+              (self.peak_total / 2**20, 'none' if self.budget is None else '%.1f MB' % (self.budget / 2**20)))
+        return df
+
+    def cleanup(self):
+        if self.spill_dir is not None and os.path.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir)
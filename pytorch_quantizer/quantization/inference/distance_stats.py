@@ -1,6 +1,5 @@
 from utils.misc import Singleton
 import numpy as np
-import pandas as pd
 import os
 import shutil
 from utils.misc import sorted_nicely
@@ -12,6 +11,38 @@ home = str(Path.home())
 base_dir = os.path.join(home, 'mxt-sim')
 
 
+class GrowthBuffer:
+    """
+    Append only buffer on the device of appended tensors, grows by fixed size chunks of rows.
+    Rows are scalars or of the shape of the first appended tensor without its first dim.
+    Appending never copies previous data or syncs with host.
+    """
+    def __init__(self, chunk_size=16384):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.pos = chunk_size
+        self.count = 0
+
+    def append(self, t):
+        t = t.detach()
+        t = t.flatten() if t.dim() <= 1 else t
+        i = 0
+        while i < t.shape[0]:
+            if self.pos == self.chunk_size:
+                self.chunks.append(torch.empty((self.chunk_size,) + t.shape[1:], dtype=t.dtype, device=t.device))
+                self.pos = 0
+            n = min(t.shape[0] - i, self.chunk_size - self.pos)
+            self.chunks[-1][self.pos:self.pos + n].copy_(t[i:i + n])
+            self.pos += n
+            i += n
+        self.count += t.shape[0]
+
+    def numpy(self):
+        if len(self.chunks) == 0:
+            return np.array([])
+        return torch.cat(self.chunks)[:self.count].cpu().numpy()
+
+
 class MeasureStatistics(metaclass=Singleton):
     def __init__(self, folder):
         self.enabled = False
@@ -21,16 +52,14 @@ class MeasureStatistics(metaclass=Singleton):
 
     def save_measure(self, tensor, id):
         if id not in self.stats:
-            self.stats[id] = np.array([])
+            self.stats[id] = GrowthBuffer()
 
         # Assume dimensions of [N,C,H,W]
         t = tensor.view(tensor.shape[0], -1)
         d = torch.sum(t**2, dim=-1)
-        stat_arr = d.cpu().numpy()
 
-        # Add to stats dictionary
-        s = np.concatenate([self.stats[id], stat_arr])
-        self.stats[id] = s
+        # Add to stats dictionary, stays on device until exit
+        self.stats[id].append(d)
 
     def __enter__(self):
         self.enabled = True
@@ -38,6 +67,7 @@ class MeasureStatistics(metaclass=Singleton):
         return self
 
     def __exit__(self, *args):
+        import pandas as pd
         if self.enabled and len(self.stats) > 0:
             self.enabled = False
             # Save measures
@@ -47,7 +77,7 @@ class MeasureStatistics(metaclass=Singleton):
                 os.makedirs(self.folder)
 
             path = os.path.join(self.folder, 'distance.csv')
-            pairs = [i for i in self.stats.items()]
+            pairs = [(k, v.numpy()) for k, v in self.stats.items()]
             cols = [i[0] for i in pairs]
             data = np.array([i[1] for i in pairs]).transpose()
             df = pd.DataFrame(data=data, columns=cols)
@@ -7,13 +7,17 @@ from utils.monitor import Monitor
 from .statistic_manager import StatisticManager
 from .statistic_manager_perchannel import StatisticManagerPerChannel
 from .distance_stats import MeasureStatistics as MS
+from .quantization_profiler import QuantizationProfiler as QP
+from .bit_search import load_precision_map
 # from .measure_statistics import MeasureStatistics as MS
 from pytorch_quantizer.quantization.quantization_manager import QuantizationManagerBase
 from enum import Enum
 from itertools import count
 import os
+import re
 import numpy as np
 from utils.dump_manager import DumpManager as DM
+from utils.mark_relu import fused_relu_arch
 from pytorch_quantizer.clipping.clipping_manager import StatisticalClipper, RatioClipper
 from pytorch_quantizer.quantization.qtypes.dummy_quantizer import DummyQuantizer
 
@@ -31,6 +35,9 @@ class ReLUWithId(nn.ReLU):
         super(ReLUWithId, self).__init__(inplace)
 
     def forward(self, input):
+        # Relu fused into half range quantization of previous layer
+        if QMI().enabled and QMI().is_rectified(input):
+            return input
         out = super(ReLUWithId, self).forward(input)
         # id = next(self._id)
         # out_id = 'relu%d_activation' % id
@@ -66,10 +73,10 @@ class MaxPool2dWithId(nn.MaxPool2d):
                 QMI().stats_manager.save_tensor_stats(out, 'activation_pooling', out_id)
             elif QMI().stats_mode is StatsMode.use_stats:
                 # Quantize using statistics
-                out = QMI().quantize_instant(out, "activation_pooling", stat_id=out_id, verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, "activation_pooling", stat_id=out_id, verbose=QMI().verbose, inplace=True)
             else:
                 # No stats, quantize using actual values
-                out = QMI().quantize_instant(out, "activation_pooling", verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, "activation_pooling", verbose=QMI().verbose, inplace=True)
 
         return out
 
@@ -93,10 +100,10 @@ class AvgPool2dWithId(nn.AvgPool2d):
                 QMI().stats_manager.save_tensor_stats(out, tag_act, out_id)
             elif QMI().stats_mode is StatsMode.use_stats:
                 # Quantize using statistics
-                out = QMI().quantize_instant(out, tag_act, stat_id=out_id, verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, tag_act, stat_id=out_id, verbose=QMI().verbose, inplace=True)
             else:
                 # No stats, quantize using actual values
-                out = QMI().quantize_instant(out, tag_act, verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, tag_act, verbose=QMI().verbose, inplace=True)
 
         return out
 
@@ -174,8 +181,10 @@ class Conv2dWithId(nn.Conv2d):
                 QMI().stats_manager.save_tensor_stats(out, self.internal_name, activation_id)
             elif QMI().stats_mode is StatsMode.use_stats:
                 # Quantize using statistics
+                # Output before quantization is needed only for bias correction
                 out_q = QMI().quantize_instant(out, tag_act, stat_id=activation_id,
-                                               half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose)
+                                               half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose,
+                                               inplace=not QMI().bcorr_act)
                 # print("%s: %d" % (activation_id, out.shape[2]*out.shape[3]))
                 if QMI().bcorr_act:
                     # if activation_id in bias_corr_cache:
@@ -204,7 +213,11 @@ class Conv2dWithId(nn.Conv2d):
 
             else:
                 # No stats, quantize using actual values
-                out = QMI().quantize_instant(out, tag_act, half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, tag_act, half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose,
+                                             inplace=True)
+
+        if QMI().dump_tensors and DM().enabled:
+            DM().dump(out, activation_id)
 
         if QMI().measure_stats.enabled:
             QMI().measure_stats.save_measure(out, activation_id)
@@ -237,12 +250,15 @@ class LinearWithId(nn.Linear):
                 QMI().stats_manager.save_tensor_stats(out, tag_act, activation_id, force_global_min_max=('classifier' in tag_act))
             elif QMI().stats_mode is StatsMode.use_stats:
                 out_q = QMI().quantize_instant(out, tag_act, stat_id=activation_id, half_range=half_range,
-                                               verbose=QMI().verbose)
+                                               verbose=QMI().verbose, inplace=True)
 
                 out = out_q
 
             else:
-                out = QMI().quantize_instant(out, tag_act, half_range=half_range, verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, tag_act, half_range=half_range, verbose=QMI().verbose, inplace=True)
+
+        if QMI().dump_tensors and DM().enabled:
+            DM().dump(out, activation_id)
 
         if QMI().measure_stats.enabled:
             QMI().measure_stats.save_measure(out, activation_id)
@@ -261,8 +277,6 @@ class BatchNorm2dWithId(nn.BatchNorm2d):
 
     def forward(self, input):
         activation_id = 'bn%d_activation' % self.id
-        if QMI().bn_folding and hasattr(self, 'absorbed'):
-            return input
 
         if not QMI().enabled:
             out = super(BatchNorm2dWithId, self).forward(input)
@@ -272,10 +286,10 @@ class BatchNorm2dWithId(nn.BatchNorm2d):
                 QMI().stats_manager.save_tensor_stats(out, 'activation', activation_id)
             elif QMI().stats_mode is StatsMode.use_stats:
                 # Quantize using statistics
-                out = QMI().quantize_instant(out, "activation", stat_id=activation_id, half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, "activation", stat_id=activation_id, half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose, inplace=True)
             else:
                 # No stats, quantize using actual values
-                out = QMI().quantize_instant(out, "activation", half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose)
+                out = QMI().quantize_instant(out, "activation", half_range=hasattr(self, 'before_relu'), verbose=QMI().verbose, inplace=True)
 
         if QMI().measure_stats.enabled:
             QMI().measure_stats.save_measure(out, activation_id)
@@ -290,12 +304,17 @@ class QuantizationManagerInference(QuantizationManagerBase):
         self.verbose = False
         self.quantize = args.qtype is not None
         self.disable_quantization = args.q_off
+        # Layers before relu marked on traced model, kept when op manager is recreated on reload
+        self.relu_marked = False
         self.op_manager = self.createTruncationManager(args, qparams)
         self.enabled = False
         self.bn_folding = False
+        # Last output of half range quantization and its version, rectified already
+        self.rectified = None
         self.bcorr_act = args.bias_corr_act
         self.bcorr_weight = args.bias_corr_weight
         self.vcorr_weight = args.var_corr_weight
+        self.dump_tensors = getattr(args, 'dump_dir', None) is not None
         sf = args.stats_folder if args.stats_folder is not None else args.arch
         if args.kld_threshold:
             sf += '_kld_' + args.qtype
@@ -305,9 +324,11 @@ class QuantizationManagerInference(QuantizationManagerBase):
             print("Collecting statistics...")
             self.stats_mode = StatsMode.collect_stats
             if args.per_channel_quant_act:
-                self.stats_manager = StatisticManagerPerChannel(sf, load_stats=False, batch_avg=args.stats_batch_avg)
+                self.stats_manager = StatisticManagerPerChannel(sf, load_stats=False, batch_avg=args.stats_batch_avg,
+                                                                mem_budget=args.calib_mem_budget, mem_policy=args.calib_mem_policy)
             else:
-                self.stats_manager = StatisticManager(sf, load_stats=False, kld_threshold=args.kld_threshold, batch_avg=args.stats_batch_avg)
+                self.stats_manager = StatisticManager(sf, load_stats=False, kld_threshold=args.kld_threshold, batch_avg=args.stats_batch_avg,
+                                                      mem_budget=args.calib_mem_budget, mem_policy=args.calib_mem_policy)
         elif args.stats_mode == 'use':
             self.stats_mode = StatsMode.use_stats
             if args.per_channel_quant_act:
@@ -322,6 +343,11 @@ class QuantizationManagerInference(QuantizationManagerBase):
             # enable measuring statistics
             self.measure_stats.__enter__()
 
+        self.profiler = QP(args.arch)
+        if args.profile_quant:
+            # enable profiling of quantize_instant
+            self.profiler.__enter__()
+
 
     def __exit__(self, *args):
         self.op_manager.__exit__(args)
@@ -329,6 +355,8 @@ class QuantizationManagerInference(QuantizationManagerBase):
             self.stats_manager.__exit__()
         if self.measure_stats is not None:
             self.measure_stats.__exit__()
+        if self.profiler is not None:
+            self.profiler.__exit__()
         super(QuantizationManagerInference, self).__exit__(args)
 
     def createTruncationManager(self, args, qparams):
@@ -336,18 +364,41 @@ class QuantizationManagerInference(QuantizationManagerBase):
         if args.qtype == 'int4':
             ignore_ids = [0]
             op_manager.set_8bit_list(['conv%d_activation'%id for id in ignore_ids])
+        if getattr(args, 'precision_map', None) is not None and os.path.exists(args.precision_map):
+            op_manager.set_precision_map(load_precision_map(args.precision_map))
+        if self.relu_marked:
+            op_manager.set_fused_relu(False)
 
         return op_manager
 
-    def quantize_instant(self, tensor, tag="", stat_id=None, half_range=False, override_att=None, verbose=False):
-        return self.op_manager.quantize_instant(tensor, tag, stat_id, half_range, override_att, verbose)
+    def set_relu_marked(self, marked):
+        self.relu_marked = marked
+        self.op_manager.set_fused_relu(fused_relu_arch(self.args.arch) and not marked)
+
+    def quantize_instant(self, tensor, tag="", stat_id=None, half_range=False, override_att=None, verbose=False,
+                         inplace=False):
+        out = self.op_manager.quantize_instant(tensor, tag, stat_id, half_range, override_att, verbose, inplace)
+        if half_range and getattr(self.op_manager.get_quantizer(tag), 'clamps_half_range', False):
+            # Negative values are clamped to zero by quantization, relu of this output is a no-op
+            self.rectified = (out, out._version)
+        return out
+
+    def is_rectified(self, tensor):
+        # Not modified in place since quantization
+        if self.rectified is not None and self.rectified[0] is tensor and self.rectified[1] == tensor._version:
+            self.rectified = None
+            return True
+        return False
 
     def set_8bit_list(self, ignore_ids):
         self.op_manager.set_8bit_list(ignore_ids)
 
+    def set_precision_map(self, precision_map):
+        self.op_manager.set_precision_map(precision_map)
+
     def reset_counters(self):
         ReLUWithId._id = count(0)
-        pass
+        self.rectified = None
 
     def quantize_model(self, model):
         if self.args.stats_mode == 'collect':
@@ -355,16 +406,23 @@ class QuantizationManagerInference(QuantizationManagerBase):
 
         for n, m in model.named_modules():
             weight_q = None
+            # Weight precision from mixed precision map
+            override_att = None
+            if hasattr(m, 'id') and (isinstance(m, torch.nn.Conv2d) or isinstance(m, torch.nn.Linear)):
+                layer_id = ('conv%d_activation' if isinstance(m, torch.nn.Conv2d) else 'linear%d_activation') % m.id
+                wbits = self.op_manager.precision_map.get(layer_id, {}).get('weight')
+                override_att = ('num_bits', wbits) if wbits is not None else None
+
             if isinstance(m, torch.nn.Conv2d):
                 if m.weight.shape[1] == 3:
                     # first layer leave in 8 bit
                     weight_q = QMI().quantize_instant(m.weight, "weight", override_att=('num_bits', 8), verbose=True)
                 else:
-                    weight_q = QMI().quantize_instant(m.weight, "weight", verbose=True)
+                    weight_q = QMI().quantize_instant(m.weight, "weight", override_att=override_att, verbose=True)
 
             elif isinstance(m, torch.nn.Linear):
                 tag_weight = 'weight_classifier' if m.weight.shape[0] == 1000 else 'weight'
-                weight_q = QMI().quantize_instant(m.weight, tag_weight, verbose=True)
+                weight_q = QMI().quantize_instant(m.weight, tag_weight, override_att=override_att, verbose=True)
 
             if weight_q is not None:
                 if self.vcorr_weight or self.bcorr_weight:
@@ -395,7 +453,8 @@ QMI = QuantizationManagerInference
 
 class TruncationOpManagerInference:
     def __load_quantizer__(self, qtype, qparams):
-        qtype_name = qtype.rstrip('1234567890')
+        # Leading letters name the quantizer family, e.g. int8 -> int, fp8e4m3 -> fp
+        qtype_name = re.match('[a-z]+', qtype).group()
         quant_params = qparams[qtype_name] if qtype_name in qparams else {}
         quantizer = qtypes.__dict__[qtype_name + "_quantizer"](qtype, quant_params)
         return quantizer, quant_params
@@ -478,27 +537,31 @@ class TruncationOpManagerInference:
         self.orig_avgpool = nn.AvgPool2d
         self.orig_relu = nn.ReLU
         self.ignore_ids = []
+        self.precision_map = {}
 
         self.rho_act = qparams['qmanager']['rho_act'] if 'qmanager' in qparams else None
         self.rho_weight = qparams['qmanager']['rho_weight'] if 'qmanager' in qparams else None
         self.fp32_clip = self.rho_act is not None or self.rho_weight is not None
-        self.fused_relu = args.arch is not None and (args.arch == 'alexnet' or args.arch == 'vgg16' or args.arch == 'vgg16_bn' or args.arch == 'inception_v3' or 'squeezenet' in args.arch)
+        self.fused_relu = fused_relu_arch(args.arch)
 
         if args.qtype is not None:
             self.quantizers = {}
             self.quantize = True
-            if 'bfloat' in args.qtype:
-                self.quantizer_default, _ = self.__load_quantizer__(args.qtype, qparams)
-                self.linear_layer_quantizer = DummyQuantizer()
-            else:
-                self.__fill_quantizers__(args.qtype, qparams, args.arch, args.qweight)
-                self.quantizer_default, _ = self.__load_quantizer__('int8', qparams)
+            self.__fill_quantizers__(args.qtype, qparams, args.arch, args.qweight)
+            self.quantizer_default, _ = self.__load_quantizer__('int8', qparams)
             self.activations_clipper = StatisticalClipper(self.rho_act)
             self.weights_clipper = RatioClipper(self.rho_weight)
 
     def __exit__(self, *args):
         pass
 
+    def set_fused_relu(self, fused_relu):
+        # Positive range for all activations, not needed when layers before relu are marked
+        self.fused_relu = fused_relu
+        if hasattr(self, 'quantizers'):
+            self.quantizers['activation'].force_positive = fused_relu
+            self.quantizers['activation_linear'].force_positive = fused_relu
+
     def get_quantizer(self, tag, tensor=None):
         if tag in self.quantizers:
             return self.quantizers[tag]
@@ -508,6 +571,9 @@ class TruncationOpManagerInference:
     def set_8bit_list(self, ignore_list):
         self.ignore_ids = ignore_list
 
+    def set_precision_map(self, precision_map):
+        self.precision_map = precision_map
+
     def enable(self):
         # self.quantize_matmul()
         nn.Linear = LinearWithId
@@ -539,7 +605,9 @@ class TruncationOpManagerInference:
         fprop = self.activation_quantizer if fprop else None
         return attacher.pytorch_attach(tensor, fprop, None)
 
-    def quantize_instant(self, tensor, tag="", stat_id=None, half_range=False, override_att=None, verbose=False):
+    def quantize_instant(self, tensor, tag="", stat_id=None, half_range=False, override_att=None, verbose=False,
+                         inplace=False):
+        # inplace - tensor is dead after quantization and its buffer may hold the result
         # ignore quantization of first and last layer
         ignore_cond = False
         if stat_id is not None:
@@ -559,7 +627,15 @@ class TruncationOpManagerInference:
         q = self.get_quantizer(qtag)
         q.half_range = half_range
 
+        # Activation precision from mixed precision map
+        if not ignore_cond and override_att is None and stat_id in self.precision_map and \
+                'act' in self.precision_map[stat_id] and (tag == 'activation' or tag == 'activation_linear'):
+            override_att = ('num_bits', self.precision_map[stat_id]['act'])
+
         if verbose:
             print("Quantize {0:21} | Id - {1:18} | {2:} | {3:}".format(tag, str(stat_id), str(q), str(tensor.device)))
 
-        return q(tensor, tag, stat_id, override_att)
+        if QP().enabled:
+            return QP().profile(q, tensor, tag, stat_id, override_att, inplace=inplace)
+
+        return q(tensor, tag, stat_id, override_att, inplace=inplace)
@@ -0,0 +1,121 @@
+from utils.misc import Singleton
+import numpy as np
+import os
+import shutil
+import json
+import time
+import warnings
+import torch
+from pathlib import Path
+
+
+home = str(Path.home())
+base_dir = os.path.join(home, 'mxt-sim')
+
+
+class QuantizationProfiler(metaclass=Singleton):
+    """
+    Profiles calls to quantize_instant per (stat_id, tag).
+    Records call count, wall time, bytes processed, host-device synchronizations and the quantizer path taken.
+    On exit writes a summary table sorted by total time and a chrome trace (chrome://tracing, perfetto) of all calls.
+    Calls are also wrapped with record_function so they show up as named ranges under torch.profiler.
+    """
+    def __init__(self, folder, sync_cuda=True, count_syncs=True, max_events=200000):
+        self.enabled = False
+        self.folder = os.path.join(base_dir, 'profile', folder)
+        # Synchronize device around each call so wall time accounts for asynchronous kernels
+        self.sync_cuda = sync_cuda
+        self.count_syncs = count_syncs
+        self.max_events = max_events
+        self.records = {}
+        self.events = []
+        self.start_time = None
+
+    def profile(self, quantizer, tensor, tag, stat_id, *args, **kwargs):
+        key = (str(stat_id), tag)
+        self.__sync_device(tensor)
+        start = time.perf_counter()
+        with torch.autograd.profiler.record_function('quantize/%s/%s' % key):
+            if self.count_syncs and tensor.is_cuda:
+                res, syncs = self.__call_counting_syncs(quantizer, tensor, tag, stat_id, *args, **kwargs)
+            else:
+                res = quantizer(tensor, tag, stat_id, *args, **kwargs)
+                syncs = 0
+        self.__sync_device(tensor)
+        end = time.perf_counter()
+
+        path = getattr(quantizer, 'last_path', type(quantizer).__name__)
+        nbytes = tensor.numel() * tensor.element_size() + res.numel() * res.element_size()
+        shape = list(tensor.shape)
+        self.__add_record(key, path, end - start, nbytes, syncs)
+        if len(self.events) < self.max_events:
+            self.events.append({'name': '%s/%s' % key, 'cat': path, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                'ts': (start - self.start_time) * 1e6, 'dur': (end - start) * 1e6,
+                                'args': {'stat_id': key[0], 'tag': tag, 'path': path, 'bytes': nbytes,
+                                         'syncs': syncs, 'shape': shape}})
+        return res
+
+    @staticmethod
+    def __call_counting_syncs(quantizer, tensor, tag, stat_id, *args, **kwargs):
+        # Let pytorch report every synchronizing cuda call as a warning and count them
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                res = quantizer(tensor, tag, stat_id, *args, **kwargs)
+        finally:
+            torch.cuda.set_sync_debug_mode('default')
+        syncs = len([m for m in w if 'synchroniz' in str(m.message)])
+        return res, syncs
+
+    def __sync_device(self, tensor):
+        if self.sync_cuda and tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+
+    def __add_record(self, key, path, duration, nbytes, syncs):
+        if key not in self.records:
+            self.records[key] = {'calls': 0, 'time': 0., 'bytes': 0, 'syncs': 0, 'paths': set()}
+        r = self.records[key]
+        r['calls'] += 1
+        r['time'] += duration
+        r['bytes'] += nbytes
+        r['syncs'] += syncs
+        r['paths'].add(path)
+
+    def summary(self):
+        import pandas as pd
+        rows = []
+        for (stat_id, tag), r in self.records.items():
+            rows.append([stat_id, tag, ','.join(sorted(r['paths'])), r['calls'], r['time'] * 1e3,
+                         r['time'] * 1e3 / r['calls'], r['bytes'] / 2**20,
+                         r['bytes'] / r['time'] / 2**30 if r['time'] > 0 else np.nan, r['syncs']])
+        df = pd.DataFrame(data=rows, columns=['stat_id', 'tag', 'path', 'calls', 'total_ms', 'mean_ms', 'MB',
+                                              'GB/s', 'host_syncs'])
+        df = df.sort_values('total_ms', ascending=False).reset_index(drop=True)
+        total = df['total_ms'].sum()
+        df['%time'] = 100. * df['total_ms'] / total if total > 0 else np.nan
+        return df
+
+    def __enter__(self):
+        self.enabled = True
+        self.records.clear()
+        self.events.clear()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.enabled and len(self.records) > 0:
+            self.enabled = False
+            if os.path.exists(self.folder):
+                shutil.rmtree(self.folder)
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+
+            df = self.summary()
+            print(df.to_string())
+            df.to_csv(os.path.join(self.folder, 'quantization_profile.csv'), index=False)
+
+            path = os.path.join(self.folder, 'quantization_trace.json')
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            print("Quantization profile saved to %s" % self.folder)
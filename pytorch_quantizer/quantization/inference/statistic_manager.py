@@ -1,21 +1,23 @@
 from utils.misc import Singleton
 import numpy as np
-import pandas as pd
 import os
 import shutil
 from utils.misc import sorted_nicely, cos_sim
 import torch
-from .kld_threshold import get_kld_threshold_15bins
-from tqdm import tqdm
+from .calibration_memory import StatsBuffer, CalibrationMemoryTracker
+from utils.distributed import all_gather_object, is_distributed, is_main_process
 from pathlib import Path
 home = str(Path.home())
 base_dir = os.path.join(home, 'mxt-sim')
 
 
 class StatisticManager(metaclass=Singleton):
-    def __init__(self, folder, load_stats, stats = ['max', 'min', 'std', 'mean', 'kurtosis', 'mean_abs', 'b', 'dim'], batch_avg=False, kld_threshold=False, collect_err=True):
+    def __init__(self, folder, load_stats, stats = ['max', 'min', 'std', 'mean', 'kurtosis', 'mean_abs', 'b', 'dim'], batch_avg=False, kld_threshold=False, collect_err=True,
+                 mem_budget=None, mem_policy='stream'):
+        import pandas as pd
         self.name = folder
         self.folder = os.path.join(base_dir, 'statistics', folder)
+        self.mem_tracker = CalibrationMemoryTracker(mem_budget, mem_policy, os.path.join(base_dir, 'statistics_spill', folder))
         self.stats_names = stats
         self.collect_err = collect_err
         self.batch_avg = batch_avg
@@ -32,6 +34,8 @@ class StatisticManager(metaclass=Singleton):
             # self.stats_names.append('ang_laplace')
         self.stats = {}
         self.metadata = {}
+        # Output size per sample, 'dim' depends on batch size of the collection run
+        self.sample_dim = {}
         self.save_stats = not load_stats
         self.kld_threshold = kld_threshold
         if kld_threshold:
@@ -45,6 +49,7 @@ class StatisticManager(metaclass=Singleton):
         pass
 
     def save_tensor_stats(self, tensor, tag, id, tensors_q={}, force_global_min_max=False):
+        self.mem_tracker.begin(tensor)
         stat_arr = []
         # Calculate tensor stats
         for sn in self.stats_names:
@@ -78,6 +83,8 @@ class StatisticManager(metaclass=Singleton):
             elif sn == 'dim':
                 st = t.numel()
             elif sn == 'kld_th':
+                from .kld_threshold import get_kld_threshold_15bins
+                from tqdm import tqdm
                 t_np = tensor.cpu().numpy()
                 st = np.max(np.array([get_kld_threshold_15bins(t_np[i]) for i in tqdm(range(t_np.shape[0]))]))
             elif 'mse' in sn:
@@ -115,13 +122,12 @@ class StatisticManager(metaclass=Singleton):
             stat_arr.append(st.cpu().numpy() if sn != 'dim' and sn != 'kld_th' else st)
 
         # Add to stats dictionary
-        if id in self.stats:
-            stat_arr = np.vstack(stat_arr).transpose()
-            s = np.concatenate([self.stats[id], stat_arr])
-            self.stats[id] = s
-        else:
-            self.stats[id] = np.vstack(stat_arr).transpose()
+        if id not in self.stats:
+            self.stats[id] = StatsBuffer(self.mem_tracker.spill_path(id))
             self.metadata[id] = tag
+            self.sample_dim[id] = tensor[0].numel()
+        self.stats[id].append(np.vstack(stat_arr).transpose())
+        self.mem_tracker.end(id, tensor, self.stats, temp_factor=2 + len(tensors_q))
 
     def get_tensor_stats(self, id, kind={'min':'mean', 'max':'mean', 'mean': 'mean','std':'mean', 'range':'mean', 'mean_abs':'mean', 'b':'mean'}):
         if self.stats_df is not None:
@@ -144,21 +150,41 @@ class StatisticManager(metaclass=Singleton):
         return s
 
     def __exit__(self, *args):
+        import pandas as pd
         if self.save_stats:
+            # Statistics of all ranks are merged and saved by rank 0
+            if is_distributed():
+                # Ranks agree on layers first, rank without calibration batches of a layer merges empty buffer
+                metadata = {}
+                for m, d in all_gather_object((self.metadata, self.sample_dim)):
+                    metadata.update({s_id: (m[s_id], d[s_id]) for s_id in m})
+                for s_id in sorted_nicely(metadata.keys()):
+                    if s_id not in self.stats:
+                        self.stats[s_id] = StatsBuffer(self.mem_tracker.spill_path(s_id))
+                        self.metadata[s_id], self.sample_dim[s_id] = metadata[s_id]
+                    self.stats[s_id].merge_distributed()
+                if not is_main_process():
+                    self.mem_tracker.cleanup()
+                    return
+
             # Save statistics
             if os.path.exists(self.folder):
                 shutil.rmtree(self.folder)
             if not os.path.exists(self.folder):
                 os.makedirs(self.folder)
-            all_stats_df = {}
             for s_id in self.stats:
-                path = os.path.join(self.folder, '%s.csv' % s_id)
-                df = pd.DataFrame(columns=self.stats_names, data=self.stats[s_id])
-                df.to_csv(path, index=False)
-                all_stats_df[s_id] = df
-            self.__save_summry(all_stats_df)
+                # Full history is not available for layers switched to streaming summary
+                data = self.stats[s_id].materialize()
+                if data is not None:
+                    path = os.path.join(self.folder, '%s.csv' % s_id)
+                    df = pd.DataFrame(columns=self.stats_names, data=data)
+                    df.to_csv(path, index=False)
+            self.__save_summry()
+            self.mem_tracker.report(self.stats, self.folder)
+            self.mem_tracker.cleanup()
 
-    def __save_summry(self, all_stats_df):
+    def __save_summry(self):
+        import pandas as pd
         columns = []
         c_names = self.stats_names
         for c in c_names:
@@ -167,12 +193,14 @@ class StatisticManager(metaclass=Singleton):
             columns.append('max_%s' % c)
 
         df_summary = pd.DataFrame(columns=['internal_name']+columns)
-        for s_id in sorted_nicely(all_stats_df.keys()):
+        for s_id in sorted_nicely(self.stats.keys()):
+            min_, mean_, max_, first = self.stats[s_id].summarize()
             df_summary.loc[s_id, 'internal_name'] = self.metadata[s_id]
-            for c in c_names:
-                df_summary.loc[s_id, 'min_%s' % c] = all_stats_df[s_id][c].min()
-                df_summary.loc[s_id, 'mean_%s' % c] = all_stats_df[s_id][c].mean()
-                df_summary.loc[s_id, 'max_%s' % c] = all_stats_df[s_id][c].max()
-            df_summary.loc[s_id, 'dim'] = all_stats_df[s_id]['dim'][0]
+            for i, c in enumerate(c_names):
+                df_summary.loc[s_id, 'min_%s' % c] = min_[i]
+                df_summary.loc[s_id, 'mean_%s' % c] = mean_[i]
+                df_summary.loc[s_id, 'max_%s' % c] = max_[i]
+            df_summary.loc[s_id, 'dim'] = first[c_names.index('dim')]
+            df_summary.loc[s_id, 'sample_dim'] = self.sample_dim[s_id]
         path = os.path.join(self.folder, '%s_summary.csv' % self.name)
         df_summary.to_csv(path, index=True)
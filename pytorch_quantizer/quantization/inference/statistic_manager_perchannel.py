@@ -1,12 +1,13 @@
 from utils.misc import Singleton
 import numpy as np
-import pandas as pd
 import os
 import shutil
 from utils.misc import sorted_nicely, cos_sim
 import torch
 import pickle
 from pathlib import Path
+from .calibration_memory import StatsBuffer, CalibrationMemoryTracker
+from utils.distributed import all_gather_object, is_distributed, is_main_process
 
 
 home = str(Path.home())
@@ -15,9 +16,11 @@ base_dir = os.path.join(home, 'mxt-sim')
 SAVE_FULL_STATS = False
 
 class StatisticManagerPerChannel(metaclass=Singleton):
-    def __init__(self, folder, load_stats, stats = ['max', 'min', 'std', 'mean', 'kurtosis', 'b', 'std_pos'], batch_avg=False, collect_err=False):
+    def __init__(self, folder, load_stats, stats = ['max', 'min', 'std', 'mean', 'kurtosis', 'b', 'std_pos'], batch_avg=False, collect_err=False,
+                 mem_budget=None, mem_policy='stream'):
         self.name = folder
         self.folder = os.path.join(base_dir, 'statistics/per_channel', folder)
+        self.mem_tracker = CalibrationMemoryTracker(mem_budget, mem_policy, os.path.join(base_dir, 'statistics_spill/per_channel', folder))
         self.stats_names = stats
         self.collect_err = collect_err
         self.batch_avg = batch_avg
@@ -47,6 +50,7 @@ class StatisticManagerPerChannel(metaclass=Singleton):
         if len(tensor.shape) < 3 or (tensor.shape[2] == 1 and tensor.shape[3] == 1):
             return
 
+        self.mem_tracker.begin(tensor)
         # Assume activation dimentions [N,C,H,W]
         t = tensor.transpose(0, 1).contiguous()  # [C, N, H, W]
         t = t.view(t.shape[0], -1) # [C, NxHxW]
@@ -117,12 +121,11 @@ class StatisticManagerPerChannel(metaclass=Singleton):
             if id not in self.stats:
                 self.stats[id] = {}
             if sn not in self.stats[id]:
-                self.stats[id][sn] = st
-            else:
-                # if len(st.shape) > 1:
-                self.stats[id][sn] = np.vstack([self.stats[id][sn], st])
-                # else:
-                #     self.stats[id][sn] = np.concatenate([self.stats[id][sn], st])
+                self.stats[id][sn] = StatsBuffer(self.mem_tracker.spill_path(id, sn))
+            self.stats[id][sn].append(st)
+
+        # Transposed copy, kurtosis and relu temporaries
+        self.mem_tracker.end(id, tensor, self.stats, temp_factor=3 + len(tensors_q))
 
     def get_tensor_stat(self, id, stat, kind='mean'):
         if self.stats is not None:
@@ -134,6 +137,20 @@ class StatisticManagerPerChannel(metaclass=Singleton):
 
     def __exit__(self, *args):
         if self.save_stats:
+            # Statistics of all ranks are merged and saved by rank 0
+            if is_distributed():
+                # Ranks agree on layers first, rank without calibration batches of a layer merges empty buffer
+                keys = set()
+                for k in all_gather_object([(l, sn) for l in self.stats for sn in self.stats[l]]):
+                    keys.update(k)
+                for l, sn in sorted(keys):
+                    if sn not in self.stats.setdefault(l, {}):
+                        self.stats[l][sn] = StatsBuffer(self.mem_tracker.spill_path(l, sn))
+                    self.stats[l][sn].merge_distributed()
+                if not is_main_process():
+                    self.mem_tracker.cleanup()
+                    return
+
             # Save statistics
             if os.path.exists(self.folder):
                 shutil.rmtree(self.folder)
@@ -142,14 +159,19 @@ class StatisticManagerPerChannel(metaclass=Singleton):
 
             # Avoid saving full stats by default since it takes huge amound of disk space
             if SAVE_FULL_STATS:
+                # Layers switched to streaming summary have no full history
+                full_stats = {l: {s: self.stats[l][s].materialize() for s in self.stats[l]} for l in self.stats}
                 path = os.path.join(self.folder, 'statistics_perchannel.pkl')
                 f = open(path, "wb")
-                pickle.dump(self.stats, f)
+                pickle.dump(full_stats, f)
                 f.close()
 
             self.__save_summry()
+            self.mem_tracker.report(self.stats, self.folder)
+            self.mem_tracker.cleanup()
 
     def __save_summry(self):
+        import pandas as pd
         stats_summary = {}
         stats = self.stats_names
         columns = []
@@ -162,10 +184,10 @@ class StatisticManagerPerChannel(metaclass=Singleton):
             df = pd.DataFrame(columns=columns)
             for s in stats:
                 if s in self.stats[l]:
-                    t = self.stats[l][s]
-                    df['min_%s' % s] = t.min(axis=0) if len(t.shape) > 1 else [t.min(axis=0)]
-                    df['mean_%s' % s] = t.mean(axis=0) if len(t.shape) > 1 else [t.mean(axis=0)]
-                    df['max_%s' % s] = t.max(axis=0) if len(t.shape) > 1 else [t.max(axis=0)]
+                    min_, mean_, max_, _ = self.stats[l][s].summarize()
+                    df['min_%s' % s] = min_
+                    df['mean_%s' % s] = mean_
+                    df['max_%s' % s] = max_
             stats_summary[l] = df
 
         path = os.path.join(self.folder, '%s_statistics_perchannel_summary.pkl' % self.name)
@@ -1,6 +1,6 @@
-from sklearn.cluster import KMeans
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from tqdm import tqdm
 import torchvision.models as models
 import sys
@@ -8,26 +8,56 @@ import time
 import os
 import copy
 from utils.absorb_bn import search_absorbe_bn
+from pytorch_quantizer.quantization.codebook import save_codebook_model
 import argparse
 from pathlib import Path
 
+
+def kmeans1d(x, k, max_iter=300, tol=1e-6):
+    """
+    Lloyd-Max k-means of 1-D data.
+    On sorted data every cluster is a contiguous range, so an iteration is a search of k-1 boundaries and a
+    difference of prefix sums instead of a pass assigning every value.
+    Returns sorted cluster centers and boundaries between them.
+    """
+    xs, _ = torch.sort(torch.as_tensor(x).detach().flatten().double())
+    n = xs.numel()
+    k = max(1, min(k, n))
+    csum = torch.cat([xs.new_zeros(1), torch.cumsum(xs, 0)])
+    scale = (xs[-1] - xs[0]).item()
+
+    # init centers at quantiles
+    centers = xs[((torch.arange(k, dtype=torch.float64) + 0.5) * n / k).long()]
+    for _ in range(max_iter):
+        bounds = (centers[1:] + centers[:-1]) / 2
+        edges = torch.cat([torch.zeros(1, dtype=torch.long), torch.searchsorted(xs, bounds),
+                           torch.full((1,), n, dtype=torch.long)])
+        counts = edges[1:] - edges[:-1]
+        sums = csum[edges[1:]] - csum[edges[:-1]]
+        # empty clusters keep their center
+        new_centers = torch.where(counts > 0, sums / counts.clamp(min=1), centers)
+        shift = (new_centers - centers).abs().max().item()
+        centers = new_centers
+        if shift <= tol * scale:
+            break
+
+    return centers, (centers[1:] + centers[:-1]) / 2
+
+
 def clip1d_kmeans(x, num_bits=8, n_jobs=-1):
-    orig_shape = x.shape
-    x = np.expand_dims(x.flatten(), -1)
-    kmeans = KMeans(n_clusters=2**num_bits, random_state=0)
-    kmeans.fit(x)
-    x = np.clip(x, kmeans.cluster_centers_.min(), kmeans.cluster_centers_.max())
-    return x.reshape(orig_shape)
+    centers, _ = kmeans1d(x, 2**num_bits)
+    if isinstance(x, torch.Tensor):
+        return x.clamp(centers.min().item(), centers.max().item())
+    return np.clip(x, centers.min().item(), centers.max().item())
 
 
 def quantize1d_kmeans(x, num_bits=8, n_jobs=-1):
-    orig_shape = x.shape
-    x = np.expand_dims(x.flatten(), -1)
-    # init = np.expand_dims(np.linspace(x.min(), x.max(), 2**num_bits), -1)
-    kmeans = KMeans(n_clusters=2**num_bits, random_state=0, n_jobs=n_jobs)
-    x_kmeans = kmeans.fit_predict(x)
-    q_kmeans = np.array([kmeans.cluster_centers_[i] for i in x_kmeans])
-    return q_kmeans.reshape(orig_shape)
+    t = torch.as_tensor(x)
+    centers, bounds = kmeans1d(t, 2**num_bits)
+    # Assign each value to the cluster between its boundaries
+    q = centers[torch.bucketize(t.flatten().double(), bounds, right=True)]
+    q = q.view(t.shape).to(t.dtype)
+    return q.numpy() if isinstance(x, np.ndarray) else q
 
 
 def is_ignored(name, param):
@@ -39,30 +69,78 @@ def is_ignored(name, param):
            (name == 'Conv2d_2a_3x3.conv.weight') # WA for inception_v3
 
 
-def quantize_model_parameters(model, num_bits):
+def _init_worker():
+    # One thread per process, parallelism comes from the pool
+    torch.set_num_threads(1)
+
+
+def run_layer_jobs(fn, jobs, workers=1):
+    """
+    Run independent per layer jobs, fn(job) writes its result in place to job[0].
+    With workers > 1 jobs run in a process pool on tensors moved to shared memory. Largest layers are
+    dispatched first so the pool is not left waiting for a big layer at the end. Every job writes only
+    its own tensor, so the result does not depend on scheduling.
+    """
+    jobs = sorted(jobs, key=lambda j: j[0].numel(), reverse=True)
+    if workers <= 1:
+        for j in tqdm(jobs):
+            fn(j)
+        return
+
+    for j in jobs:
+        for t in j:
+            if isinstance(t, torch.Tensor):
+                t.share_memory_()
+    with mp.get_context('fork').Pool(workers, initializer=_init_worker) as pool:
+        for _ in tqdm(pool.imap_unordered(fn, jobs), total=len(jobs)):
+            pass
+
+
+def _quantize_job(job):
+    w, num_bits = job
+    w.copy_(quantize1d_kmeans(w, num_bits=num_bits))
+
+
+def _clip_job(job):
+    w, num_bits = job
+    w.copy_(clip1d_kmeans(w, num_bits=num_bits))
+
+
+def _bias_correction_job(job):
+    w_km, w_orig = job
+    mean_delta = w_km.view(w_km.shape[0], -1).mean(dim=-1) - w_orig.view(w_orig.shape[0], -1).mean(dim=-1)
+    w_km.view(w_km.shape[0], -1).sub_(mean_delta.view(mean_delta.shape[0], 1))
+
+
+def quantize_model_parameters(model, num_bits, workers=1):
     # Quantize parameters of the model with 4 bit kmeans
-    named_params = [np for np in model.named_parameters() if not is_ignored(*np)]
-    for np in tqdm(named_params):
-        np[1].data = torch.tensor(quantize1d_kmeans(np[1].detach().numpy(), num_bits=num_bits))
+    jobs = [(p.data, num_bits) for n, p in model.named_parameters() if not is_ignored(n, p)]
+    run_layer_jobs(_quantize_job, jobs, workers)
 
 
-def clip_model_parameters(model, num_bits):
+def clip_model_parameters(model, num_bits, workers=1):
     # Quantize parameters of the model with 4 bit kmeans
-    named_params = [np for np in model.named_parameters() if not is_ignored(*np)]
-    for np in tqdm(named_params):
-        np[1].data = torch.tensor(clip1d_kmeans(np[1].detach().numpy(), num_bits=num_bits))
+    jobs = [(p.data, num_bits) for n, p in model.named_parameters() if not is_ignored(n, p)]
+    run_layer_jobs(_clip_job, jobs, workers)
+
+
+def save_model(model, path, arch, fmt='codebook'):
+    if fmt == 'codebook':
+        save_codebook_model(model, path, arch)
+    else:
+        torch.save(model, path)
 
 
-def process_model(arch, num_bits, base_dir, task='quantize'):
+def process_model(arch, num_bits, base_dir, task='quantize', fmt='codebook', workers=1):
     model = models.__dict__[arch](pretrained=True)
     search_absorbe_bn(model)
 
     # Quantize model by kmeans non uniform quantization
     model_qkmeans = copy.deepcopy(model)
     if task == 'quantize':
-        quantize_model_parameters(model_qkmeans, num_bits=num_bits)
+        quantize_model_parameters(model_qkmeans, num_bits=num_bits, workers=workers)
     elif task == 'clip':
-        clip_model_parameters(model_qkmeans, num_bits=num_bits)
+        clip_model_parameters(model_qkmeans, num_bits=num_bits, workers=workers)
     else:
         print("Invalid argument task=%s" % task)
         exit(-1)
@@ -73,23 +151,18 @@ def process_model(arch, num_bits, base_dir, task='quantize'):
         os.makedirs(model_path)
     model_path = os.path.join(model_path, arch + ('_kmeans%dbit.pt' % num_bits))
     print("Saving quantized model to %s" % model_path)
-    torch.save(model_qkmeans, model_path)
+    save_model(model_qkmeans, model_path, arch, fmt)
 
     # Per channel bias correction
     model_bcorr = copy.deepcopy(model_qkmeans)
     p_km = [np for np in model_bcorr.named_parameters()]
     p_orig = [np for np in model.named_parameters()]
-    for i in tqdm(range(len(p_km))):
-        if not is_ignored(p_km[i][0], p_km[i][1]):
-            w_km = p_km[i][1]
-            w_orig = p_orig[i][1]
-            mean_delta = w_km.view(w_km.shape[0], -1).mean(dim=-1) - w_orig.view(w_orig.shape[0], -1).mean(dim=-1)
-            p_km[i][1].data = (w_km.view(w_km.shape[0], -1) - mean_delta.view(mean_delta.shape[0], 1)).view(
-                w_orig.shape)
+    jobs = [(p_km[i][1].data, p_orig[i][1].data) for i in range(len(p_km)) if not is_ignored(p_km[i][0], p_km[i][1])]
+    run_layer_jobs(_bias_correction_job, jobs, workers)
 
     model_path = model_path.split('.')[0] + '_bcorr.pt'
     print("Saving quantized model with bias correction to %s" % model_path)
-    torch.save(model_bcorr, model_path)
+    save_model(model_bcorr, model_path, arch, fmt)
 
 
 model_names = sorted(name for name in models.__dict__
@@ -104,6 +177,10 @@ parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
 parser.add_argument('-bits', '--num_bits', default=4, type=int,
                     help='Number of bits for quantization')
 parser.add_argument('-t', '--task', default='quantize', help='[quantize, clip]')
+parser.add_argument('-j', '--workers', default=1, type=int,
+                    help='Number of processes for per layer clustering and bias correction (default: 1, sequential)')
+parser.add_argument('-f', '--format', default='codebook', help='Saved model format [codebook, full]. '
+                    'codebook - per layer/channel codebook and packed indices, load with codebook.load_codebook_model')
 args = parser.parse_args()
 
 
@@ -111,5 +188,5 @@ if __name__ == '__main__':
     home = str(Path.home())
     base_dir = os.path.join(home, 'mxt-sim')
     print('%s %s model to %d bits' % (args.task, args.arch, args.num_bits))
-    process_model(args.arch, num_bits=args.num_bits, base_dir=base_dir, task=args.task)
+    process_model(args.arch, num_bits=args.num_bits, base_dir=base_dir, task=args.task, fmt=args.format, workers=args.workers)
     print('Done')
@@ -1,2 +1,2 @@
 from .int_quantizer import int_quantizer
-
+from .float_quantizer import bfloat_quantizer, half_quantizer, fp_quantizer
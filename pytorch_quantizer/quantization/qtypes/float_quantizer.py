@@ -0,0 +1,109 @@
+import torch
+import re
+from pytorch_quantizer.quantization.inference.statistic_manager import StatisticManager
+try:
+    import float_quantization
+    cpu_kernel_available = True
+except ImportError:
+    cpu_kernel_available = False
+
+
+def float_max(exp_bits, man_bits, ieee=True):
+    # Largest finite value. IEEE like formats reserve top exponent for inf/nan,
+    # otherwise (fp8 e4m3) only all ones mantissa of top exponent is reserved for nan.
+    bias = 2 ** (exp_bits - 1) - 1
+    if ieee:
+        return (2 - 2. ** -man_bits) * 2. ** (2 ** exp_bits - 2 - bias)
+    else:
+        return (2 - 2. ** (1 - man_bits)) * 2. ** (2 ** exp_bits - 1 - bias)
+
+
+def float_truncate(tensor, exp_bits, man_bits, max_value, out=None):
+    # Round to nearest even representable value, subnormals included, saturate out of range values
+    if not tensor.is_cuda and cpu_kernel_available and tensor.dtype == torch.float32 and tensor.is_contiguous():
+        if out is None:
+            return float_quantization.float2float(tensor, exp_bits, man_bits, max_value)
+        return float_quantization.float2float_out(tensor, out, exp_bits, man_bits, max_value)
+
+    bias = 2 ** (exp_bits - 1) - 1
+    _, e = torch.frexp(tensor)
+    e = torch.clamp(e - 1, min=1 - bias)
+    step = torch.ldexp(torch.ones_like(tensor), e - man_bits)
+    output = torch.div(tensor, step, out=out)
+    return output.round_().mul_(step).clamp_(-max_value, max_value)
+
+
+class FloatQuantizer:
+    def __init__(self, exp_bits, man_bits, params, ieee=True):
+        self.exp_bits = exp_bits
+        self.man_bits = man_bits
+        self.num_bits = 1 + exp_bits + man_bits
+        self.max_value = float_max(exp_bits, man_bits, ieee)
+        # Per tensor scaling maps max abs value of the tensor to max value of the format
+        self.scaling = params['scaling'] if 'scaling' in params else 'max'
+        self.stats_kind = params['stats_kind'] if 'stats_kind' in params else 'mean'
+        self.sm = StatisticManager
+        self.force_positive = False
+        self.half_range = False
+        self.last_path = None
+
+    def __call__(self, tensor, tag="", stat_id=None, override_att=None, inplace=False):
+        if override_att is not None:
+            orig_att = getattr(self, override_att[0])
+            setattr(self, override_att[0], override_att[1])
+
+        if self.scaling == 'max':
+            self.last_path = 'float_scaled'
+            res = self.floatScaledQuantize(tensor, tag, stat_id, inplace=inplace)
+        else:
+            self.last_path = 'float'
+            t = tensor.detach()
+            res = float_truncate(t, self.exp_bits, self.man_bits, self.max_value, out=t if inplace else None)
+
+        if override_att is not None:
+            setattr(self, override_att[0], orig_att)
+        return res
+
+    def __repr__(self):
+        return 'FloatQuantizer - [bits: {}, exp: {}, mantissa: {}, max: {}, scaling: {}, kind: {}]'\
+            .format(self.num_bits, self.exp_bits, self.man_bits, self.max_value, self.scaling, self.stats_kind)
+
+    def get_max_abs(self, tensor, stat_id=None):
+        if stat_id is not None:
+            kind = 'mean' if self.stats_kind == 'mean' else 'min'
+            min_ = self.sm().get_tensor_stat(stat_id, 'min', kind)
+            kind = 'mean' if self.stats_kind == 'mean' else 'max'
+            max_ = self.sm().get_tensor_stat(stat_id, 'max', kind)
+            return max(abs(float(min_)), abs(float(max_)))
+        else:
+            return tensor.detach().abs().max()
+
+    def floatScaledQuantize(self, tensor, tag="", stat_id=None, inplace=False):
+        max_abs = self.get_max_abs(tensor, stat_id)
+        scale = self.max_value / torch.clamp(torch.as_tensor(max_abs, dtype=tensor.dtype, device=tensor.device),
+                                             min=1e-12)
+        t = tensor.detach()
+        output = torch.mul(t, scale, out=t if inplace else None)
+        output = float_truncate(output, self.exp_bits, self.man_bits, self.max_value, out=output)
+        return output.div_(scale)
+
+
+def bfloat_quantizer(qtype, quant_params):
+    # bfloat[N] - 8 bit exponent, N - 9 bit mantissa
+    size = int(qtype[len('bfloat'):]) if len(qtype) > len('bfloat') else 16
+    return FloatQuantizer(8, size - 9, quant_params)
+
+
+def half_quantizer(qtype, quant_params):
+    return FloatQuantizer(5, 10, quant_params)
+
+
+def fp_quantizer(qtype, quant_params):
+    # fp[N]e[E]m[M], e.g. fp8e4m3, fp8e5m2. fp8e4m3 follows e4m3fn without infinities.
+    m = re.match(r'fp(\d+)e(\d+)m(\d+)$', qtype)
+    if m is None:
+        raise ValueError('Invalid float type %s, expected fp[N]e[E]m[M]' % qtype)
+    size, exp_bits, man_bits = [int(g) for g in m.groups()]
+    if size != 1 + exp_bits + man_bits:
+        raise ValueError('Invalid float type %s, bits do not sum up to %d' % (qtype, size))
+    return FloatQuantizer(exp_bits, man_bits, quant_params, ieee=not (exp_bits == 4 and man_bits == 3))
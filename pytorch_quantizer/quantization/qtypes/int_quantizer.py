@@ -4,6 +4,7 @@ import numpy as np
 import int_quantization
 import math
 from utils.monitor import Monitor
+from pytorch_quantizer.clipping import aciq
 from pytorch_quantizer.quantization.inference.statistic_manager import StatisticManager
 from pytorch_quantizer.quantization.inference.statistic_manager_perchannel import StatisticManagerPerChannel
 
@@ -20,6 +21,9 @@ from pytorch_quantizer.quantization.inference.statistic_manager_perchannel impor
 def to_cuda(t, device):
     if isinstance(t, torch.Tensor):
         return t.to(device)
+    elif np.ndim(t) == 0:
+        # Fill scalar on device instead of copying it from host
+        return torch.full((), float(t), dtype=torch.float32, device=device)
     else:
         return torch.tensor(t, dtype=torch.float32).to(device)
 
@@ -31,10 +35,18 @@ def to_numpy(tensor):
 
 count = 0
 class IntQuantizer(Function):
+    # Random stream position shared by all quantizers, so every call draws fresh stochastic rounding noise
+    rng_offset = 0
+    generators = {}
+    # Half range (before relu) activations are quantized with zero offset, negative values are clamped to zero
+    clamps_half_range = True
+
     def __init__(self, size, params):
         self.num_bits = size
+        self.stochastic = params['stochastic'] if 'stochastic' in params else False
+        seed = params['seed'] if 'seed' in params else None
+        self.seed = seed if seed is not None else torch.initial_seed()
         # TODO: expose as cmd line parameters
-        self.stochastic = False
         self.int_exp = False
         self.enforce_true_zero = True #params['true_zero']
         self.clipping = params['clipping'] if 'clipping' in params else 'no'
@@ -50,35 +62,41 @@ class IntQuantizer(Function):
         self.bit_alloc_round = params['bit_alloc_rmode'] == 'round'
         self.bit_alloc_prior = params['bit_alloc_prior']
 
-        self.alpha_gaus = {1 : 1.24, 2: 1.71, 3: 2.15, 4: 2.55, 5: 2.93, 6: 3.28, 7: 3.61, 8: 3.92}
-        self.alpha_gaus_positive = {1 : 1.71, 2: 2.15, 3: 2.55, 4: 2.93, 5: 3.28, 6: 3.61, 7: 3.92, 8: 4.2}
-
-        self.alpha_laplace = {0 : 1.05, 1 : 1.86, 2: 2.83, 3: 3.89, 4: 5.03, 5: 6.2, 6: 7.41, 7: 8.64, 8: 9.89}
-        self.alpha_laplace_positive = {0 : 1.86, 1 : 2.83, 2: 3.89, 3: 5.02, 4: 6.2, 5: 7.41, 6: 8.64, 7: 9.89, 8: 11.16}
+        # Optimal clipping coefficients for any bit width, solved numerically from the mse formulas
+        self.alpha_gaus, self.alpha_gaus_positive = aciq.aciq_tables('gaus')
+        self.alpha_laplace, self.alpha_laplace_positive = aciq.aciq_tables('laplace')
+        self.alpha_exp, self.alpha_exp_positive = aciq.aciq_tables('exp')
 
         self.gaussian_const = (0.5 * 0.35) * (1 + (math.pi * math.log(4)) ** 0.5)
         self.sm = StatisticManagerPerChannel if params['pcq_act'] else StatisticManager
         self.force_positive = False
         self.half_range = False
+        self.last_path = None
 
-    def __call__(self, tensor, tag="", stat_id=None, override_att=None):
+    def __call__(self, tensor, tag="", stat_id=None, override_att=None, inplace=False):
+        # inplace - tensor is not used after quantization, its buffer may be reused for the result
         if override_att is not None:
             orig_att = getattr(self, override_att[0])
             setattr(self, override_att[0], override_att[1])
         if self.kld:
-            res = self.gemmlowpKldQuantize(tensor, tag, stat_id=stat_id)
+            self.last_path = 'kld'
+            res = self.gemmlowpKldQuantize(tensor, tag, stat_id=stat_id, inplace=inplace)
         elif self.clipping != 'no':
             # print("clipping %s: %d" % (tag, self.num_bits))
-            res = self.gemmlowpClippingQuantize(tensor, tag, stat_id=stat_id, clip_type=self.clipping)
+            self.last_path = 'clipping_%s' % self.clipping
+            res = self.gemmlowpClippingQuantize(tensor, tag, stat_id=stat_id, clip_type=self.clipping, inplace=inplace)
         elif self.pcq_w:
             # print("pcq_w %s: %d" % (tag, self.num_bits))
-            res = self.gemmlowpQuantizeWeightsPerChannel(tensor)
+            self.last_path = 'pcq_w'
+            res = self.gemmlowpQuantizeWeightsPerChannel(tensor, inplace=inplace)
         elif self.pcq_a and len(tensor.shape) > 3 and (tensor.shape[2] > 1 or tensor.shape[3] > 1):
             # print("pcq_a %s: %d" % (tag, self.num_bits))
-            res = self.gemmlowpQuantizeActivationPerChannel(tensor, tag, stat_id=stat_id)
+            self.last_path = 'pcq_a'
+            res = self.gemmlowpQuantizeActivationPerChannel(tensor, tag, stat_id=stat_id, inplace=inplace)
         else:
             # print("no clipping %s: %d" % (tag, self.num_bits))
-            res = self.gemmlowpMinMaxQuantize(tensor, tag, stat_id=stat_id)
+            self.last_path = 'minmax'
+            res = self.gemmlowpMinMaxQuantize(tensor, tag, stat_id=stat_id, inplace=inplace)
 
         if override_att is not None:
             setattr(self, override_att[0], orig_att)
@@ -108,8 +126,8 @@ class IntQuantizer(Function):
                 else:
                     std = self.__act_stats__(tensor, [prior], avg_over_batch=False)[prior]
             bit_alloc = self.get_bits_alloc(std, self.num_bits, self.bit_alloc_round)
-            aciq_factor = np.array([(self.alpha_laplace_positive[nbit.item()] if (self.force_positive or self.half_range) else self.alpha_laplace[nbit.item()]) for nbit in bit_alloc])
-            aciq_factor = to_cuda(aciq_factor, tensor.device)
+            table = self.alpha_laplace_positive if (self.force_positive or self.half_range) else self.alpha_laplace
+            aciq_factor = table.gather(bit_alloc, b.dtype if torch.is_tensor(b) else None)
         else:
             aciq_factor = (self.alpha_laplace_positive[self.num_bits] if (self.force_positive or self.half_range) else self.alpha_laplace[self.num_bits])
 
@@ -134,6 +152,9 @@ class IntQuantizer(Function):
         return self.alpha_exp[self.num_bits] * mean_abs
 
     def alpha2DeltaOffset(self, alpha, max_value, min_value, mean, clip2max=False):
+        if isinstance(alpha, torch.Tensor):
+            return self.__alpha2DeltaOffsetDevice(alpha, max_value, min_value, mean, clip2max)
+
         alpha = to_numpy(alpha)
         max_value = to_numpy(max_value)
         min_value = to_numpy(min_value)
@@ -151,6 +172,24 @@ class IntQuantizer(Function):
 
         return delta, offset
 
+    def __alpha2DeltaOffsetDevice(self, alpha, max_value, min_value, mean, clip2max=False):
+        # Same as alpha2DeltaOffset for statistics computed on the fly, keeps everything on device
+        max_value = to_cuda(max_value, alpha.device)
+        min_value = to_cuda(min_value, alpha.device)
+        mean = to_cuda(mean, alpha.device)
+        if self.force_positive or self.half_range:
+            delta = torch.clamp(mean, min=0) + alpha
+            if clip2max:
+                delta = torch.min(delta, max_value)
+            offset = torch.zeros_like(delta)
+        else:
+            delta = 2 * alpha
+            if clip2max:
+                delta = torch.min(delta, max_value - min_value)
+            offset = torch.max(min_value, mean - alpha)
+
+        return delta, offset
+
     def get_alpha(self, tensor, tag="", stat_id=None, clip_type='laplace', per_channel=False):
         if clip_type == 'laplace':
             alpha = self.get_alpha_laplace(tensor, stat_id, per_channel=per_channel)  # laplace clipping
@@ -174,7 +213,7 @@ class IntQuantizer(Function):
         return alpha
 
 
-    def gemmlowpClippingQuantize(self, tensor, tag="", stat_id=None, clip_type='laplace'):
+    def gemmlowpClippingQuantize(self, tensor, tag="", stat_id=None, clip_type='laplace', inplace=False):
         if stat_id is not None:
             min_value = self.sm().get_tensor_stat(stat_id, 'min', 'mean')
             max_value = self.sm().get_tensor_stat(stat_id, 'max', 'mean')
@@ -199,16 +238,16 @@ class IntQuantizer(Function):
             min_value = to_cuda(min_value, tensor.device)
             range = to_cuda(range, tensor.device)
             max_ = min_value + range
-            res = self.gemmlowpQuantizeActivationPerChannel(tensor.contiguous(), tag, stat_id, min_=min_value, max_=max_)
+            res = self.gemmlowpQuantizeActivationPerChannel(tensor, tag, stat_id, min_=min_value, max_=max_, inplace=inplace)
         else:
             alpha = self.get_alpha(tensor, tag, stat_id, clip_type, per_channel=False)
-            max_value = float(max_value); min_value = float(min_value); mean = float(mean); alpha = float(alpha)
             range, min_value = self.alpha2DeltaOffset(alpha, max_value, min_value, mean)
-            res = self.__gemmlowpQuantize1__(tensor.contiguous(), to_cuda(range, tensor.device), to_cuda(min_value, tensor.device))
+            res = self.__gemmlowpQuantize1__(tensor, to_cuda(range, tensor.device), to_cuda(min_value, tensor.device),
+                                             inplace=inplace)
 
         return res
 
-    def gemmlowpMinMaxQuantize(self, tensor, tag="", stat_id=None):
+    def gemmlowpMinMaxQuantize(self, tensor, tag="", stat_id=None, inplace=False):
         if stat_id is not None:
             if self.stats_kind == 'mean':
                 kind = {'min': 'mean', 'max': 'mean', 'mean': 'mean', 'std': 'mean', 'mean_abs': 'mean', 'b': 'mean'}
@@ -226,7 +265,7 @@ class IntQuantizer(Function):
         if self.force_positive or self.half_range:
             min_ = 0
 
-        return self.__gemmlowpQuantize__(tensor, max_ - min_, min_)
+        return self.__gemmlowpQuantize__(tensor, max_ - min_, min_, inplace=inplace)
 
     @staticmethod
     def get_bits_alloc(alpha, num_bits, round=False):
@@ -236,11 +275,11 @@ class IntQuantizer(Function):
         # Calculate bit allocation
         p = alpha ** (2 / 3)
         bin_alloc = (B * p) / p.sum()
-        bin_alloc[bin_alloc < 1] = 2
+        bin_alloc = bin_alloc.masked_fill(bin_alloc < 1, 2)
         bit_alloc = torch.round(torch.log2(bin_alloc)) if round else torch.ceil(torch.log2(bin_alloc))
         return bit_alloc
 
-    def gemmlowpQuantizeActivationPerChannel(self, tensor, tag="", stat_id=None, min_=None, max_=None):
+    def gemmlowpQuantizeActivationPerChannel(self, tensor, tag="", stat_id=None, min_=None, max_=None, inplace=False):
         if min_ is None:
             if self.force_positive or self.half_range:
                 min_ = 0  # np.zeros(min_.shape)
@@ -257,10 +296,6 @@ class IntQuantizer(Function):
                 max_ = self.__act_stats_perchannel__(tensor, ['max'], avg_over_batch=False)['max']
         max_ = to_cuda(max_, tensor.device)
 
-        N, C, H, W = tensor.shape  # N x C x H x W
-        t = tensor.detach().transpose(0, 1).contiguous()  # C x N x H x W
-        t = t.view(t.shape[0], -1)
-
         if self.bit_alloc_act and self.num_bits <= 4:
             prior = 'std' if self.bit_alloc_prior == 'gaus' else 'b'
             if stat_id is not None:
@@ -273,11 +308,10 @@ class IntQuantizer(Function):
         else:
             bit_alloc = None
 
-        output = self.__gemmlowpQuantize1__(t, max_ - min_, min_, bit_alloc=bit_alloc)
-        output = output.view(C, N, H, W).transpose(0, 1).contiguous()  # N x C x H x W
-        return output.view(tensor.shape)
+        # Per channel parameters are broadcasted along channels, N x C x H x W layout is kept
+        return self.__gemmlowpQuantize1__(tensor, max_ - min_, min_, bit_alloc=bit_alloc, channel_dim=1, inplace=inplace)
 
-    def gemmlowpQuantizeWeightsPerChannel(self, tensor, min_=None, max_=None):
+    def gemmlowpQuantizeWeightsPerChannel(self, tensor, min_=None, max_=None, inplace=False):
         # Assume weights with dimensions [OFM,IFM,K1,K2]
         t = tensor.view(tensor.shape[0], -1)
 
@@ -293,11 +327,11 @@ class IntQuantizer(Function):
         else:
             bit_alloc = None
 
-        output = self.__gemmlowpQuantize1__(t, max_ - min_, min_, bit_alloc=bit_alloc)
+        output = self.__gemmlowpQuantize1__(t, max_ - min_, min_, bit_alloc=bit_alloc, channel_dim=0, inplace=inplace)
 
         return output.view(tensor.shape)
 
-    def gemmlowpKldQuantize(self, tensor, tag="", stat_id=None):
+    def gemmlowpKldQuantize(self, tensor, tag="", stat_id=None, inplace=False):
         min_ = self.sm().get_tensor_stat(stat_id, 'min', 'mean')
         max_ = self.sm().get_tensor_stat(stat_id, 'max', 'mean')
         kld_th = self.sm().get_tensor_stat(stat_id, 'kld_th', 'mean')
@@ -305,27 +339,16 @@ class IntQuantizer(Function):
 
         range, offset = self.alpha2DeltaOffset(kld_th, max_, min_, mean)
 
-        return self.__gemmlowpQuantize__(tensor, range, offset)
+        return self.__gemmlowpQuantize__(tensor, range, offset, inplace=inplace)
 
 
     def symlowpQuantize(self, tensor):
         maxabs = torch.max(tensor.detach().abs())
         return self.__symlowpQuantize__(tensor, maxabs)
 
-    @staticmethod
-    def mse_laplace(b, alpha, num_bits):
-        return 2 * (b ** 2) * np.exp(-alpha / b) + ((alpha ** 2) / (3 * 2 ** (2 * num_bits)))
-
-    @staticmethod
-    def mse_exponential(mean_abs, alpha, num_bits):
-        return 2 * (mean_abs ** 2) * np.exp(-alpha / mean_abs) + ((alpha ** 2) / (3 * 2 ** (2 * num_bits)))
-
-    @staticmethod
-    def mse_gaus(sigma, alpha, num_bits):
-        clipping_err = (sigma ** 2 + (alpha ** 2)) * (1 - math.erf(alpha / (sigma * np.sqrt(2.0)))) - \
-                       np.sqrt(2.0 / np.pi) * alpha * sigma * (np.e ** ((-1) * (0.5 * (alpha ** 2)) / sigma ** 2))
-        quant_err = (alpha ** 2) / (3 * (2 ** (2 * num_bits)))
-        return clipping_err + quant_err
+    mse_laplace = staticmethod(aciq.mse_laplace)
+    mse_exponential = staticmethod(aciq.mse_exponential)
+    mse_gaus = staticmethod(aciq.mse_gaus)
 
     @staticmethod
     def __act_stats__(tensor, stats, avg_over_batch=False):
@@ -354,23 +377,25 @@ class IntQuantizer(Function):
     def __act_stats_perchannel__(tensor, stats, avg_over_batch=False):
         # Assume activation dimentions [N,C,H,W]
         if not avg_over_batch:
-            t = tensor.transpose(0, 1).contiguous()  # [C, N, H, W]
-            t = t.view(t.shape[0], -1) # [C, NxHxW]
+            # reduce over [N, H, W] without transposed copy of the tensor
+            t = tensor.view(tensor.shape[0], tensor.shape[1], -1)  # [N, C, HxW]
+            dim = (0, 2)
         else:
             t = tensor.view(tensor.shape[0], tensor.shape[1], -1)  # [N, C, HxW]
+            dim = -1
 
         stats_dict = {}
         for s in stats:
             if s == 'max':
-                stats_dict[s] = t.max(dim=-1)[0]
+                stats_dict[s] = t.amax(dim=dim)
             elif s == 'min':
-                stats_dict[s] = t.min(dim=-1)[0]
+                stats_dict[s] = t.amin(dim=dim)
             elif s == 'mean':
-                stats_dict[s] = t.mean(dim=-1)
+                stats_dict[s] = t.mean(dim=dim)
             elif s == 'b':
-                stats_dict[s] = torch.mean(torch.abs(t - t.mean(dim=-1).unsqueeze(-1)), dim=-1)
+                stats_dict[s] = torch.mean(torch.abs(t - t.mean(dim=dim, keepdim=True)), dim=dim)
             elif s == 'std':
-                stats_dict[s] = torch.std(t, dim=-1, unbiased=True)
+                stats_dict[s] = torch.std(t, dim=dim, unbiased=True)
 
             if avg_over_batch:
                 stats_dict[s] = torch.mean(stats_dict[s], dim=0)
@@ -397,7 +422,7 @@ class IntQuantizer(Function):
         del res
         return mse, mse_est
 
-    def __gemmlowpQuantize1__(self, tensor, delta, offset, bit_alloc=None):
+    def __gemmlowpQuantize1__(self, tensor, delta, offset, bit_alloc=None, channel_dim=None, inplace=False):
         qmin = 0.
         if bit_alloc is None:
             qmax = 2.**self.num_bits - 1.
@@ -406,54 +431,88 @@ class IntQuantizer(Function):
         #import pdb; pdb.set_trace()
         scale = (delta) / (qmax - qmin)
 
-        scale = torch.max(scale, torch.tensor([1e-8]).to(scale.device))
+        scale = torch.clamp(scale, min=1e-8)
+
+        def per_channel(p):
+            # Broadcast per channel parameter along channel_dim of tensor
+            if channel_dim is None or not isinstance(p, torch.Tensor) or p.dim() == 0:
+                return p
+            shape = [1] * tensor.dim()
+            shape[channel_dim] = -1
+            return p.view(shape)
 
+        scale = per_channel(scale)
+        offset = per_channel(offset)
+
+        # Single output buffer, or none if tensor may be overwritten
         output = tensor.detach()
+        out = output if inplace else torch.empty_like(output)
         if self.enforce_true_zero:
             initial_zero_point = qmin - offset / scale
             # make zero exactly represented
             zero_point = torch.round(initial_zero_point)
-            output = torch.div(output, scale.unsqueeze(-1))
-            output = torch.add(output, zero_point.unsqueeze(-1))
+            output = torch.div(output, scale, out=out)
+            output.add_(zero_point)
         else:
-            output = torch.add(output, -offset.unsqueeze(-1))
-            output = torch.div(output, scale.unsqueeze(-1))
+            output = torch.sub(output, offset, out=out)
+            output.div_(scale)
+
+        if self.stochastic:
+            output.add_(self.__rounding_noise(output))
 
         if bit_alloc is None:
             output.clamp_(qmin, qmax).round_()  # quantize
         else:
-            qmax = qmax.view(qmax.numel(), 1)
-            output = torch.where(output.gt(qmax), qmax, output)
+            output = torch.min(output, per_channel(qmax), out=output)
             output.clamp_(qmin).round_()
 
         if self.enforce_true_zero:
-            output = torch.add(output, -zero_point.unsqueeze(-1))
-            output = torch.mul(output, scale.unsqueeze(-1))  # dequantize
-        else:
-            output = torch.mul(output, scale.unsqueeze(-1))
-            output = torch.add(output, offset.unsqueeze(-1))  # dequantize
-
-        return output.view(tensor.shape)
-
-    def __gemmlowpQuantize__(self, tensor, delta, offset):
-        if self.stochastic:
-            # Generate noise for stochastic rounding
-            noise = tensor.new(tensor.shape).uniform_(-0.5, 0.5)
+            output.sub_(zero_point).mul_(scale)  # dequantize
         else:
-            noise = torch.cuda.FloatTensor(tensor.shape).fill_(0)
+            output.mul_(scale).add_(offset)  # dequantize
+
+        return output
+
+    def __rounding_noise(self, tensor):
+        # Uniform noise for stochastic rounding of pytorch ops path, seeded generator per device
+        if tensor.device not in IntQuantizer.generators:
+            g = torch.Generator(tensor.device)
+            g.manual_seed(self.seed)
+            IntQuantizer.generators[tensor.device] = g
+        return torch.empty_like(tensor).uniform_(-0.5, 0.5, generator=IntQuantizer.generators[tensor.device])
+
+    def __rng_state(self, tensor):
+        # Seed and offset of philox generator inside kernels, offset advances by number of drawn values
+        if not self.stochastic:
+            return self.seed, 0
+        offset = IntQuantizer.rng_offset
+        IntQuantizer.rng_offset += tensor.numel()
+        return self.seed, offset
+
+    def __gemmlowpQuantize__(self, tensor, delta, offset, inplace=False):
+        seed, rng_offset = self.__rng_state(tensor)
+        tensor = tensor.detach().contiguous()
+        out = tensor if inplace else torch.empty_like(tensor)
+        if isinstance(delta, torch.Tensor) or isinstance(offset, torch.Tensor):
+            # Range and offset stay on device, zero point and range checks are done by the kernel
+            delta = to_cuda(delta, tensor.device)
+            offset = to_cuda(offset, tensor.device)
+            return int_quantization.float2gemmlowp_dynamic_out(tensor, out, delta, offset, self.num_bits,
+                                                               self.int_exp, self.enforce_true_zero,
+                                                               self.stochastic, seed, rng_offset)
 
         # if enforce_true_zero and zero in range
         preserve_zero = self.enforce_true_zero and (offset + delta) > 0 and offset < 0
-        return int_quantization.float2gemmlowp(tensor.contiguous(), delta, offset, self.num_bits, self.int_exp, preserve_zero, noise)
-
-    def __symlowpQuantize__(self, tensor, maxabs):
-        if self.stochastic:
-            # Generate noise for stochastic rounding
-            noise = tensor.new(tensor.shape).uniform_(-0.5, 0.5)
-        else:
-            noise = torch.cuda.FloatTensor(tensor.shape).fill_(0)
-
-        return int_quantization.float2symlowp(tensor.contiguous(), maxabs, self.num_bits, self.int_exp, noise)
+        return int_quantization.float2gemmlowp_out(tensor, out, delta, offset, self.num_bits, self.int_exp, preserve_zero,
+                                                   self.stochastic, seed, rng_offset)
+
+    def __symlowpQuantize__(self, tensor, maxabs, inplace=False):
+        seed, rng_offset = self.__rng_state(tensor)
+        maxabs = to_cuda(maxabs, tensor.device)
+        tensor = tensor.detach().contiguous()
+        out = tensor if inplace else torch.empty_like(tensor)
+        return int_quantization.float2symlowp_out(tensor, out, maxabs, self.num_bits, self.int_exp,
+                                                  self.stochastic, seed, rng_offset)
 
 
 def int_quantizer(qtype, quant_params):
@@ -1,40 +1,85 @@
 import torch
 import torch.nn as nn
+from utils.tracing import call_counts, trace
 
 def absorb_bn(module, bn_module):
+    # Works on any device and dtype, weight of conv (any groups) or linear is scaled per output channel
     w = module.weight.data
     if module.bias is None:
-        zeros = torch.Tensor(module.out_channels).zero_().type(w.type())
-        module.bias = nn.Parameter(zeros)
+        module.bias = nn.Parameter(torch.zeros(w.size(0), dtype=w.dtype, device=w.device))
     b = module.bias.data
     invstd = bn_module.running_var.clone().add_(bn_module.eps).pow_(-0.5)
-    w.mul_(invstd.view(w.size(0), 1, 1, 1).expand_as(w))
+    shape = (w.size(0),) + (1,) * (w.dim() - 1)
+    w.mul_(invstd.view(shape))
     b.add_(-bn_module.running_mean).mul_(invstd)
 
     if bn_module.affine:
-        w.mul_(bn_module.weight.data.view(w.size(0), 1, 1, 1).expand_as(w))
+        w.mul_(bn_module.weight.data.view(shape))
         b.mul_(bn_module.weight.data).add_(bn_module.bias.data)
 
-    bn_module.register_buffer('running_mean', torch.zeros(module.out_channels).cuda())
-    bn_module.register_buffer('running_var', torch.ones(module.out_channels).cuda())
-    bn_module.register_parameter('weight', None)
-    bn_module.register_parameter('bias', None)
-    bn_module.affine = False
-
 
 def is_bn(m):
     return isinstance(m, nn.BatchNorm2d) or isinstance(m, nn.BatchNorm1d)
 
 
 def is_absorbing(m):
-    return (isinstance(m, nn.Conv2d) and m.groups == 1) or isinstance(m, nn.Linear)
+    return isinstance(m, nn.Conv2d) or isinstance(m, nn.Linear)
 
 
-def search_absorbe_bn(model):
+def can_absorb(m, bn):
+    return is_absorbing(m) and is_bn(bn) and bn.track_running_stats and bn.running_var is not None and \
+           bn.num_features == m.weight.size(0) and (isinstance(m, nn.Conv2d) == isinstance(bn, nn.BatchNorm2d))
+
+
+def remove_module(model, name):
+    # Folded BN is removed from Sequential, modules calling it by attribute get identity
+    parent_name, _, child = name.rpartition('.')
+    parent = dict(model.named_modules())[parent_name]
+    if isinstance(parent, nn.Sequential):
+        del parent._modules[child]
+    else:
+        setattr(parent, child, nn.Identity())
+
+
+def traced_pairs(model):
+    """(module, bn) names where bn is the only consumer of module output, from traced graph. None if tracing fails"""
+    graph = trace(model)
+    if graph is None:
+        return None
+    modules = dict(model.named_modules())
+    calls = call_counts(graph)
+    pairs = []
+    for node in graph.nodes:
+        if node.op != 'call_module' or not is_bn(modules[node.target]) or len(node.args) != 1:
+            continue
+        prev = node.args[0]
+        if hasattr(prev, 'op') and prev.op == 'call_module' and len(prev.users) == 1 and \
+                calls[prev.target] == 1 and calls[node.target] == 1 and \
+                can_absorb(modules[prev.target], modules[node.target]):
+            pairs.append((prev.target, node.target))
+    return pairs
+
+
+def sibling_pairs(model, prefix=''):
+    # Fallback for models that can not be traced: bn right after module among children of the same parent
+    pairs = []
     prev = None
-    for m in model.children():
-        if is_bn(m) and is_absorbing(prev):
-            m.absorbed = True
-            absorb_bn(prev, m)
-        search_absorbe_bn(m)
-        prev = m
+    for name, m in model.named_children():
+        if prev is not None and can_absorb(prev[1], m):
+            pairs.append((prev[0], prefix + name))
+        pairs += sibling_pairs(m, prefix + name + '.')
+        prev = (prefix + name, m)
+    return pairs
+
+
+def search_absorbe_bn(model):
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    pairs = traced_pairs(model)
+    if pairs is None:
+        pairs = sibling_pairs(model)
+    modules = dict(model.named_modules())
+    for name, bn_name in pairs:
+        absorb_bn(modules[name], modules[bn_name])
+        remove_module(model, bn_name)
+    return len(pairs)
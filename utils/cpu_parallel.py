@@ -0,0 +1,74 @@
+import os
+import queue as queue_
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def split_cores(workers):
+    # Contiguous groups of the cores available to this process, one group per worker
+    cores = sorted(os.sched_getaffinity(0))
+    workers = min(workers, len(cores))
+    return [[int(c) for c in g] for g in np.array_split(cores, workers)]
+
+
+def shard_range(num_samples, workers, rank, align=1):
+    # Contiguous shard of [0, num_samples), boundaries aligned to multiples of align (e.g. batch size)
+    num_chunks = (num_samples + align - 1) // align
+    start = (num_chunks * rank // workers) * align
+    end = min((num_chunks * (rank + 1) // workers) * align, num_samples)
+    return start, end
+
+
+def _worker(fn, rank, cores, queue):
+    try:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        queue.put((rank, fn(rank), None))
+    except Exception:
+        queue.put((rank, None, traceback.format_exc()))
+
+
+def run_cpu_parallel(fn, workers, poll_interval=5.):
+    """
+    Run fn(rank) for rank in [0, workers) in forked processes, each pinned to its own group of cores with
+    intra op threads set accordingly. State of the parent (e.g. prepared model, managers) is inherited by fork,
+    tensors moved to shared memory before the call are not copied. Returns results ordered by rank.
+    Raises if a worker fails or dies without posting its result.
+    """
+    groups = split_cores(workers)
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+    # Not daemonic, workers may start data loading processes
+    procs = [ctx.Process(target=_worker, args=(fn, rank, cores, queue)) for rank, cores in enumerate(groups)]
+    for p in procs:
+        p.start()
+    results = {}
+    errors = []
+    try:
+        while len(results) < len(procs):
+            # Exit codes are checked before polling, result of a worker that exited before the poll is already
+            # in the queue. Worker killed (e.g. by oom killer or segfault) exits without posting a result.
+            dead = [r for r, p in enumerate(procs) if r not in results and p.exitcode is not None]
+            try:
+                rank, res, err = queue.get(timeout=poll_interval)
+            except queue_.Empty:
+                if len(dead) > 0:
+                    raise RuntimeError('CPU parallel evaluation failed, ' + ', '.join(
+                        ['worker %d exited with code %d without result' % (r, procs[r].exitcode) for r in dead]))
+                continue
+            results[rank] = res
+            if err is not None:
+                errors.append('worker %d:\n%s' % (rank, err))
+    except BaseException:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        raise
+    finally:
+        for p in procs:
+            p.join()
+    if len(errors) > 0:
+        raise RuntimeError('CPU parallel evaluation failed\n' + '\n'.join(errors))
+    return [results[r] for r in range(len(procs))]
@@ -31,23 +31,44 @@ class LimitDataset(Dataset):
     def __getitem__(self, index):
         return self.dset[index]
 
+def dataset_targets(ds):
+    """Labels of all samples from dataset metadata, without loading the samples when possible"""
+    if hasattr(ds, 'targets'):
+        return [int(t) for t in ds.targets]
+    if hasattr(ds, 'samples'):
+        return [int(t) for _, t in ds.samples]
+    if isinstance(ds, torch.utils.data.TensorDataset):
+        return ds.tensors[1].tolist()
+    if isinstance(ds, torch.utils.data.Subset):
+        targets = dataset_targets(ds.dataset)
+        return [targets[i] for i in ds.indices]
+    if isinstance(ds, LimitDataset):
+        return dataset_targets(ds.dset)[:len(ds)]
+    # Unknown dataset, labels are read by loading every sample
+    return [int(c) for _, c in ds]
+
+
+def indices_by_class(ds):
+    idx_by_class = {}
+    for idx, c in enumerate(dataset_targets(ds)):
+        idx_by_class.setdefault(c, [])
+        idx_by_class[c].append(idx)
+    return idx_by_class
+
+
 class ByClassDataset(Dataset):
 
     def __init__(self, ds):
         self.dataset = ds
-        self.idx_by_class = {}
-        for idx, (_, c) in enumerate(ds):
-            self.idx_by_class.setdefault(c, [])
-            self.idx_by_class[c].append(idx)
+        self.idx_by_class = indices_by_class(ds)
+        self.classes = sorted(self.idx_by_class.keys())
 
     def __len__(self):
         return min([len(d) for d in self.idx_by_class.values()])
 
     def __getitem__(self, idx):
-        idx_per_class = [self.idx_by_class[c][idx]
-                         for c in range(len(self.idx_by_class))]
-        labels = torch.LongTensor([self.dataset[i][1]
-                                   for i in idx_per_class])
+        idx_per_class = [self.idx_by_class[c][idx] for c in self.classes]
+        labels = torch.LongTensor(self.classes)
         items = [self.dataset[i][0] for i in idx_per_class]
         if torch.is_tensor(items[0]):
             items = torch.stack(items)
@@ -55,6 +76,39 @@ class ByClassDataset(Dataset):
         return (items, labels)
 
 
+class StratifiedSampler(torch.utils.data.sampler.Sampler):
+    """
+    Class balanced random subset of num_samples (default: all samples), seeded.
+    Classes are interleaved, so any prefix of the order (e.g. calibration set of first batches) is balanced too.
+    Built from dataset labels only, no samples are loaded.
+    """
+
+    def __init__(self, data_source, num_samples=None, seed=0):
+        g = torch.Generator().manual_seed(seed)
+        idx_by_class = indices_by_class(data_source)
+        classes = sorted(idx_by_class.keys())
+        per_class = [[idx_by_class[c][i] for i in torch.randperm(len(idx_by_class[c]), generator=g).tolist()]
+                     for c in classes]
+        total = sum([len(p) for p in per_class])
+        self.num_samples = total if num_samples is None else min(num_samples, total)
+
+        self.order = []
+        for r in range(max([len(p) for p in per_class])):
+            # Random order of classes in every round, classes that ran out of samples are skipped
+            for c in torch.randperm(len(classes), generator=g).tolist():
+                if r < len(per_class[c]):
+                    self.order.append(per_class[c][r])
+            if len(self.order) >= self.num_samples:
+                break
+        self.order = self.order[:self.num_samples]
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return self.num_samples
+
+
 class IdxDataset(Dataset):
     """docstring for IdxDataset."""
 
@@ -0,0 +1,121 @@
+import os
+import math
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_distributed(backend='gloo'):
+    # Rank, world size and master address from environment (torchrun or run_local)
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    print("Distributed rank %d of %d (%s)" % (get_rank(), get_world_size(), backend))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def gather_object(obj):
+    # List of objects of all ranks on rank 0, None on other ranks
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size() if is_main_process() else None
+    dist.gather_object(obj, out, dst=0)
+    return out
+
+
+def all_gather_object(obj):
+    # List of objects of all ranks on every rank
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def all_reduce_meters(*meters):
+    # Exact sums and counts of AverageMeters over all ranks
+    if not is_distributed():
+        return
+    t = torch.tensor([[m.sum, m.count] for m in meters], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    for m, (s, c) in zip(meters, t.tolist()):
+        m.sum = s
+        m.count = c
+        m.avg = s / c if c > 0 else 0
+
+
+def all_reduce_sum(values):
+    # Sums of list of numbers over all ranks
+    if not is_distributed():
+        return list(values)
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+
+class DistributedBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of the single process order assigned round robin to ranks: rank r gets batches r, r + world, ...
+    Every batch holds the same samples as in a single process run, so per batch statistics are identical.
+    No padding or duplicated samples. Shuffled order depends only on seed. Order can be given by sampler instead.
+    """
+    def __init__(self, data_source, batch_size, shuffle=False, seed=0, rank=None, world_size=None, sampler=None):
+        self.sampler = sampler
+        self.num_samples = len(data_source) if sampler is None else len(sampler)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        if self.sampler is not None:
+            order = list(self.sampler)
+        elif self.shuffle:
+            g = torch.Generator().manual_seed(self.seed)
+            order = torch.randperm(self.num_samples, generator=g).tolist()
+        else:
+            order = list(range(self.num_samples))
+        num_batches = int(math.ceil(self.num_samples / self.batch_size))
+        for b in range(self.rank, num_batches, self.world_size):
+            yield order[b * self.batch_size:(b + 1) * self.batch_size]
+
+    def __len__(self):
+        num_batches = int(math.ceil(self.num_samples / self.batch_size))
+        return len(range(self.rank, num_batches, self.world_size))
+
+
+def _run_local_worker(rank, fn, world_size, port, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    os.environ['RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    init_distributed()
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def run_local(fn, world_size, port=29500, args=()):
+    # Run fn(*args) in world_size local processes of one process group, for testing on a single machine
+    mp.spawn(_run_local_worker, args=(fn, world_size, port, args), nprocs=world_size, join=True)
@@ -5,10 +5,19 @@ from utils.misc import Singleton
 import os
 import shutil
 import uuid
+import queue
+import threading
+import zipfile
 
 
 class DumpManager(metaclass=Singleton):
-    def __init__(self, dump_dir=None):
+    """
+    Dumps tensors to dump_dir as <name>_<tag>.npy.
+    In async mode tensors are copied to (pinned) host buffers and handed to a background writer that stores
+    all tensors of a tag in one <tag>.npz container (np.load(path)[name]), optionally compressed.
+    Memory of pending tensors is bounded by max_queue_mb, dump blocks while the writer catches up.
+    """
+    def __init__(self, dump_dir=None, async_mode=False, compress=False, max_queue_mb=1024):
         if dump_dir is None:
             raise Exception('dump_dir must be provided')
 
@@ -19,18 +28,99 @@ class DumpManager(metaclass=Singleton):
         self.enabled = False
         self.tag = ''
 
+        self.async_mode = async_mode
+        self.compress = compress
+        self.max_bytes = max_queue_mb * 2**20
+        self.pending_bytes = 0
+        self.cv = threading.Condition()
+        self.queue = queue.Queue()
+        self.containers = {}
+        self.writer = None
+        self.error = None
+
     def __enter__(self):
         self.enabled = True
+        if self.async_mode and self.writer is None:
+            self.writer = threading.Thread(target=self.__write_loop, daemon=True)
+            self.writer.start()
         return self
 
     def __exit__(self, *args):
         self.enabled = False
+        self.flush()
 
     def set_tag(self, tag):
         self.tag = tag
 
     def dump(self, tensor, name):
         if self.enabled:
-            f = os.path.join(self.dump_dir, name + '_' + self.tag)
-            print("dumping: %s" % f)
-            np.save(f, tensor.cpu().numpy())
+            if self.async_mode:
+                self.__dump_async(tensor, name)
+            else:
+                f = os.path.join(self.dump_dir, name + '_' + self.tag)
+                print("dumping: %s" % f)
+                np.save(f, tensor.cpu().numpy())
+
+    def flush(self):
+        # Wait for all pending tensors and close containers
+        if self.writer is None:
+            return
+        self.queue.join()
+        for zf in self.containers.values():
+            zf.close()
+        self.containers.clear()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __dump_async(self, tensor, name):
+        if self.error is not None:
+            self.flush()
+        tensor = tensor.detach()
+        nbytes = tensor.numel() * tensor.element_size()
+        self.__reserve(nbytes)
+
+        # Copy is needed also on cpu since tensor may be modified in place after dump
+        event = None
+        if tensor.is_cuda:
+            host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            host.copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = tensor.clone()
+        self.queue.put((self.tag, name, host, event, nbytes))
+
+    def __reserve(self, nbytes):
+        # Backpressure, single tensor larger than the limit is still accepted when nothing is pending
+        with self.cv:
+            while self.pending_bytes > 0 and self.pending_bytes + nbytes > self.max_bytes:
+                self.cv.wait()
+            self.pending_bytes += nbytes
+
+    def __release(self, nbytes):
+        with self.cv:
+            self.pending_bytes -= nbytes
+            self.cv.notify_all()
+
+    def __container(self, tag):
+        if tag not in self.containers:
+            path = os.path.join(self.dump_dir, (tag if tag != '' else 'dump') + '.npz')
+            compression = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+            self.containers[tag] = zipfile.ZipFile(path, mode='a', compression=compression, allowZip64=True)
+        return self.containers[tag]
+
+    def __write_loop(self):
+        while True:
+            tag, name, host, event, nbytes = self.queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                with self.__container(tag).open(name + '.npy', mode='w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, host.numpy(), allow_pickle=False)
+            except Exception as e:
+                self.error = e
+            finally:
+                del host
+                self.__release(nbytes)
+                self.queue.task_done()
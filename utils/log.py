@@ -6,13 +6,7 @@ import logging.config
 from datetime import datetime
 import json
 
-
-import pandas as pd
-from bokeh.io import output_file, save, show
-from bokeh.plotting import figure
-from bokeh.layouts import column
-from bokeh.models import Div
-
+# pandas and bokeh are imported where used, they are slow to import and not needed by most runs
 try:
     import hyperdash
     HYPERDASH_AVAILABLE = True
@@ -86,6 +80,7 @@ class ResultsLog(object):
         data_format: str('csv'|'json')
             which file format to use to save the data
         """
+        import pandas as pd
         if data_format not in ResultsLog.supported_data_formats:
             raise ValueError('data_format must of the following: ' +
                              '|'.join(['{}'.format(k) for k in ResultsLog.supported_data_formats]))
@@ -129,6 +124,7 @@ class ResultsLog(object):
             resultsLog.add(epoch=epoch_num, train_loss=loss,
                            test_loss=test_loss)
         """
+        import pandas as pd
         df = pd.DataFrame([kwargs.values()], columns=kwargs.keys())
         self.results = self.results.append(df, ignore_index=True)
         if hasattr(self, 'hd_experiment'):
@@ -149,6 +145,9 @@ class ResultsLog(object):
         title: string
             title of the HTML file
         """
+        from bokeh.io import output_file, save
+        from bokeh.layouts import column
+        from bokeh.models import Div
         title = title or self.title
         if len(self.figures) > 0:
             if os.path.isfile(self.plot_path):
@@ -186,6 +185,9 @@ class ResultsLog(object):
             raise ValueError('{} isn''t a file'.format(path))
 
     def show(self, title=None):
+        from bokeh.io import show
+        from bokeh.layouts import column
+        from bokeh.models import Div
         title = title or self.title
         if len(self.figures) > 0:
             plot = column(
@@ -203,6 +205,7 @@ class ResultsLog(object):
             results.plot(x='epoch', y=['train_loss', 'val_loss'],
                          'title='Loss', 'ylabel'='loss')
         """
+        from bokeh.plotting import figure
         if not isinstance(y, list):
             y = [y]
         xlabel = xlabel or x
@@ -221,6 +224,7 @@ class ResultsLog(object):
         self.figures.append(f)
 
     def image(self, *kargs, **kwargs):
+        from bokeh.plotting import figure
         fig = figure()
         fig.image(*kargs, **kwargs)
         self.figures.append(fig)
@@ -241,6 +245,7 @@ def save_checkpoint(state, is_best, path='.', filename='checkpoint.pth.tar', sav
 
 class EvalLog:
     def __init__(self, headers, f_name=None, auto_save=False):
+        import pandas as pd
         if auto_save and f_name is None:
             raise Exception('auto_save option requires to specify file name')
 
@@ -1,8 +1,20 @@
-from torchvision.models.resnet import Bottleneck, BasicBlock
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.parallel.data_parallel import DataParallel
+from utils.tracing import call_counts, trace
+
+# Archs where every quantized activation is followed by relu, fallback if model can not be traced
+FUSED_RELU_ARCHS = ['alexnet', 'vgg16', 'vgg16_bn', 'inception_v3']
+RELU_FUNCTIONS = [F.relu, F.relu6, torch.relu, torch.relu_]
+
+
+def fused_relu_arch(arch):
+    return arch is not None and (arch in FUSED_RELU_ARCHS or 'squeezenet' in arch)
 
 
 def mark_bottlenetck_before_relu(model):
+    from torchvision.models.resnet import Bottleneck
     for m in model.children():
         if isinstance(m, Bottleneck):
             m.conv1.before_relu = True
@@ -13,6 +25,7 @@ def mark_bottlenetck_before_relu(model):
             mark_bottlenetck_before_relu(m)
 
 def mark_basicblock_before_relu(model):
+    from torchvision.models.resnet import BasicBlock
     for m in model.children():
         if isinstance(m, BasicBlock):
             m.conv1.before_relu = True
@@ -28,3 +41,42 @@ def resnet_mark_before_relu(model):
 
     mark_bottlenetck_before_relu(model)
     mark_basicblock_before_relu(model)
+
+
+def is_relu(node, modules):
+    if node.op == 'call_module':
+        return isinstance(modules[node.target], nn.ReLU) or isinstance(modules[node.target], nn.ReLU6)
+    elif node.op == 'call_function':
+        return node.target in RELU_FUNCTIONS
+    elif node.op == 'call_method':
+        return node.target in ['relu', 'relu_']
+    return False
+
+
+def mark_before_relu(model):
+    """
+    Mark conv, linear and bn layers whose output is consumed only by relu, for half range quantization.
+    Detected on traced graph of any model, returns names of marked layers or None if model can not be traced.
+    """
+    if isinstance(model, DataParallel):
+        model = model.module
+    graph = trace(model)
+    if graph is None:
+        return None
+    modules = dict(model.named_modules())
+    calls = call_counts(graph)
+    marked = []
+    for node in graph.nodes:
+        if node.op != 'call_module' or calls[node.target] != 1:
+            continue
+        m = modules[node.target]
+        if not (isinstance(m, nn.Conv2d) or isinstance(m, nn.Linear) or isinstance(m, nn.BatchNorm2d)):
+            continue
+        # Folded bn left as identity is skipped
+        user = list(node.users)[0] if len(node.users) == 1 else None
+        while user is not None and user.op == 'call_module' and isinstance(modules[user.target], nn.Identity):
+            user = list(user.users)[0] if len(user.users) == 1 else None
+        if user is not None and is_relu(user, modules):
+            m.before_relu = True
+            marked.append(node.target)
+    return marked
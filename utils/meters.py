@@ -1,3 +1,4 @@
+import math
 import torch
 
 class AverageMeter(object):
@@ -100,3 +101,60 @@ class AccuracyMeter(object):
     @property
     def avg_error(self):
         return {n: 100. - meter.avg for (n, meter) in self._meters.items()}
+
+
+class BinomialMeter(object):
+    """Counts successes of Bernoulli trials (e.g. correct top1), rate with Wilson score confidence interval"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sum = 0
+        self.count = 0
+
+    def update(self, successes, n):
+        self.sum += successes
+        self.count += n
+
+    @property
+    def avg(self):
+        return 100. * self.sum / self.count if self.count > 0 else 0.
+
+    def interval(self, confidence=0.95):
+        # Bounds in percent
+        if self.count == 0:
+            return 0., 100.
+        from statistics import NormalDist
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        n = self.count
+        p = self.sum / n
+        center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+        half = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+        return 100. * max(0., center - half), 100. * min(1., center + half)
+
+
+class EarlyStop(object):
+    """
+    Sequential stopping rule of evaluation. Stops when confidence intervals of all tracked rates (top1, agreement
+    with fp32) are narrower than +-width, or when top1 is clearly below reference accuracy.
+    Intervals are checked after every batch, so confidence should be high to account for repeated looks.
+    """
+
+    def __init__(self, width=0.5, confidence=0.99, reference=None, min_samples=1000):
+        self.width = width
+        self.confidence = confidence
+        self.reference = reference
+        self.min_samples = min_samples
+
+    def check(self, top1, agreement=None):
+        # Reason to stop or None
+        if top1.count < self.min_samples:
+            return None
+        lo, hi = top1.interval(self.confidence)
+        if self.reference is not None and hi < self.reference:
+            return 'below reference %.3f' % self.reference
+        intervals = [(lo, hi)] + ([agreement.interval(self.confidence)] if agreement is not None else [])
+        if all([h - l <= 2 * self.width for l, h in intervals]):
+            return 'interval within +-%.3f' % self.width
+        return None
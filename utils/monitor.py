@@ -14,8 +14,52 @@ def patch_call(instance, func):
     instance.__class__ = _
 
 
+class RingBuffer:
+    """
+    Last size captures of a tensor in preallocated host memory (pinned for cuda tensors), slots are reused.
+    Captures of different shape reallocate the buffer.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = None
+        self.counts = [0] * size
+        self.meta = [None] * size
+        self.pos = 0
+        self.len = 0
+
+    def __allocate(self, t):
+        self.data = torch.empty((self.size,) + tuple(t.shape), dtype=t.dtype, pin_memory=t.is_cuda)
+        self.pos = 0
+        self.len = 0
+
+    def push(self, t, meta, n=None):
+        t = t.detach()
+        if self.data is None or self.data.shape[2:] != t.shape[1:] or self.data.shape[1] < t.shape[0] \
+                or self.data.dtype != t.dtype:
+            self.__allocate(t)
+        n = t.shape[0] if n is None else n
+        self.data[self.pos, :n].copy_(t, non_blocking=True)
+        self.counts[self.pos] = n
+        self.meta[self.pos] = meta
+        self.pos = (self.pos + 1) % self.size
+        self.len = min(self.len + 1, self.size)
+
+    def snapshot(self):
+        # Oldest first
+        order = [(self.pos - self.len + i) % self.size for i in range(self.len)]
+        return {'data': [self.data[i, :self.counts[i]].clone() for i in order],
+                'epoch': [self.meta[i][0] for i in order],
+                'step': [self.meta[i][1] for i in order]}
+
+
 class Monitor(metaclass=Singleton):
-    def __init__(self, dump_dir=None):
+    """
+    By default keeps references to registered tensors until dump.
+    With capture=True tensors are copied to per key ring buffers of the last ring_size captures. Only every
+    sample_every step (see set_step) is captured and only sample_batch random samples of the batch
+    (same samples for all keys of the step). Memory and copy overhead are bounded.
+    """
+    def __init__(self, dump_dir=None, capture=False, ring_size=8, sample_every=1, sample_batch=None, seed=0):
         if dump_dir is None:
             raise Exception('dump_dir must be provided')
 
@@ -27,12 +71,63 @@ class Monitor(metaclass=Singleton):
         self.observed_tensors = dict()
         self.observed_operations = dict()
 
-    def register_tensor(self, tensor, key, retain_grad=False):
+        self.capture = capture
+        self.ring_size = ring_size
+        self.sample_every = sample_every
+        self.sample_batch = sample_batch
+        self.generator = torch.Generator().manual_seed(seed)
+        self.rings = dict()
+        self.epoch = 0
+        self.step = 0
+        self.sampled = True
+        self.batch_idx = dict()
+
+    def set_step(self, epoch, step):
+        self.epoch = epoch
+        self.step = step
+        self.sampled = step % self.sample_every == 0
+        self.batch_idx.clear()
+
+    def __sample_idx(self, batch_size, device):
+        # Random subset of the batch, drawn once per step and batch size
+        if batch_size not in self.batch_idx:
+            idx = torch.randperm(batch_size, generator=self.generator)[:self.sample_batch]
+            self.batch_idx[batch_size] = torch.sort(idx)[0]
+        return self.batch_idx[batch_size].to(device)
+
+    def capture_tensor(self, tensor, key, batch=True):
+        if not self.sampled:
+            return
+        t = tensor.detach()
+        if t.dim() == 0 or not batch:
+            t = t.unsqueeze(0)
+        elif self.sample_batch is not None and t.shape[0] > self.sample_batch:
+            t = t.index_select(0, self.__sample_idx(t.shape[0], t.device))
+        if key not in self.rings:
+            self.rings[key] = RingBuffer(self.ring_size)
+        self.rings[key].push(t, (self.epoch, self.step))
+
+    def dump_capture(self, fname='capture.pt'):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        rings = {key: ring.snapshot() for key, ring in self.rings.items()}
+        torch.save(rings, os.path.join(self.dump_dir, fname))
+
+    def register_tensor(self, tensor, key, retain_grad=False, batch=True):
+        if self.capture:
+            # Capture gradient when it is computed instead of retaining it
+            if retain_grad and tensor.requires_grad and self.sampled:
+                tensor.register_hook(lambda g: self.capture_tensor(g, key + '_grad', batch))
+            self.capture_tensor(tensor, key, batch)
+            return
         if retain_grad:
             tensor.retain_grad()
         self.observed_tensors[key] = tensor
 
     def dump_tensors(self, epoch, step):
+        if self.capture:
+            self.dump_capture('epoch_' + str(epoch) + '_step_' + str(step) + '.pt')
+            return
         grad_keys = []
         for key in self.observed_tensors.keys():
             tensor = self.observed_tensors[key]
@@ -54,6 +149,9 @@ class Monitor(metaclass=Singleton):
         self.observed_operations[key] = operation
 
     def dump_operations(self, epoch, step):
+        if self.capture:
+            self.dump_capture('epoch_' + str(epoch) + '_step_' + str(step) + '.pt')
+            return
         for op_key in self.observed_operations.keys():
             grad_keys = []
             operation = self.observed_operations[op_key]
@@ -85,11 +183,25 @@ class Monitor(metaclass=Singleton):
         Conv2d_dict['padding'] = Conv2d.padding
         Conv2d_dict['dilation'] = Conv2d.dilation
         Conv2d_dict['groups'] = Conv2d.groups
-        if Conv2d.bias:
+        if Conv2d.bias is not None:
             Conv2d_dict['bias'] = Conv2d.bias
         Conv2d_dict['weight'] = Conv2d.weight
         __call__ = Conv2d.__call__
 
+        def capture_warpper(input):
+            key = str(id(Conv2d))
+            self.register_tensor(input, key + '_input', retain_grad)
+            output = __call__(input)
+            self.register_tensor(output, key + '_output', retain_grad)
+            return output
+
+        if self.capture:
+            # Weights are parameters, capture only activations
+            del Conv2d_dict['weight']
+            Conv2d_dict.pop('bias', None)
+            patch_call(Conv2d, capture_warpper)
+            return
+
         def call_warpper(input):
             Conv2d_dict['input'] = input
             if retain_grad:
@@ -0,0 +1,162 @@
+import os
+dir_path = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.join(dir_path, os.path.pardir)
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+import subprocess
+import time
+from pathlib import Path
+
+
+home = str(Path.home())
+DEFAULT_DB = os.path.join(home, 'mxt-sim', 'results.db')
+
+# Arguments that do not change results of a run
+NO_RESULT = ['print_freq', 'workers', 'cpu_workers', 'results_json', 'results_db', 'results_db_skip', 'mlflow',
+             'mlf_experiment', 'distributed', 'dump_dir', 'dump_async', 'dump_compress', 'dump_queue_mb',
+             'measure_stats', 'measure_stats_folder', 'profile_quant', 'device_ids']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    config_hash TEXT NOT NULL,
+    code_version TEXT NOT NULL,
+    arch TEXT,
+    qtype TEXT,
+    qweight TEXT,
+    act_bits INTEGER,
+    weight_bits INTEGER,
+    subset INTEGER,
+    tag TEXT,
+    loss REAL,
+    top1 REAL,
+    top5 REAL,
+    images INTEGER,
+    early_stop INTEGER NOT NULL DEFAULT 0,
+    config TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config_hash, code_version);
+CREATE INDEX IF NOT EXISTS runs_budget ON runs (arch, weight_bits, act_bits, top1);
+'''
+
+__code_version = None
+
+
+def code_version():
+    # Git commit of the code, marked dirty if there are uncommitted changes
+    global __code_version
+    if __code_version is None:
+        try:
+            rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root_dir,
+                                          stderr=subprocess.DEVNULL).decode().strip()
+            dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=root_dir, stderr=subprocess.DEVNULL) != 0
+            __code_version = rev + ('-dirty' if dirty else '')
+        except (OSError, subprocess.CalledProcessError):
+            __code_version = 'unknown'
+    return __code_version
+
+
+def type_bits(qtype):
+    # int8 -> 8, fp8e4m3 -> 8, bfloat16 -> 16, half -> 16, not quantized -> 32
+    if qtype is None:
+        return 32
+    if qtype == 'half':
+        return 16
+    m = re.match(r'[a-z]+(\d+)', qtype)
+    return int(m.group(1)) if m is not None else (16 if qtype == 'bfloat' else None)
+
+
+def run_config(args, tag=None):
+    # Tag distinguishes runs with the same arguments (e.g. fp32 reference of eval_precision)
+    config = vars(args) if isinstance(args, argparse.Namespace) else dict(args)
+    config = {k: v for k, v in config.items() if k not in NO_RESULT}
+    if tag is not None:
+        config['tag'] = tag
+    return config
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultsDB:
+    """
+    Append only store of run results in SQLite, keyed by full run config and code version.
+    WAL journal lets parallel jobs write concurrently, writers wait on lock instead of failing.
+    """
+    def __init__(self, path=None, timeout=120):
+        self.path = path if path is not None else DEFAULT_DB
+        dir_name = os.path.dirname(self.path)
+        if dir_name != '' and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=timeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            # Databases created before early stop was recorded
+            columns = [r['name'] for r in self.conn.execute('PRAGMA table_info(runs)')]
+            if 'images' not in columns:
+                self.conn.execute('ALTER TABLE runs ADD COLUMN images INTEGER')
+            if 'early_stop' not in columns:
+                self.conn.execute('ALTER TABLE runs ADD COLUMN early_stop INTEGER NOT NULL DEFAULT 0')
+
+    def add(self, args, loss, top1, top5, tag=None, images=None, early_stop=False):
+        # Early stopped runs are estimates from part of the data (images evaluated)
+        config = run_config(args, tag)
+        row = (config_hash(config), code_version(), config.get('arch'), config.get('qtype'), config.get('qweight'),
+               type_bits(config.get('qtype')), type_bits(config.get('qweight')), config.get('subset'), tag,
+               float(loss), float(top1), float(top5), images, int(bool(early_stop)),
+               json.dumps(config, sort_keys=True, default=str), time.time())
+        with self.conn:
+            self.conn.execute('INSERT INTO runs (config_hash, code_version, arch, qtype, qweight, act_bits, '
+                              'weight_bits, subset, tag, loss, top1, top5, images, early_stop, config, created) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def find(self, args, tag=None, any_version=False):
+        # Latest result of the same config (and code version), None if there is none
+        query = 'SELECT * FROM runs WHERE config_hash = ?'
+        params = [config_hash(run_config(args, tag))]
+        if not any_version:
+            query += ' AND code_version = ?'
+            params.append(code_version())
+        return self.conn.execute(query + ' ORDER BY id DESC LIMIT 1', params).fetchone()
+
+    def best_per_budget(self, arch=None, subset=None, early_stop=False):
+        # Best top1 per weight/activation bit widths, of fully evaluated runs unless early_stop
+        query = 'SELECT arch, weight_bits, act_bits, MAX(top1) AS top1, top5, loss, images, early_stop, ' \
+                'config_hash, code_version FROM runs WHERE subset IS ?'
+        params = [subset]
+        if not early_stop:
+            query += ' AND early_stop = 0'
+        if arch is not None:
+            query += ' AND arch = ?'
+            params.append(arch)
+        query += ' GROUP BY arch, weight_bits, act_bits ORDER BY arch, weight_bits, act_bits'
+        return self.conn.execute(query, params).fetchall()
+
+    def query(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query results database')
+    parser.add_argument('--db', default=DEFAULT_DB, help='Database file')
+    parser.add_argument('--arch', '-a', default=None, help='Filter by architecture')
+    parser.add_argument('--subset', '-ss', default=None, type=int, help='Runs on subset of data (default: full set)')
+    parser.add_argument('--early_stop', '-es', action='store_true', default=False, help='Include early stopped runs')
+    parser.add_argument('--sql', default=None, help='Custom query')
+    args = parser.parse_args()
+
+    import pandas as pd
+    db = ResultsDB(args.db)
+    rows = db.query(args.sql) if args.sql is not None else db.best_per_budget(args.arch, args.subset, args.early_stop)
+    print(pd.DataFrame([dict(r) for r in rows]))
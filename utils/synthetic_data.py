@@ -0,0 +1,100 @@
+import os
+import torch
+import torch.nn as nn
+from pathlib import Path
+
+
+home = str(Path.home())
+base_dir = os.path.join(home, 'mxt-sim', 'synthetic')
+
+
+class BNStatsLoss(object):
+    """Distance of batch statistics of BN inputs to running statistics stored in BN layers"""
+    def __init__(self, model):
+        self.losses = []
+        self.handles = [m.register_forward_hook(self.hook) for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+        if len(self.handles) == 0:
+            raise ValueError('Model has no BatchNorm2d layers, synthetic data needs BN statistics')
+
+    def hook(self, module, input, output):
+        x = input[0]
+        mean = x.mean(dim=(0, 2, 3))
+        std = torch.sqrt(x.var(dim=(0, 2, 3), unbiased=False) + module.eps)
+        self.losses.append(torch.norm(mean - module.running_mean) +
+                           torch.norm(std - torch.sqrt(module.running_var + module.eps)))
+
+    def pop(self):
+        loss = sum(self.losses)
+        self.losses = []
+        return loss
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+
+
+def distill_batch(model, batch_size, input_size=224, iterations=500, lr=0.2, device='cpu'):
+    """
+    Synthetic batch of normalized images optimized to match BN statistics of the model (ZeroQ, Cai et al. 2020).
+    Labels are predictions of the model on the generated images.
+    """
+    bn_loss = BNStatsLoss(model)
+    try:
+        x = torch.randn(batch_size, 3, input_size, input_size, device=device, requires_grad=True)
+        optimizer = torch.optim.Adam([x], lr=lr)
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, min_lr=1e-4, patience=50)
+        for _ in range(iterations):
+            optimizer.zero_grad()
+            model(x)
+            # Inputs are normalized, keep them close to zero mean and unit variance
+            loss = bn_loss.pop() + torch.norm(x.mean(dim=(0, 2, 3))) + torch.norm(x.std(dim=(0, 2, 3)) - 1)
+            loss.backward()
+            optimizer.step()
+            scheduler.step(loss.item())
+        with torch.no_grad():
+            labels = model(x).argmax(1)
+            bn_loss.pop()
+    finally:
+        bn_loss.remove()
+    return x.detach(), labels
+
+
+def synthetic_dataset(model, num_samples, batch_size, input_size=224, iterations=500, seed=0, device='cpu',
+                      cache_name=None):
+    """
+    Dataset of synthetic calibration images, generated from BN statistics before BN folding.
+    Generated images are cached in ~/mxt-sim/synthetic/<cache_name>.pt
+    """
+    path = os.path.join(base_dir, cache_name + '.pt') if cache_name is not None else None
+    if path is not None and os.path.exists(path):
+        print("=> loading synthetic calibration data '{}'".format(path))
+        data, labels = torch.load(path)
+        return torch.utils.data.TensorDataset(data, labels)
+
+    training = model.training
+    model.eval()
+    # Model parameters are not optimized
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    for p in model.parameters():
+        p.requires_grad_(False)
+
+    g = torch.random.get_rng_state()
+    torch.manual_seed(seed)
+    data, labels = [], []
+    for i in range(0, num_samples, batch_size):
+        x, y = distill_batch(model, min(batch_size, num_samples - i), input_size, iterations, device=device)
+        data.append(x.cpu())
+        labels.append(y.cpu())
+        print("Synthetic calibration data: %d/%d" % (i + len(x), num_samples))
+    torch.random.set_rng_state(g)
+
+    for p, r in zip(model.parameters(), requires_grad):
+        p.requires_grad_(r)
+    model.train(training)
+
+    data = torch.cat(data)
+    labels = torch.cat(labels)
+    if path is not None:
+        os.makedirs(base_dir, exist_ok=True)
+        torch.save((data, labels), path)
+    return torch.utils.data.TensorDataset(data, labels)
@@ -0,0 +1,33 @@
+import torch.nn as nn
+
+
+def is_leaf(m):
+    # Modules derived from torch.nn layers (e.g. Conv2dWithId) are not traced into
+    return not isinstance(m, nn.Sequential) and \
+        any([c.__module__.startswith('torch.nn') for c in type(m).__mro__ if c is not nn.Module and c is not object])
+
+
+def trace(model):
+    """fx graph of the model with torch.nn layers as leaves, None if fx is not available or tracing fails"""
+    try:
+        import torch.fx as fx
+    except ImportError:
+        return None
+
+    class LeafTracer(fx.Tracer):
+        def is_leaf_module(self, m, module_qualified_name):
+            return is_leaf(m)
+
+    try:
+        return LeafTracer().trace(model)
+    except Exception:
+        return None
+
+
+def call_counts(graph):
+    # Number of calls of every module, shared modules are called more than once
+    calls = {}
+    for node in graph.nodes:
+        if node.op == 'call_module':
+            calls[node.target] = calls.get(node.target, 0) + 1
+    return calls